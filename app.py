@@ -7,6 +7,7 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timezone, timedelta
 from models import QuestHistory, Quest, Question, QuestAttemptLog
 import os
+import sys
 import json
 import re
 import logging
@@ -15,7 +16,23 @@ import time
 import atexit
 import csv
 import io
+import uuid
+import threading
 from utils.svg_preview_bp import bp as svg_preview_bp # Import the blueprint
+from utils import question_cache
+from utils.catalog import catalog
+from utils import rollups, attempt_buckets, student_summary, result_store, submissions
+from utils.write_queue import WriteQueue
+from utils.retry import RetryPolicy, is_retryable
+from utils import content_snapshot
+from utils.content_version import VersionWatcher
+from utils import cache as app_cache
+from utils.cache import cached
+from utils.single_flight import coalesced, flights
+from utils import cross_db, id_allocator
+from utils import importer, exporter, grading, answer_log
+from utils import jobs
+from utils.jobs import JobRunner, JobQueueFull
 
 # ... (rest of imports/mappings)
 
@@ -50,7 +67,15 @@ SUBJECT_KEY_TO_JP = {
 # 日本語名から英語キーへの逆引きマップ
 SUBJECT_JP_TO_KEY = {v: k for k, v in SUBJECT_KEY_TO_JP.items()}
 
-from models import db, User, Quest, UserProgress
+from models import db, User, Quest, UserProgress, ProgressRollup, AttemptBucket, QuestResult, AttemptAnswer
+
+# メダル判定（utils.rollups.MEDAL_TIERS）の表示用スタイル
+MEDAL_STYLES = {
+    'diamond': {'icon': 'fa-gem', 'color': '#00d2ff', 'label': 'ダイヤモンド', 'text': 'text-info'},
+    'gold': {'icon': 'fa-medal', 'color': '#FFD700', 'label': '金', 'text': 'text-warning'},
+    'silver': {'icon': 'fa-medal', 'color': '#C0C0C0', 'label': '銀', 'text': 'text-secondary'},
+    'bronze': {'icon': 'fa-medal', 'color': '#CD7F32', 'label': '銅', 'text': 'text-brown'},
+}
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 app = Flask(__name__, template_folder=os.path.join(basedir, 'templates'))
@@ -63,6 +88,15 @@ def from_json_filter(s):
     except (json.JSONDecodeError, TypeError):
         return None
 
+@app.template_filter('local_datetime')
+def local_datetime_filter(dt, fmt='%Y-%m-%d %H:%M'):
+    """DBのUTC日時を設定タイムゾーン（MQUEST_TIMEZONE）の表示文字列にする。"""
+    if not dt:
+        return ''
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(attempt_buckets.get_timezone(app.config['MQUEST_TIMEZONE'])).strftime(fmt)
+
 # データベース設定（例: SQLite）
 # Flask-SQLAlchemyはデフォルトでinstanceフォルダを探すため、パスから 'instance/' を除外するか絶対パスを使用します。
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'instance', 'mquest_user.db')
@@ -70,10 +104,28 @@ app.config['SQLALCHEMY_BINDS'] = {
     'content': 'sqlite:///' + os.path.join(basedir, 'instance', 'mquest_content.db')
 }
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# 学習グラフの日・週・月の区切りに使うタイムゾーン
+app.config['MQUEST_TIMEZONE'] = os.environ.get('MQUEST_TIMEZONE', 'Asia/Tokyo')
+# 生徒向けのクエスト・問題の読み取りをコンテンツDBのインメモリスナップショットから行う（MQUEST_CONTENT_SNAPSHOT=1 で有効）
+app.config['MQUEST_CONTENT_SNAPSHOT'] = os.environ.get('MQUEST_CONTENT_SNAPSHOT', '0') == '1'
+# 集計結果のキャッシュ（'tiered': プロセス内 + 全プロセス共有の SQLite、'memory': プロセス内のみ、'off': 無効）
+app.config['MQUEST_CACHE'] = os.environ.get('MQUEST_CACHE', 'tiered')
+app.config['MQUEST_CACHE_TTL'] = int(os.environ.get('MQUEST_CACHE_TTL', 300))
+# 他のプロセスでのタグの更新を確認する間隔（秒）
+app.config['MQUEST_CACHE_TAG_INTERVAL'] = float(os.environ.get('MQUEST_CACHE_TAG_INTERVAL', 1.0))
+# 結果送信などのユーザーDBへの書き込みを専用スレッドに集約する（MQUEST_WRITE_QUEUE=1 で有効）
+app.config['MQUEST_WRITE_QUEUE'] = os.environ.get('MQUEST_WRITE_QUEUE', '0') == '1'
+# インポートで1トランザクションにまとめるレコード数
+app.config['MQUEST_IMPORT_BATCH_SIZE'] = int(os.environ.get('MQUEST_IMPORT_BATCH_SIZE', 500))
+# インポート・エクスポートなどのバックグラウンドジョブを同時に実行する数
+app.config['MQUEST_JOB_WORKERS'] = int(os.environ.get('MQUEST_JOB_WORKERS', 2))
 
 # DBとLoginManagerの初期化
 db.init_app(app)
 
+# 解決できないタイムゾーンでは集計の日付がずれるため、起動時にエラーにする
+attempt_buckets.get_timezone(app.config['MQUEST_TIMEZONE'])
+
 from sqlalchemy import event
 from sqlalchemy.engine import Engine
 
@@ -86,80 +138,198 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
         cursor.execute("PRAGMA busy_timeout=30000")
         cursor.close()
 
+from sqlalchemy.orm import Session as SASession, selectinload
+
+# インポート・エクスポートなどのバックグラウンドジョブ（utils/jobs.py）
+job_runner = JobRunner(app, workers=app.config['MQUEST_JOB_WORKERS'])
+atexit.register(job_runner.stop)
+IMPORT_DIR = os.path.join(basedir, 'instance', 'imports')
+IMPORT_EXTENSIONS = ('.json', '.ndjson', '.jsonl')
+EXPORT_DIR = os.path.join(basedir, 'instance', 'exports')
+
+def submit_job(kind, fn, *args):
+    """
+    管理画面の処理をバックグラウンドのジョブとして登録し、ジョブの画面へのリダイレクトを返す。
+    待ち行列がいっぱいの場合はエラーを表示して None を返す。
+    """
+    try:
+        job = job_runner.submit(kind, fn, *args, created_by=current_user.id)
+    except JobQueueFull:
+        flash("実行待ちのジョブが多すぎます。しばらくしてから再度お試しください。", "danger")
+        return None
+    return job
+
+def run_write(fn, *args, **kwargs):
+    """
+    ユーザーDBへの書き込み処理 fn を実行してコミットし、fn の戻り値を返す。
+    書き込みキューが有効な場合は書き込みスレッドで実行され、その完了を待つ。
+    """
+    if write_queue is not None:
+        return write_queue.submit(fn, *args, **kwargs).result(timeout=WRITE_QUEUE_TIMEOUT)
+    result = fn(*args, **kwargs)
+    safe_commit(site=f"commit:{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}")
+    return result
+
+def refresh_progress_rollups(groups, user_ids=()):
+    """
+    クエストの追加・削除・科目/レベル変更をコミットした後に呼び出し、
+    progress_rollups の総クエスト数とメダル判定を更新する。
+    user_ids を指定した場合はその生徒の集計を作り直す。
+    """
+    if user_ids:
+        rollups.rebuild(user_ids)
+    rollups.refresh_totals(groups)
+    safe_commit()
+    # 総クエスト数・メダルが変わるため、全生徒の進捗のキャッシュを無効にする
+    app_cache.cache.bump_tag('rollups')
+
+def mark_content_changed(quest_ids=None):
+    """
+    コンテンツ（クエスト・問題）の変更を記録する。
+    キャッシュの破棄は現在のトランザクションの終了後に行う（quest_ids=None は全件）。
+    """
+    pending = db.session.info.setdefault('changed_quest_ids', set())
+    if quest_ids is None:
+        pending.add(None)
+    else:
+        pending.update(int(qid) for qid in quest_ids)
+
+def invalidate_content(quest_ids=None):
+    """プロセス内のコンテンツキャッシュを破棄する（quest_ids=None は全件）。"""
+    # 次のリクエストで content_version を読み直し、キャッシュのキーに新しい値が使われるようにする
+    content_watcher.expire()
+    # スナップショットを先に無効化し、キャッシュの再構築が新しい内容を読むようにする
+    content_snapshot.snapshot.invalidate()
+    question_cache.invalidate(quest_ids)
+    catalog.invalidate(quest_ids)
+
+@event.listens_for(SASession, "after_commit")
+@event.listens_for(SASession, "after_soft_rollback")
+def invalidate_content_caches(session, *args):
+    pending = session.info.pop('changed_quest_ids', None)
+    if not pending:
+        return
+    invalidate_content(None if None in pending else pending)
+
+# 他のワーカープロセスでのコンテンツ変更の検知（content_version テーブル）
+content_watcher = VersionWatcher(
+    invalidate_content,
+    interval=float(os.environ.get('MQUEST_CONTENT_VERSION_INTERVAL', 1.0))
+)
+
+# 後から追加したユーザーDBのテーブル。既存のDBでもスクリプトを実行せずに動くよう、最初のリクエストの前に作成する
+USER_DB_TABLES = (ProgressRollup, AttemptBucket, QuestResult, AttemptAnswer)
+_user_tables_ready = False
+_user_tables_lock = threading.Lock()
+
+@app.before_request
+def ensure_user_tables():
+    global _user_tables_ready
+    if _user_tables_ready:
+        return
+    with _user_tables_lock:
+        if not _user_tables_ready:
+            for model in USER_DB_TABLES:
+                model.__table__.create(db.engine, checkfirst=True)
+            _user_tables_ready = True
+
+@app.before_request
+def check_content_version():
+    content_watcher.check()
+
+app_cache.configure(app)
+
+def content_cache_version(*args, **kwargs):
+    """コンテンツから作る値のキャッシュのバージョン（content_version が無い環境では None = キャッシュしない）。"""
+    return content_watcher.version
+
+def user_cache_version(user_id, *args, **kwargs):
+    """生徒の学習データから作る値のキャッシュのバージョン。"""
+    version = content_watcher.version
+    if version is None:
+        return None
+    return (version, app_cache.cache.get_tag(f'user:{user_id}'), app_cache.cache.get_tag('rollups'))
+
+def students_cache_version(*args, **kwargs):
+    """生徒一覧（全生徒の進捗・メダル）のバージョン。"""
+    version = content_watcher.version
+    if version is None:
+        return None
+    return (version, app_cache.cache.get_tag('students'), app_cache.cache.get_tag('rollups'))
+
+def aggregates_rebuilt():
+    """集計テーブルを作り直した後に呼び出し、全生徒の進捗・学習グラフのキャッシュを全プロセスで無効にする。"""
+    app_cache.cache.bump_tag('rollups')
+    app_cache.cache.bump_tag('students')
+
+def user_data_changed(user_id):
+    """
+    生徒の学習データの変更後に呼び出し、その生徒のキャッシュを全プロセスで無効にする。
+    送信のたびに全ワーカーが同じ行を書き換えないよう、生徒一覧のタグ（'students'）はここでは更新しない
+    （生徒一覧は同時リクエストをまとめるだけで、結果は保持しない）。
+    """
+    app_cache.cache.bump_tag(f'user:{user_id}')
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 app.register_blueprint(svg_preview_bp) # Register the blueprint
 
-def safe_commit(retries=3, delay=0.5):
+# SQLite の一時的なエラー（ロック・I/O）に対するリトライ方針（utils/retry.py）
+db_retry = RetryPolicy(
+    max_attempts=int(os.environ.get('MQUEST_DB_RETRY_ATTEMPTS', 4)),
+    deadline=float(os.environ.get('MQUEST_DB_RETRY_DEADLINE', 2.0)),
+    request_budget=float(os.environ.get('MQUEST_DB_RETRY_REQUEST_BUDGET', 3.0))
+)
+
+# 書き込みキュー（無効の場合は None）。終了時は DB のチェックポイントより先に停止する
+# 他のプロセスとのロックの競合は、バッチ全体を db_retry でやり直す
+write_queue = WriteQueue(app, retry=db_retry.call).start() if app.config['MQUEST_WRITE_QUEUE'] else None
+if write_queue is not None:
+    atexit.register(write_queue.stop)
+WRITE_QUEUE_TIMEOUT = 30
+
+def _call_site(operation):
+    """メトリクス用の呼び出し箇所名（例: 'commit:quest_result'）。safe_* の呼び出し元の関数名を使う。"""
+    return f"{operation}:{sys._getframe(2).f_code.co_name}"
+
+def safe_commit(site=None):
     """
-    Attempts to commit the current session, with retries for OperationalError (e.g., disk I/O error).
+    Commits the current session, retrying transient SQLite errors (busy/locked/I/O)
+    according to db_retry. The session is rolled back before each retry and on failure.
     """
-    for i in range(retries):
-        try:
-            db.session.commit()
-            return True
-        except OperationalError as e:
-            if "disk I/O error" in str(e) or "database is locked" in str(e):
-                app.logger.warning(f"Database commit failed (attempt {i+1}/{retries}): {e}. Retrying in {delay}s...")
-                db.session.rollback()
-                time.sleep(delay)
-                continue
-            else:
-                db.session.rollback()
-                raise
-        except Exception:
-            db.session.rollback()
-            raise
-    # Final attempt
-    db.session.commit()
+    try:
+        db_retry.call(db.session.commit, site or _call_site('commit'), on_retry=lambda e: db.session.rollback())
+    except Exception:
+        db.session.rollback()
+        raise
     return True
 
-def safe_get(model, ident, retries=3, delay=0.5):
+def safe_get(model, ident, options=None, site=None):
     """
-    Attempts to get a record by ID with retries for OperationalError.
+    Gets a record by primary key, retrying transient SQLite errors.
+    options: loader options such as [selectinload(Quest.questions)].
     """
-    for i in range(retries):
-        try:
-            return db.session.get(model, ident)
-        except OperationalError as e:
-            if "disk I/O error" in str(e) or "database is locked" in str(e):
-                app.logger.warning(f"Database get failed (attempt {i+1}/{retries}): {e}. Retrying in {delay}s...")
-                time.sleep(delay)
-                continue
-            raise
-    return db.session.get(model, ident)
+    return db_retry.call(lambda: db.session.get(model, ident, options=options), site or _call_site('get'))
 
-def safe_query_all(query, retries=3, delay=0.5):
-    """
-    Attempts to execute a query (all()) with retries for OperationalError.
-    """
-    for i in range(retries):
-        try:
-            return query.all()
-        except OperationalError as e:
-            if "disk I/O error" in str(e) or "database is locked" in str(e):
-                app.logger.warning(f"Database query all failed (attempt {i+1}/{retries}): {e}. Retrying in {delay}s...")
-                time.sleep(delay)
-                continue
-            raise
-    return query.all()
+def safe_query_all(query, site=None):
+    """Executes query.all(), retrying transient SQLite errors."""
+    return db_retry.call(query.all, site or _call_site('query_all'))
+
+def safe_query_first(query, site=None):
+    """Executes query.first(), retrying transient SQLite errors."""
+    return db_retry.call(query.first, site or _call_site('query_first'))
 
-def safe_query_first(query, retries=3, delay=0.5):
+def run_cross_db(op, *args):
     """
-    Attempts to execute a query (first()) with retries for OperationalError.
+    ユーザーDBとコンテンツDBにまたがる処理 op(conn, *args) を1つのトランザクションで実行する
+    （utils/cross_db.py）。一時的なエラーの場合はトランザクション全体をやり直す。
     """
-    for i in range(retries):
-        try:
-            return query.first()
-        except OperationalError as e:
-            if "disk I/O error" in str(e) or "database is locked" in str(e):
-                app.logger.warning(f"Database query first failed (attempt {i+1}/{retries}): {e}. Retrying in {delay}s...")
-                time.sleep(delay)
-                continue
-            raise
-    return query.first()
+    def attempt():
+        with cross_db.unit_of_work(db.engine, db.engines['content']) as conn:
+            return op(conn, *args)
+    return db_retry.call(attempt, f"cross_db:{op.__name__}")
 
 @app.route('/')
 def home():
@@ -251,8 +421,7 @@ def profile():
         avatars = ['default.svg']
 
     # 利用可能な全レベルを取得
-    all_levels_raw = safe_query_all(db.session.query(Quest.level).distinct())
-    all_levels = sorted(list(set([l[0] for l in all_levels_raw])))
+    all_levels = catalog.levels()
 
     if request.method == 'POST':
         nickname = request.form.get('nickname', '').strip()
@@ -376,67 +545,78 @@ def create_user():
     '''
 
 
-@app.route('/dashboard/student')
-@login_required
-def dashboard_student():
-    if session.get('role') != 'student':
-        return redirect(url_for('login'))
-
-    target_levels = current_user.target_levels
-    
-    # 科目ごとの進捗計算
-    progress_summary = {}
-    subjects = {
-        'math': 'europe',
-        'english': 'americus',
-        'japanese': 'zipangu'
-    }
-
-    conquered_quest_data = []
+# 科目キーと世界地図の対応
+SUBJECT_WORLDS = {
+    'math': 'europe',
+    'english': 'americus',
+    'japanese': 'zipangu'
+}
 
-    for sub_key, world_name in subjects.items():
+@coalesced('dashboard_student', version=user_cache_version)
+def build_student_dashboard(user_id, target_levels):
+    """
+    生徒ダッシュボード用の集計。全科目分の進捗とマップ表示用データを返す。
+    クエスト→科目/レベルの対応はカタログ索引から引くため、DBへの問い合わせは
+    ユーザーDBへの1クエリ（クリア済みクエストと挑戦回数の射影）のみ。
+    同時に来た同じ生徒の集計は1回だけ実行して結果を共有する（変更しないこと）。
+    """
+    quest_subject = {}
+    quest_codes = {}
+    totals = {}
+    for sub_key in SUBJECT_WORLDS:
         target_level = target_levels.get(sub_key, 'Lv1')
-        
-        # 1. ターゲットレベルの全クエストを取得
-        all_quests_in_level = safe_query_all(Quest.query.filter_by(title=sub_key, level=target_level))
-        total_count = len(all_quests_in_level)
-        
-        # 2. その中からクリア済みのものを取得
-        quest_ids = [q.id for q in all_quests_in_level]
-        cleared_records = safe_query_all(UserProgress.query.filter(
-            UserProgress.user_id == current_user.id,
+        totals[sub_key] = catalog.count(sub_key, target_level)
+        for q in catalog.quests(sub_key, target_level):
+            quest_subject[q.id] = sub_key
+            quest_codes[q.id] = q.code
+
+    rows = []
+    if quest_subject:
+        rows = safe_query_all(db.session.query(
+            UserProgress.quest_id,
+            QuestHistory.attempts
+        ).outerjoin(
+            QuestHistory,
+            (QuestHistory.user_id == UserProgress.user_id) & (QuestHistory.quest_id == UserProgress.quest_id)
+        ).filter(
+            UserProgress.user_id == user_id,
             UserProgress.status == 'cleared',
-            UserProgress.quest_id.in_(quest_ids)
-        ))
-        cleared_count = len(cleared_records)
-        cleared_quest_ids = [p.quest_id for p in cleared_records]
+            UserProgress.quest_id.in_(list(quest_subject))
+        ).order_by(UserProgress.quest_id))
+
+    cleared_counts = {sub_key: 0 for sub_key in SUBJECT_WORLDS}
+    conquered_by_subject = {sub_key: [] for sub_key in SUBJECT_WORLDS}
+    for quest_id, attempts in rows:
+        sub_key = quest_subject[quest_id]
+        cleared_counts[sub_key] += 1
+        conquered_by_subject[sub_key].append({
+            # SVGのIDと一致させるため、表示用のクエストID（code）を (code % 1000) // 10 に変換
+            "quest_id": ((quest_codes[quest_id] or quest_id) % 1000) // 10,
+            "attempts": attempts or 0,
+            "map_type": SUBJECT_WORLDS[sub_key]
+        })
 
-        # 3. 割合計算
-        percentage = int((cleared_count / total_count * 100)) if total_count > 0 else 0
-        
-        # 4. マップ表示用の詳細データ収集 (ターゲットレベルのもののみ)
-        if cleared_quest_ids:
-            histories = safe_query_all(QuestHistory.query.filter(
-                QuestHistory.user_id == current_user.id,
-                QuestHistory.quest_id.in_(cleared_quest_ids)
-            ))
-            attempts_map = {h.quest_id: h.attempts for h in histories}
-            
-            for q_id in cleared_quest_ids:
-                # SVGのIDと一致させるため、(ID % 1000) // 10 に変換
-                map_marker_id = (q_id % 1000) // 10
-                conquered_quest_data.append({
-                    "quest_id": map_marker_id,
-                    "attempts": attempts_map.get(q_id, 0),
-                    "map_type": world_name
-                })
-        
+    progress_summary = {}
+    conquered_quest_data = []
+    for sub_key in SUBJECT_WORLDS:
+        total_count = totals[sub_key]
+        cleared_count = cleared_counts[sub_key]
+        conquered_quest_data.extend(conquered_by_subject[sub_key])
         progress_summary[sub_key] = {
             "cleared": cleared_count,
             "total": total_count,
-            "percentage": percentage,
-            "level": target_level
+            "percentage": int((cleared_count / total_count * 100)) if total_count > 0 else 0,
+            "level": target_levels.get(sub_key, 'Lv1')
         }
+    return progress_summary, conquered_quest_data
+
+@app.route('/dashboard/student')
+@login_required
+def dashboard_student():
+    if session.get('role') != 'student':
+        return redirect(url_for('login'))
+
+    progress_summary, conquered_quest_data = build_student_dashboard(current_user.id, current_user.target_levels)
 
     return render_template(
         'dashboard_student.html',
@@ -445,12 +625,27 @@ def dashboard_student():
         progress_summary=progress_summary
     )
 
+def build_parent_summary(parent_id, recent_limit=5):
+    """
+    保護者の子ども全員の学習状況（メダル数・科目/レベル別クリア数・最終学習日時・最近の挑戦）。
+    子どもの人数に関係なく一定回数のクエリで集計する（utils/student_summary.parent_summary）。
+    """
+    summary = student_summary.parent_summary(parent_id, recent_limit=recent_limit)
+    for child in summary:
+        for p in child['progress']:
+            p['title'] = SUBJECT_KEY_TO_JP.get(p['title'], p['title'])
+        for attempt in child['recent_attempts']:
+            if attempt['title']:
+                attempt['title'] = SUBJECT_KEY_TO_JP.get(attempt['title'], attempt['title'])
+    return summary
+
 @app.route('/dashboard/parent')
 @login_required
 def dashboard_parent():
     if session.get('role') != 'parent':
         return redirect(url_for('login'))
-    return render_template('dashboard_parent.html', user_id=session.get('user_id'))
+    children = build_parent_summary(session.get('user_id'), recent_limit=3)
+    return render_template('dashboard_parent.html', user_id=session.get('user_id'), children=children)
 
 @app.route('/dashboard/admin')
 @login_required
@@ -471,9 +666,8 @@ def dashboard_teacher():
 @app.route('/select_title')
 @login_required
 def select_title():
-    titles = safe_query_all(db.session.query(Quest.title).distinct())
     # ユーザーに表示する際は、ここで日本語に変換
-    jp_titles = [SUBJECT_KEY_TO_JP.get(t[0], t[0]) for t in titles]
+    jp_titles = [SUBJECT_KEY_TO_JP.get(t, t) for t in catalog.titles()]
     return render_template('select_title.html', titles=jp_titles)
 
 # レベル選択（ステップ2）
@@ -482,24 +676,19 @@ def select_title():
 def select_level(title):
     print(f"Title: {title}")
     title_key = SUBJECT_JP_TO_KEY.get(title, title)
-    levels = safe_query_all(db.session.query(Quest.level).filter_by(title=title_key).distinct())
+    levels = catalog.levels(title_key)
     print(f"Levels: {levels}")
-    return render_template('select_level.html', title=title, levels=[l[0] for l in levels])
+    return render_template('select_level.html', title=title, levels=levels)
 
 @app.route('/select_quest/<title>/<level>')
 @login_required
 def select_quest_by_title_level(title, level):
     title_key = SUBJECT_JP_TO_KEY.get(title, title)
-    quests = safe_query_all(Quest.query.filter_by(title=title_key, level=level))
+    quests = catalog.quests(title_key, level)
 
     history_map = {}
     if current_user.is_authenticated:
-        user_id = current_user.id
-        histories = safe_query_all(QuestHistory.query.filter(
-            QuestHistory.user_id == user_id,
-            QuestHistory.quest_id.in_([q.id for q in quests])
-        ))
-        history_map = {h.quest_id: h for h in histories}
+        history_map = quest_history_map(current_user.id, title_key, level)
 
     return render_template(
         'select_quest.html',
@@ -509,13 +698,26 @@ def select_quest_by_title_level(title, level):
         history_map=history_map
     )
 
+@cached('quest_history_map', version=user_cache_version)
+def quest_history_map(user_id, title_key, level):
+    """科目・レベル内のクエストごとの挑戦回数・クリア回数（quest_id -> dict）。"""
+    quest_ids = [q.id for q in catalog.quests(title_key, level)]
+    histories = safe_query_all(db.session.query(
+        QuestHistory.quest_id, QuestHistory.attempts, QuestHistory.cleared_count, QuestHistory.is_cleared
+    ).filter(
+        QuestHistory.user_id == user_id,
+        QuestHistory.quest_id.in_(quest_ids)
+    ))
+    return {h.quest_id: {'attempts': h.attempts, 'cleared_count': h.cleared_count, 'is_cleared': h.is_cleared}
+            for h in histories}
+
 # クエスト実行（ステップ4）    
 @app.route('/quest/<int:quest_id>', methods=['GET', 'POST'])
 def quest(quest_id):
     if session.get('role') != 'student':
         return redirect(url_for('login'))
 
-    quest_obj = safe_get(Quest, quest_id)
+    quest_obj = safe_get(Quest, quest_id, options=[selectinload(Quest.questions)])
     if not quest_obj:
         return "クエストが見つかりません", 404
 
@@ -539,7 +741,7 @@ def quest(quest_id):
 @app.route("/quest/select/<title>/<level>")
 def select_quest(title, level):
     title_key = SUBJECT_JP_TO_KEY.get(title, title)
-    quests = safe_query_all(Quest.query.filter_by(title=title_key, level=level))
+    quests = catalog.quests(title_key, level)
     print(quests)
     return render_template(
         'select_quest.html',
@@ -550,112 +752,13 @@ def select_quest(title, level):
 
 @app.route("/quest/run/<int:quest_id>")
 def quest_run(quest_id):
-    quest = safe_get(Quest, quest_id)
-    if not quest:
+    # パース済みの問題ビューモデルをキャッシュから取得（リクエストごとにはシャッフルのみ行う）
+    payload = question_cache.get_quest_payload(quest_id)
+    if not payload:
         return "指定されたクエストが存在しません", 404
 
-    # すべての同タイトルの問題を取得（1問＝1レコード）
-    quest = safe_query_first(Quest.query.filter_by(id=quest_id))  # ✅ 1件のQuestオブジェクトになる
-    if not quest:
-        return "クエストが見つかりません", 404
-
-    all_questions = quest.questions  # Question オブジェクトのリスト
-
-    questions = []
-
-    for q in all_questions:
-        choices = None
-        if q.type == 'choice':
-            # q.choicesが文字列のJSONならパースする
-            try:
-                choices = json.loads(q.choices)
-                random.shuffle(choices)  # 選択肢をシャッフル
-            except Exception:
-                choices = q.choices  # パースできなければそのまま
-        else:
-            try:
-                choices = json.loads(q.choices)
-            except Exception:
-                choices = q.choices
-
-        # q.answerが文字列のJSONならパースする
-        try:
-            answer = json.loads(q.answer)
-        except Exception:
-            answer = q.answer  # パースできなければそのまま
-
-        # すでに構造化されていないので、自前で構築
-        if q.type == 'svg_interactive' or q.type == 'figure_choice':
-            # Try to parse choices as JSON (new format with 'svg' and 'ggb')
-            svg_display = q.choices
-            try:
-                choices_json = json.loads(q.choices)
-                if isinstance(choices_json, dict) and 'svg' in choices_json:
-                    svg_display = choices_json['svg']
-            except (json.JSONDecodeError, TypeError):
-                pass
-
-            try:
-                sub_questions = json.loads(q.answer) if q.answer else []
-                # figure_choice の場合は各小問の選択肢をシャッフル
-                if q.type == 'figure_choice':
-                    for sub_q in sub_questions:
-                        if 'choices' in sub_q and isinstance(sub_q['choices'], list):
-                            random.shuffle(sub_q['choices'])
-            except json.JSONDecodeError:
-                sub_questions = []
-
-            questions.append({
-                "type": q.type,
-                "text": q.text,
-                "choices": q.choices, # Pass raw JSON for size extraction in template
-                "svg_content": svg_display,
-                "sub_questions": sub_questions
-            })
-        elif q.type == 'function_graph':
-            questions.append({
-                "type": q.type,
-                "text": q.text,
-                "answer": answer, # This will be the parsed list of dicts
-                "choices": choices,
-                "answers": None
-            })
-        elif q.type == 'function_graph_choice':
-            # q.choices is now an object containing {'definitions': [...], 'width': ..., 'height': ...}
-            try:
-                choices_parsed = json.loads(q.choices) if q.choices else {}
-                if isinstance(choices_parsed, dict):
-                    graph_data = choices_parsed
-                else:
-                    # Legacy support: if it was just a list, keep it as definitions
-                    graph_data = {'definitions': choices_parsed, 'width': '', 'height': ''}
-            except json.JSONDecodeError:
-                graph_data = {'definitions': [], 'width': '', 'height': ''}
-
-            try:
-                sub_questions = json.loads(q.answer) if q.answer else []
-                # 各小問の選択肢をシャッフル
-                for sub_q in sub_questions:
-                    if 'choices' in sub_q and isinstance(sub_q['choices'], list):
-                        random.shuffle(sub_q['choices'])
-            except json.JSONDecodeError:
-                sub_questions = []
-
-            questions.append({
-                "type": q.type,
-                "text": q.text,
-                "graph_data": graph_data,
-                "sub_questions": sub_questions,
-                "explanation": q.explanation
-            })
-        else:
-            questions.append({
-                "type": q.type,  
-                "text": q.text,
-                "choices": choices,
-                "answer": answer if q.type != "numeric" else None,
-                "answers": answer if q.type == "numeric" else None
-            })
+    quest, cached_questions = payload
+    questions = question_cache.shuffled(cached_questions)
 
     # Get title and level from request args if present (from manage_quests)
     # Otherwise, use the quest's own title/level as fallback
@@ -673,264 +776,62 @@ def quest_run(quest_id):
         "quest_run.html",
         quest_id=quest_id,
         quest=quest,
-        title=SUBJECT_KEY_TO_JP.get(quest.title, quest.title), # For display
-        level=quest.level, # For display
+        title=SUBJECT_KEY_TO_JP.get(quest['title'], quest['title']), # For display
+        level=quest['level'], # For display
         questions=questions,
         role=session.get('role'),
-        original_title=param_title or quest.title, # Pass original title/level for "back" links
-        original_level=param_level or quest.level
+        original_title=param_title or quest['title'], # Pass original title/level for "back" links
+        original_level=param_level or quest['level']
     )
 
 # クエストの結果を処理するエンドポイント
 @app.route('/quest/<int:quest_id>/result', methods=['GET', 'POST'])
 def quest_result(quest_id):
     if request.method == 'POST':
-        quest = safe_get(Quest, quest_id)
-        if not quest:
+        # 採点用の答えのキーはクエストごとにキャッシュされ、問題の保存・インポートで作り直される（utils/grading.py）
+        payload = question_cache.get_grading_payload(quest_id)
+        if not payload:
             return "Quest not found", 404
+        quest, answer_keys, _ = payload
 
-        results = []
-        for i, q in enumerate(quest.questions):
-            question_type = q.type
-            correct = False
-            user_answer = ''
-            expected = ''
-
-            if question_type == 'choice':
-                user_answer = request.form.get(f'q{i}', '').strip()
-                try:
-                    correct_answer = json.loads(q.answer)
-                except (json.JSONDecodeError, TypeError):
-                    correct_answer = q.answer
-                
-                correct = user_answer == correct_answer
-                expected = correct_answer
-
-            elif question_type == 'multiple_choice':
-                user_answers = request.form.getlist(f'q{i}')
-                try:
-                    # DBの答えはカンマ区切りの文字列
-                    correct_answers = [ans.strip() for ans in q.answer.split(',')]
-                except Exception:
-                    correct_answers = []
-                
-                # ソートして比較
-                correct = sorted(user_answers) == sorted(correct_answers)
-                user_answer = ','.join(sorted(user_answers))
-                expected = ','.join(sorted(correct_answers))
-
-            elif question_type == 'sort':
-                user_answer = request.form.get(f'q{i}', '').strip()
-                try:
-                    correct_answer = json.loads(q.answer)
-                except (json.JSONDecodeError, TypeError):
-                    correct_answer = q.answer
-                if isinstance(correct_answer, str):
-                    correct_answer = correct_answer.strip()
-                
-                # 句読点の前のスペースを削除して正規化
-                user_answer_normalized = user_answer.replace(" .", ".").replace(" ,", ",").replace(" ?", "?").replace(" !", "!")
-                correct_answer_normalized = str(correct_answer).replace(" .", ".").replace(" ,", ",").replace(" ?", "?").replace(" !", "!")
-                
-                correct = user_answer_normalized.lower() == correct_answer_normalized.lower()
-                expected = correct_answer
-
-            elif question_type == 'fill_in_the_blank_en':
-                user_answer = request.form.get(f'q{i}', '').strip().lower()
-                try:
-                    # Load answer which might be a JSON string
-                    correct_answers_raw = json.loads(q.answer)
-                except (json.JSONDecodeError, TypeError):
-                    # Or a plain string
-                    correct_answers_raw = q.answer
-
-                # NEW: Check if correct_answers_raw is not None before splitting
-                if correct_answers_raw:
-                    # Split the string by comma to get multiple answers, and trim whitespace from each
-                    correct_answer_list = [ans.strip().lower() for ans in correct_answers_raw.split(',')]
-                else:
-                    correct_answer_list = []
-
-                # Check if the user's answer is in the list of correct answers
-                correct = user_answer in correct_answer_list
-                expected = correct_answers_raw # Show all possible answers in the result
-
-            elif question_type == 'svg_interactive':
-                sub_questions = json.loads(q.answer)
-                all_sub_correct = True
-                user_answers_list = []
-                expected_answers_list = []
-                for sub_q in sub_questions:
-                    sub_q_id = sub_q['id']
-                    form_field_name = f"q{i}_{sub_q_id}"
-                    user_val = request.form.get(form_field_name, '').strip()
-                    expected_val = str(sub_q['answer']).strip()
-                    user_answers_list.append({sub_q['prompt']: user_val})
-                    expected_answers_list.append({sub_q['prompt']: expected_val})
-                    if user_val != expected_val:
-                        all_sub_correct = False
-                correct = all_sub_correct
-                user_answer = user_answers_list
-                expected = expected_answers_list
-
-            elif question_type == 'figure_choice':
-                sub_questions = json.loads(q.answer)
-                all_sub_correct = True
-                user_answers_list = []
-                expected_answers_list = []
-                for sub_q_index, sub_q in enumerate(sub_questions):
-                    form_field_name = f"q{i}_{sub_q_index}"
-                    user_val = request.form.get(form_field_name, '').strip()
-                    expected_val = str(sub_q['answer']).strip()
-                    user_answers_list.append({sub_q['prompt']: user_val})
-                    expected_answers_list.append({sub_q['prompt']: expected_val})
-                    if user_val != expected_val:
-                        all_sub_correct = False
-                correct = all_sub_correct
-                user_answer = user_answers_list
-                expected = expected_answers_list
-
-            elif question_type == 'numeric':
-                answer_list = json.loads(q.answer)
-                user_input = []
-                expected = []
-                correct = True
-                for j, ans in enumerate(answer_list):
-                    field = f"q{i}_{j}"
-                    user_val = request.form.get(field, '').strip()
-                    expected_val = str(ans['answer']).strip()
-                    expected.append({ans['label']: expected_val})
-                    user_input.append({ans['label']: user_val})
-                    if user_val != expected_val:
-                        correct = False
-                user_answer = user_input
-
-            elif question_type == 'function_graph_choice':
-                try:
-                    sub_questions = json.loads(q.answer)
-                except (json.JSONDecodeError, TypeError):
-                    sub_questions = []
-                
-                all_sub_correct = True
-                user_answers_list = []
-                expected_answers_list = []
-                
-                for sub_q_index, sub_q in enumerate(sub_questions):
-                    form_field_name = f"q{i}_{sub_q_index}"
-                    user_val = request.form.get(form_field_name, '').strip()
-                    expected_val = str(sub_q.get('answer', '')).strip()
-                    
-                    user_answers_list.append({sub_q.get('prompt', ''): user_val})
-                    expected_answers_list.append({sub_q.get('prompt', ''): expected_val})
-                    
-                    if user_val != expected_val:
-                        all_sub_correct = False
-                        
-                correct = all_sub_correct
-                user_answer = user_answers_list
-                expected = expected_answers_list
-
-            elif question_type == 'function_graph':
-                try:
-                    # choices stores the sub-questions (prompts and answers) for function_graph
-                    sub_questions = json.loads(q.choices) if q.choices else []
-                except (json.JSONDecodeError, TypeError):
-                    sub_questions = []
-                
-                all_sub_correct = True
-                user_answers_list = []
-                expected_answers_list = []
-                
-                for sub_q_index, sub_q in enumerate(sub_questions):
-                    form_field_name = f"q{i}_{sub_q_index}"
-                    user_val = request.form.get(form_field_name, '').strip()
-                    expected_val = str(sub_q.get('answer', '')).strip()
-                    
-                    user_answers_list.append({sub_q.get('prompt', ''): user_val})
-                    expected_answers_list.append({sub_q.get('prompt', ''): expected_val})
-                    
-                    if user_val != expected_val:
-                        all_sub_correct = False
-                        
-                correct = all_sub_correct
-                user_answer = user_answers_list
-                expected = expected_answers_list
-                expected = expected_answers_list
-
-            results.append({
-                'question_id': q.id,
-                'user_answer': user_answer,
-                'correct': correct,
-                'type': question_type,
-                'expected': expected
-            })
-
+        answers = grading.extract_answers(answer_keys, request.form)
+        results = [grading.check(key, answer) for key, answer in zip(answer_keys, answers)]
         all_correct = all(r['correct'] for r in results)
 
-        user_id = session.get('user_id')
-        if user_id:
-            try:
-                # Update or create QuestHistory first
-                history = safe_query_first(QuestHistory.query.filter_by(user_id=user_id, quest_id=quest_id))
-                if history:
-                    history.attempts += 1
-                    history.correct = all_correct
-                    history.last_attempt = datetime.now(timezone.utc)
-                    if all_correct:
-                        history.cleared_count += 1
-                        history.is_cleared = True
-                    elif history.is_cleared:
-                        history.is_cleared = True #維持
-                else:
-                    history = QuestHistory(
-                        user_id=user_id,
-                        quest_id=quest_id,
-                        correct=all_correct,
-                        is_cleared=all_correct,
-                        cleared_count=1 if all_correct else 0,
-                        attempts=1,
-                        last_attempt=datetime.now(timezone.utc)
-                    )
-                    db.session.add(history)
-
-                # Create a detailed log for this attempt
-                score = sum(1 for r in results if r['correct'])
-                total_questions = len(results)
-                attempt_log = QuestAttemptLog(
-                    user_id=user_id,
-                    quest_id=quest_id,
-                    correct_answers=score,
-                    total_questions=total_questions
-                )
-                db.session.add(attempt_log)
-
-                # Now, sync UserProgress based on the definitive 'is_cleared' status from QuestHistory
-                if history.is_cleared:
-                    progress_record = safe_query_first(UserProgress.query.filter_by(user_id=user_id, quest_id=quest_id))
-                    if progress_record:
-                        if progress_record.status != 'cleared':
-                            progress_record.status = 'cleared'
-                            progress_record.conquered_at = datetime.now(timezone.utc)
-                    else:
-                        new_progress = UserProgress(
-                            user_id=user_id,
-                            quest_id=quest_id,
-                            status='cleared',
-                            conquered_at=datetime.now(timezone.utc)
-                        )
-                        db.session.add(new_progress)
-                
-                safe_commit()
-
-            except IntegrityError as e:
-                db.session.rollback()
-                app.logger.error(f"DATABASE SAVE ERROR: {e}")
-
-        session['last_result'] = {
-            'quest_id': quest_id,
+        # 結果画面用の採点結果はサーバー側に保存し、セッションにはトークンだけを入れる
+        # （問題文・SVG などは保存せず、表示時に問題キャッシュから補う）
+        stored = {
+            'quest': {'title': quest['title'], 'level': quest['level'], 'questname': quest['questname']},
             'results': results,
             'all_correct': all_correct
         }
+        user_id = session.get('user_id')
+        token = None
+        try:
+            if user_id:
+                # 履歴・進捗の UPSERT、挑戦ログと解答、集計、結果画面用の採点結果を1つの短いトランザクションで書き込む
+                score = sum(1 for r in results if r['correct'])
+                submitted = run_write(
+                    submissions.record_submission,
+                    user_id, quest_id, quest['title'], score, len(results), all_correct,
+                    attempt_buckets.get_timezone(app.config['MQUEST_TIMEZONE']),
+                    result=stored,
+                    # 再採点用の解答はトランザクションの外で圧縮し、挑戦ログと一緒に保存する
+                    answers=answer_log.pack(answer_keys, answers)
+                )
+                token = submitted['result_token']
+                user_data_changed(user_id)
+            else:
+                token = run_write(result_store.save, None, quest_id, stored)
+        except (IntegrityError, OperationalError, TimeoutError) as e:
+            # ロックの競合が続いた・書き込みキューが詰まっている場合も、採点結果は表示する
+            db.session.rollback()
+            app.logger.error(f"DATABASE SAVE ERROR: {e}")
+            if user_id:
+                flash("結果の記録に失敗したか、まだ完了していません。進捗画面で確認してください。", "danger")
+        if token is None:
+            return render_quest_result(quest_id, stored)
+        session['last_result'] = {'quest_id': quest_id, 'token': token}
         return redirect(url_for('quest_result', quest_id=quest_id))
 
     # GET request
@@ -938,42 +839,25 @@ def quest_result(quest_id):
     if not role:
         return redirect(url_for('login')) # Redirect to login if role is not in session
 
-    last_result = session.get('last_result')
-    if not last_result or last_result.get('quest_id') != quest_id:
+    last_result = session.get('last_result') or {}
+    stored = None
+    if last_result.get('quest_id') == quest_id:
+        stored = result_store.load(last_result.get('token'), quest_id, session.get('user_id'))
+    if not stored:
         # Redirect to the dashboard corresponding to the user's role
         return redirect(url_for(f'dashboard_{role}'))
+    return render_quest_result(quest_id, stored)
+
+def render_quest_result(quest_id, stored):
+    """結果画面を表示する（stored は result_store に保存する採点結果）。"""
+    quest = stored['quest']
+    # 問題文・SVG・解説は問題キャッシュから補う（削除された問題は空で表示する）
+    payload = question_cache.get_grading_payload(quest_id)
+    question_views = {view['id']: view for view in payload[2]} if payload else {}
+    results = [dict(result, question=question_views.get(result['question_id'], {}))
+               for result in stored['results']]
+    jp_title = SUBJECT_KEY_TO_JP.get(quest['title'], quest['title'])
 
-    quest = safe_get(Quest, quest_id)
-    jp_title = SUBJECT_KEY_TO_JP.get(quest.title, quest.title)
-
-    # Re-fetch full question objects for the template
-    question_ids = [r['question_id'] for r in last_result['results']]
-    questions = safe_query_all(Question.query.filter(Question.id.in_(question_ids)))
-    question_map = {q.id: q for q in questions}
-
-    # Add the full question object back into the results
-    for res in last_result['results']:
-        q = question_map.get(res['question_id'])
-        if q:
-            question_view_model = {
-                'id': q.id,
-                'type': q.type,
-                'text': q.text,
-                'choices': q.choices,
-                'explanation': q.explanation
-            }
-            if q.type == 'svg_interactive' or q.type == 'figure_choice':
-                svg_display = q.choices
-                try:
-                    choices_json = json.loads(q.choices)
-                    if isinstance(choices_json, dict) and 'svg' in choices_json:
-                        svg_display = choices_json['svg']
-                except (json.JSONDecodeError, TypeError):
-                    pass
-                question_view_model['svg_content'] = svg_display
-            # Explanation is now rendered as Markdown on the client side
-            res['question'] = question_view_model
-    
     # Retrieve original title and level from session for filter retention
     filters = session.get('last_manage_quests_filters', {})
     app.logger.debug(f"[quest_result] Retrieved from session: {filters}")
@@ -983,11 +867,11 @@ def quest_result(quest_id):
     return render_template("quest_result.html",
                            quest_id=quest_id,
                            quest=quest,
-                           results=last_result['results'],
-                           all_correct=last_result['all_correct'],
+                           results=results,
+                           all_correct=stored['all_correct'],
                            title=jp_title,
-                           level=quest.level,
-                           role=role,
+                           level=quest['level'],
+                           role=session.get('role'),
                            original_title=original_title, # Pass these to template
                            original_level=original_level)
 
@@ -1028,115 +912,9 @@ def progress():
         flash("生徒が見つかりません。")
         return redirect(url_for('dashboard'))
 
-    # 1. ユーザーがクリアした進捗レコードをすべて取得
-    progress_records = safe_query_all(UserProgress.query.filter_by(user_id=user_id, status='cleared'))
-    
-    # ユーザーの全履歴（メダル計算用）を取得
-    histories = safe_query_all(QuestHistory.query.filter_by(user_id=user_id))
-
-    if not progress_records and not histories:
-        processed_progress_data = []
-    else:
-        # 進捗と履歴に関連する全クエストIDを取得
-        quest_ids = list(set([p.quest_id for p in progress_records] + [h.quest_id for h in histories]))
-        quests = safe_query_all(Quest.query.filter(Quest.id.in_(quest_ids)))
-        quest_map = {q.id: q for q in quests}
-
-        # タイトルとレベルごとに集計
-        from collections import defaultdict
-        aggregated = defaultdict(lambda: {'cleared': 0, 'medals': 0})
-        
-        for p in progress_records:
-            quest = quest_map.get(p.quest_id)
-            if quest:
-                aggregated[(quest.title, quest.level)]['cleared'] += 1
-        
-        for h in histories:
-            quest = quest_map.get(h.quest_id)
-            if quest:
-                aggregated[(quest.title, quest.level)]['medals'] += h.attempts
-        
-        # 各タイトル・レベルの「全問題数」を取得してメダルを判定
-        processed_progress_data = []
-        for (title, level), stats in sorted(aggregated.items()):
-            jp_title = SUBJECT_KEY_TO_JP.get(title, title)
-            
-            # その科目・レベルの総問題数を取得
-            total_q_count = safe_query_first(db.session.query(func.count(Quest.id)).filter_by(title=title, level=level))[0]
-            
-            # メダル判定ロジック (挑戦回数 ÷ 総問題数)
-            ratio = stats['medals'] / total_q_count if total_q_count > 0 else 0
-            
-            medal = None
-            if ratio >= 2.0:
-                medal = {'icon': 'fa-gem', 'color': '#00d2ff', 'label': 'ダイヤモンド', 'text': 'text-info'}
-            elif ratio >= 1.5:
-                medal = {'icon': 'fa-medal', 'color': '#FFD700', 'label': '金', 'text': 'text-warning'}
-            elif ratio >= 1.0:
-                medal = {'icon': 'fa-medal', 'color': '#C0C0C0', 'label': '銀', 'text': 'text-secondary'}
-            elif ratio >= 0.5:
-                medal = {'icon': 'fa-medal', 'color': '#CD7F32', 'label': '銅', 'text': 'text-brown'}
-
-            processed_progress_data.append({
-                'title': jp_title,
-                'level': level,
-                'cleared_count': stats['cleared'],
-                'total_count': total_q_count,
-                'medal_count': stats['medals'],
-                'medal': medal,
-                'ratio': round(ratio, 2)
-            })
-
-    # 2. New query for 4-week chart data
-    four_weeks_ago = datetime.now(timezone.utc) - timedelta(weeks=4)
-    weekly_data_raw = safe_query_all(db.session.query(
-        func.strftime('%Y-%W', QuestAttemptLog.attempted_at).label('week'),
-        func.sum(case((QuestAttemptLog.correct_answers == QuestAttemptLog.total_questions, 1), else_=0)).label('cleared_count'),
-        func.count(QuestAttemptLog.id).label('attempt_count')
-    ).filter(
-        QuestAttemptLog.user_id == user_id,
-        QuestAttemptLog.attempted_at >= four_weeks_ago
-    ).group_by('week').order_by('week'))
-
-    # Fill gaps for weeks
-    weekly_chart_data = {'labels': [], 'cleared_count': [], 'attempt_count': []}
-    weekly_map = {d.week: d for d in weekly_data_raw}
-    for i in range(4, -1, -1):
-        dt = datetime.now(timezone.utc) - timedelta(weeks=i)
-        w_key = dt.strftime('%Y-%W')
-        weekly_chart_data['labels'].append(w_key)
-        if w_key in weekly_map:
-            weekly_chart_data['cleared_count'].append(int(weekly_map[w_key].cleared_count or 0))
-            weekly_chart_data['attempt_count'].append(int(weekly_map[w_key].attempt_count or 0))
-        else:
-            weekly_chart_data['cleared_count'].append(0)
-            weekly_chart_data['attempt_count'].append(0)
-
-    # 3. New query for 3-month chart data
-    three_months_ago = datetime.now(timezone.utc) - timedelta(days=90)
-    monthly_data_raw = safe_query_all(db.session.query(
-        func.strftime('%Y-%m', QuestAttemptLog.attempted_at).label('month'),
-        func.sum(case((QuestAttemptLog.correct_answers == QuestAttemptLog.total_questions, 1), else_=0)).label('cleared_count'),
-        func.count(QuestAttemptLog.id).label('attempt_count')
-    ).filter(
-        QuestAttemptLog.user_id == user_id,
-        QuestAttemptLog.attempted_at >= three_months_ago
-    ).group_by('month').order_by('month'))
-
-    # Fill gaps for months
-    monthly_chart_data = {'labels': [], 'cleared_count': [], 'attempt_count': []}
-    monthly_map = {d.month: d for d in monthly_data_raw}
-    for i in range(2, -1, -1):
-        # Rough month subtraction
-        dt = datetime.now(timezone.utc) - timedelta(days=i*30)
-        m_key = dt.strftime('%Y-%m')
-        monthly_chart_data['labels'].append(m_key)
-        if m_key in monthly_map:
-            monthly_chart_data['cleared_count'].append(int(monthly_map[m_key].cleared_count or 0))
-            monthly_chart_data['attempt_count'].append(int(monthly_map[m_key].attempt_count or 0))
-        else:
-            monthly_chart_data['cleared_count'].append(0)
-            monthly_chart_data['attempt_count'].append(0)
+    tz = attempt_buckets.get_timezone(app.config['MQUEST_TIMEZONE'])
+    today = attempt_buckets.local_date(datetime.now(timezone.utc), tz)
+    processed_progress_data, weekly_chart_data, monthly_chart_data = build_progress_data(user_id, today)
 
     return render_template(
         "progress.html", 
@@ -1146,72 +924,156 @@ def progress():
         monthly_chart_data=monthly_chart_data
     )
 
+@cached('progress', version=user_cache_version)
+def build_progress_data(user_id, today):
+    """
+    学習進捗画面のデータ（科目・レベル別の集計, 週別グラフ, 月別グラフ）。
+    today（設定タイムゾーンでの日付）はキャッシュのキーに含めるための引数。
+    """
+    # 1. 科目・レベルごとの集計（progress_rollups、挑戦時に更新済み）を取得
+    rollup_rows = safe_query_all(ProgressRollup.query.filter_by(user_id=user_id)
+                                 .order_by(ProgressRollup.title, ProgressRollup.level))
+
+    processed_progress_data = []
+    for r in rollup_rows:
+        processed_progress_data.append({
+            'title': SUBJECT_KEY_TO_JP.get(r.title, r.title),
+            'level': r.level,
+            'cleared_count': r.cleared_count,
+            'total_count': r.total_count,
+            'medal_count': r.total_attempts,
+            'medal': MEDAL_STYLES.get(r.medal),
+            'ratio': round(r.ratio, 2)
+        })
+
+    # 2. 週別・月別グラフ（attempt_buckets から期間数ぶんの行だけを読む）
+    tz = attempt_buckets.get_timezone(app.config['MQUEST_TIMEZONE'])
+    weekly_chart_data = attempt_buckets.chart_series(user_id, 'week', 5, tz)
+    monthly_chart_data = attempt_buckets.chart_series(user_id, 'month', 3, tz)
+    return processed_progress_data, weekly_chart_data, monthly_chart_data
+
+STUDENT_PAGE_SIZE = 50
+
+def _student_page_args():
+    """生徒一覧の検索・並び替え・ページ位置をクエリ文字列から取得する。"""
+    search = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'id')
+    if sort not in student_summary.STUDENT_SORT_COLUMNS:
+        sort = 'id'
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+    after = request.args.get('after') or None
+    if after is not None and sort == 'id':
+        try:
+            after = int(after)
+        except ValueError:
+            after = None
+    limit = min(max(request.args.get('per_page', STUDENT_PAGE_SIZE, type=int), 1), 200)
+    return search, sort, order, after, limit
+
+@coalesced('manage_students', version=students_cache_version)
+def _build_student_page(search, sort, order, after, limit):
+    """
+    生徒1ページ分の表示データを作成する。
+    生徒数に関係なく、生徒+保護者・進捗・メダルの3クエリで取得する。
+    同じ条件の同時リクエストは1回だけ実行して結果を共有する（変更しないこと）。
+    """
+    rows, next_cursor = student_summary.query_student_page(search, sort, order, after, limit)
+    user_ids = [r.id for r in rows]
+    progress_map = student_summary.progress_by_user(user_ids)
+    medals_map = student_summary.medals_by_user(user_ids)
+
+    data = []
+    for r in rows:
+        medals = medals_map.get(r.id, [])
+        data.append({
+            'id': r.id,
+            'username': r.username,
+            'nickname': r.nickname,
+            'avatar': r.avatar,
+            # progress_by_user は (科目キー, レベル) 順で返す
+            'progress': [
+                {'title': SUBJECT_KEY_TO_JP.get(p['title'], p['title']), 'level': p['level'], 'count': p['count']}
+                for p in progress_map.get(r.id, [])
+            ],
+            'medals': medals,
+            'medal_total': sum(m['count'] or 0 for m in medals),
+            'parent': {
+                'id': r.parent_id,
+                'username': r.parent_username,
+                'nickname': r.parent_nickname
+            } if r.parent_id else None
+        })
+    return data, next_cursor
+
+def _parent_options():
+    # 全保護者のリストを取得（紐付け用）
+    all_parents = safe_query_all(db.session.query(User.id, User.username, User.nickname).filter_by(role='parent'))
+    return [{'id': p.id, 'username': p.username, 'nickname': p.nickname} for p in all_parents]
+
 @app.route('/admin/students')
 def manage_students():
     # ログインしているユーザーが管理者かチェック（適宜修正）
     if session.get('role') != 'admin' :
         return redirect(url_for('login'))
 
-    users = safe_query_all(User.query.filter_by(role='student'))
+    search, sort, order, after, limit = _student_page_args()
+    data, next_cursor = _build_student_page(search, sort, order, after, limit)
 
-    data = []
-
-    for user in users:
-        user_data = {
-            'id': user.id,
-            'username': user.username,
-            'nickname': user.nickname,
-            'progress': [],
-            'medals': [],
-            'parent': None
-        }
-        
-        # 保護者情報の取得
-        if user.parent:
-            user_data['parent'] = {
-                'id': user.parent.id,
-                'username': user.parent.username,
-                'nickname': user.parent.nickname
-            }
-
-        # 学習進捗状況の取得（UserProgressから）
-        progress_records = safe_query_all(UserProgress.query.filter_by(user_id=user.id, status='cleared'))
-        if not progress_records:
-            user_data['progress'] = []
-        else:
-            quest_ids = list(set(p.quest_id for p in progress_records))
-            quests = safe_query_all(Quest.query.filter(Quest.id.in_(quest_ids)))
-            quest_map = {q.id: q for q in quests}
-
-            from collections import defaultdict
-            aggregated = defaultdict(int)
-            for p in progress_records:
-                quest = quest_map.get(p.quest_id)
-                if quest:
-                    key = (quest.title, quest.level)
-                    aggregated[key] += 1
-            
-            processed_progress = []
-            for (title, level), count in sorted(aggregated.items()):
-                jp_title = SUBJECT_KEY_TO_JP.get(title, title)
-                processed_progress.append({'title': jp_title, 'level': level, 'count': count})
-            user_data['progress'] = processed_progress
-
-        # メダル取得状況の取得（挑戦回数の合計）
-        medal_counts = safe_query_all(db.session.query(
-            QuestHistory.quest_id,
-            QuestHistory.attempts
-        ).filter_by(user_id=user.id))
-
-        user_data['medals'] = [{'quest_id': m[0], 'count': m[1]} for m in medal_counts]
+    return render_template('manage_students.html', students=data, parents=_parent_options(),
+                           search=search, sort=sort, order=order, per_page=limit,
+                           next_cursor=next_cursor, is_first_page=after is None)
 
-        data.append(user_data)
+@app.route('/admin/students.json')
+def manage_students_json():
+    """生徒一覧の続きのページを返す（テーブルの遅延読み込み用）。"""
+    if session.get('role') != 'admin':
+        return {'error': 'forbidden'}, 403
+
+    search, sort, order, after, limit = _student_page_args()
+    data, next_cursor = _build_student_page(search, sort, order, after, limit)
+    parents = _parent_options()
+    students = []
+    for student in data:
+        # 共有された結果は変更せず、コピーにURLと描画済みの行・詳細を追加する。
+        # 行・詳細はサーバーで描画したページと同じテンプレートを使う（showStudentDetail で開く）
+        student = dict(student)
+        student['avatar_url'] = url_for('static', filename='images/avatars/' + (student['avatar'] or 'default.svg'))
+        student['progress_url'] = url_for('progress', user_id=student['id'])
+        student['row_html'] = render_template('_student_row.html', student=student)
+        student['detail_html'] = render_template('_student_detail.html', student=student, parents=parents)
+        students.append(student)
+    return {'students': students, 'next_cursor': next_cursor}
+
+@app.route('/admin/metrics/db_retry')
+@login_required
+def db_retry_metrics():
+    """DBリトライの呼び出し箇所ごとの回数・待ち時間・諦めた回数（JSON）。"""
+    if not current_user.is_admin():
+        abort(403)
+    return {
+        'policy': {
+            'max_attempts': db_retry.max_attempts,
+            'deadline': db_retry.deadline,
+            'request_budget': db_retry.request_budget,
+        },
+        'sites': db_retry.metrics.snapshot()
+    }
 
-    # 全保護者のリストを取得（紐付け用）
-    all_parents = safe_query_all(User.query.filter_by(role='parent'))
-    parent_list = [{'id': p.id, 'username': p.username, 'nickname': p.nickname} for p in all_parents]
+@app.route('/admin/metrics/cache')
+@login_required
+def cache_metrics():
+    """キャッシュのヒット・ミス・追い出しなどの件数（JSON）。"""
+    if not current_user.is_admin():
+        abort(403)
+    return {'mode': app.config['MQUEST_CACHE'], 'tiers': app_cache.cache.stats()}
 
-    return render_template('manage_students.html', students=data, parents=parent_list)
+@app.route('/admin/metrics/single_flight')
+@login_required
+def single_flight_metrics():
+    """処理ごとの呼び出し数・実行数・相乗り（coalesced）数（JSON）。"""
+    if not current_user.is_admin():
+        abort(403)
+    return {'in_flight': flights.in_flight(), 'namespaces': flights.stats()}
 
 @app.route('/admin/user/edit/<int:user_id>', methods=['GET'])
 @login_required
@@ -1241,6 +1103,7 @@ def update_user_admin(user_id):
         user.set_password(password)
     
     safe_commit()
+    app_cache.cache.bump_tag('students')
     flash(f"{user.username} の設定を更新しました。", "success")
     
     if user.role == 'teacher':
@@ -1292,6 +1155,7 @@ def add_student_with_parent():
             student.parent_id = parent.id
         
         safe_commit()
+        app_cache.cache.bump_tag('students')
         flash(f"生徒 {s_username} を登録しました", "success")
     except IntegrityError:
         db.session.rollback()
@@ -1353,6 +1217,10 @@ def delete_user(user_id):
             UserProgress.query.filter_by(user_id=user_id).delete()
             QuestHistory.query.filter_by(user_id=user_id).delete()
             QuestAttemptLog.query.filter_by(user_id=user_id).delete()
+            AttemptAnswer.query.filter_by(user_id=user_id).delete()
+            ProgressRollup.query.filter_by(user_id=user_id).delete()
+            AttemptBucket.query.filter_by(user_id=user_id).delete()
+            QuestResult.query.filter_by(user_id=user_id).delete()
         
         # 保護者の場合、子供たちのparent_idをNULLにする
         elif role == 'parent':
@@ -1362,6 +1230,8 @@ def delete_user(user_id):
 
         db.session.delete(user)
         safe_commit()
+        user_data_changed(user_id)
+        app_cache.cache.bump_tag('students')
         flash(f"ユーザー {username} ({role}) を削除しました", "success")
     except Exception as e:
         db.session.rollback()
@@ -1407,40 +1277,34 @@ def manage_quests():
 
     selected_title_jp = request.args.get('title', '')
     selected_level = request.args.get('level', '')
+    data = manage_quests_data(selected_title_jp, selected_level)
 
-    # 全てのユニークなタイトルを取得
-    all_titles_raw = safe_query_all(db.session.query(Quest.title).distinct())
-    jp_titles = sorted(list(set([SUBJECT_KEY_TO_JP.get(t[0], t[0]) for t in all_titles_raw])))
+    return render_template('list_quests.html', 
+                           quests=data['quests'], 
+                           titles=data['titles'], 
+                           selected_title=selected_title_jp,
+                           levels=data['levels'],
+                           all_levels_list=data['levels'],
+                           title_to_levels=data['title_to_levels'],
+                           selected_level=selected_level)
+
+@cached('manage_quests', version=content_cache_version)
+def manage_quests_data(selected_title_jp, selected_level):
+    """クエスト管理画面の絞り込み用の科目・レベルと、表示するクエストの一覧。"""
+    # 全てのユニークなタイトルを取得（カタログ索引から）
+    jp_titles = sorted(list(set([SUBJECT_KEY_TO_JP.get(t, t) for t in catalog.titles()])))
 
     # 全てのユニークなレベルを取得
-    all_levels_raw = safe_query_all(db.session.query(Quest.level).distinct())
-    all_levels = sorted(list(set([l[0] for l in all_levels_raw])))
+    all_levels = catalog.levels()
 
     # 科目ごとのレベルマッピングを作成
     title_to_levels = {}
-    for jp_title in jp_titles:
-        title_key = SUBJECT_JP_TO_KEY.get(jp_title, jp_title)
-        levels_raw = safe_query_all(db.session.query(Quest.level).filter_by(title=title_key).distinct())
-        title_to_levels[jp_title] = sorted(list(set([l[0] for l in levels_raw])))
-
-    quest_query = Quest.query
-    if selected_title_jp:
-        title_key = SUBJECT_JP_TO_KEY.get(selected_title_jp, selected_title_jp)
-        quest_query = quest_query.filter_by(title=title_key)
-    
-    if selected_level:
-        quest_query = quest_query.filter_by(level=selected_level)
-    
-    quests = safe_query_all(quest_query)
+    for title_key, levels in catalog.title_to_levels().items():
+        title_to_levels[SUBJECT_KEY_TO_JP.get(title_key, title_key)] = levels
 
-    return render_template('list_quests.html', 
-                           quests=quests, 
-                           titles=jp_titles, 
-                           selected_title=selected_title_jp,
-                           levels=all_levels,
-                           all_levels_list=all_levels,
-                           title_to_levels=title_to_levels,
-                           selected_level=selected_level)
+    title_key = SUBJECT_JP_TO_KEY.get(selected_title_jp, selected_title_jp) if selected_title_jp else None
+    quests = catalog.quests(title_key, selected_level or None)
+    return {'titles': jp_titles, 'levels': all_levels, 'title_to_levels': title_to_levels, 'quests': quests}
 
 #　クエストの編集・問題の追加
 @app.route('/admin/quests/action', methods=['POST'])
@@ -1463,101 +1327,124 @@ def handle_quest_action():
     if action == 'edit':
         return redirect(url_for('edit_quest', quest_id=quest_ids[0], title=title, level=level))
     elif action == 'export_json':
-        export_filename = request.form.get('export_filename', 'questions_export.json').strip()
-        if not export_filename.endswith('.json'):
-            export_filename += '.json'
-
-        selected_quests = Quest.query.filter(Quest.id.in_(quest_ids)).order_by(Quest.id).all()
-        
-        export_data = []
-        for quest in selected_quests:
-            # 1. Output Quest metadata record
-            export_data.append({
-                'record_type': 'quest',
-                'id': quest.id,
-                'title': quest.title,
-                'level': quest.level,
-                'questname': quest.questname
-            })
-            
-            # 2. Output Question records for this quest
-            questions = Question.query.filter_by(quest_id=quest.id).order_by(Question.id).all()
-            for q in questions:
-                q_data = {
-                    'record_type': 'question',
-                    'id': q.id,
-                    'quest_id': q.quest_id,
-                    'type': q.type,
-                    'text': q.text,
-                    'explanation': q.explanation
-                }
-                
-                try:
-                    q_data['choices'] = json.loads(q.choices) if q.choices else None
-                except (json.JSONDecodeError, TypeError):
-                    q_data['choices'] = q.choices
-
-                try:
-                    q_data['answer'] = json.loads(q.answer) if q.answer else None
-                except (json.JSONDecodeError, TypeError):
-                    q_data['answer'] = q.answer
-                
-                export_data.append(q_data)
-        
-        json_content = json.dumps(export_data, indent=4, ensure_ascii=False)
-        
-        response = Response(
-            json_content,
-            mimetype="application/json",
-            headers={"Content-disposition": f"attachment; filename={export_filename}"}
+        export_format = request.form.get('export_format', 'json')
+        if export_format not in exporter.FORMATS:
+            abort(400)
+        export_filename = exporter.filename(
+            request.form.get('export_filename', 'questions_export.json').strip(), export_format
         )
-        return response
+
+        try:
+            quest_ids = [int(qid) for qid in quest_ids]
+        except ValueError:
+            abort(400)
+        # ファイルへの書き出しはジョブで行い、完了後にジョブの画面からダウンロードする
+        job = submit_job('export', _run_export_job, quest_ids, export_format, export_filename)
+        if job is None:
+            return redirect(url_for('manage_quests', title=title, level=level))
+        return redirect(url_for('job_page', job_id=job.id))
     elif action == 'bulk_edit':
         return redirect(url_for('bulk_edit_ids', quest_ids=','.join(quest_ids), title=title, level=level))
     elif action == 'challenge':
         # Preserve title and level filters when challenging a quest from manage_quests
         return redirect(url_for('quest_run', quest_id=quest_ids[0], title=title, level=level))
     elif action == 'delete':
-        deleted_count = 0
-        for qid in quest_ids:
-            quest_id_to_delete = int(qid)
-            quest = safe_get(Quest, quest_id_to_delete)
-            if quest:
-                # Manually delete dependent records to prevent IntegrityError
-                UserProgress.query.filter_by(quest_id=quest_id_to_delete).delete()
-                QuestHistory.query.filter_by(quest_id=quest_id_to_delete).delete()
-                Question.query.filter_by(quest_id=quest_id_to_delete).delete()
-                QuestAttemptLog.query.filter_by(quest_id=quest_id_to_delete).delete()
-
-                db.session.delete(quest)
-                deleted_count += 1
-        
-        if deleted_count > 0:
-            safe_commit()
-            flash(f"{deleted_count}件のクエストを削除しました", "success")
-        return redirect(url_for('manage_quests', title=title, level=level))
+        # 履歴・挑戦ログの多いクエストでは時間がかかるため、ジョブで削除する
+        job = submit_job('delete_quests', _run_delete_quests_job, quest_ids)
+        if job is None:
+            return redirect(url_for('manage_quests', title=title, level=level))
+        return redirect(url_for('job_page', job_id=job.id))
     
     # Fallback just in case
     return redirect(url_for('manage_quests', title=title, level=level))
 
-def _update_quest_id_internal(old_id, new_id):
-    """Internal helper to update quest ID across all related tables."""
-    user_tables = ["quest_attempt_logs", "quest_history", "user_progress"]
-    content_tables = ["questions", "quests"]
+def _run_export_job(job, quest_ids, export_format, export_filename):
+    """エクスポートのジョブ本体。EXPORT_DIR にファイルを書き出し、ジョブの画面からダウンロードさせる。"""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    _cleanup_exports()
+    path = os.path.join(EXPORT_DIR, job.id + exporter.FORMATS[export_format][0])
+    total = len(quest_ids)
+    exported = 0
+
+    def quests():
+        # 1本のクエリを読みながら、クエストごとに進捗の報告とキャンセルの確認をする
+        nonlocal exported
+        for quest in exporter.iter_quests(db.engines['content'], quest_ids):
+            job.check_cancelled()
+            yield quest
+            exported += 1
+            job.report(done=exported, total=total, message=f"{exported} / {total} 件のクエストを書き出しました")
 
-    # ユーザーDB側の更新
-    for table in user_tables:
-        column = "quest_id"
-        db.session.execute(db.text(f"UPDATE {table} SET {column} = :new_id WHERE {column} = :old_id"),
-                           {'new_id': new_id, 'old_id': old_id})
-    
-    # コンテンツDB側の更新
+    try:
+        with open(path, 'wb') as f:
+            for chunk in exporter.encode(exporter.records(quests()), export_format,
+                                         member_name=exporter.filename(export_filename, 'json')):
+                f.write(chunk)
+    except BaseException:
+        # キャンセル・失敗した場合は書きかけのファイルを残さない
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return {
+        'message': f"{exported}件のクエストをエクスポートしました",
+        'file': os.path.basename(path),
+        'filename': export_filename,
+        'mimetype': exporter.FORMATS[export_format][1],
+    }
+
+def _cleanup_exports():
+    # ジョブの記録と同じ期間を過ぎたエクスポートファイルを削除する
+    expires = time.time() - jobs.RECORD_TTL.total_seconds()
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.is_file() and entry.stat().st_mtime < expires:
+            os.remove(entry.path)
+
+def _run_delete_quests_job(job, quest_ids):
+    """クエストの一括削除のジョブ本体。"""
+    job.report(message=f"{len(quest_ids)}件のクエストを削除しています")
+    affected_users = rollups.users_with_history(int(qid) for qid in quest_ids)
+    # クエスト・問題と、そのクエストの履歴・進捗・挑戦ログを両DBにまとめて削除する
+    deleted_ids, affected_groups = run_cross_db(cross_db.delete_quests, quest_ids)
+    deleted_count = len(deleted_ids)
+
+    if deleted_count > 0:
+        db.session.expire_all()
+        invalidate_content(deleted_ids)
+        if affected_users:
+            # 削除した挑戦ログをグラフ用の期間別集計からも除く
+            job.report(message="学習グラフの集計を更新しています")
+            attempt_buckets.rebuild(attempt_buckets.get_timezone(app.config['MQUEST_TIMEZONE']), affected_users)
+        refresh_progress_rollups(affected_groups, affected_users)
+    return {'message': f"{deleted_count}件のクエストを削除しました", 'deleted': deleted_count}
+
+def _next_quest_code():
+    return (db.session.query(func.max(Quest.code)).scalar() or 0) + 1
+
+def _new_quest(code=None, **fields):
+    """
+    新しいクエストを作成する（セッションには追加しない）。code を省略すると最大値+1。
+    code が内部IDとしても未使用であれば、内部IDにも同じ値を使う。
+    """
+    if code is None:
+        code = _next_quest_code()
+    quest = Quest(code=code, **fields)
+    if safe_get(Quest, code) is None:
+        quest.id = code
+    return quest
+
+def _update_quest_codes(codes):
+    """
+    表示用のクエストID（code）を {内部ID: 新しいcode} のとおりに変更する。
+    内部IDは変わらないため、ユーザーDBの履歴・進捗は書き換えない。
+    入れ替え（101↔102）でも一意制約に触れないよう、いったん負の値を経由する。
+    """
     content_engine = db.get_engine(app, bind='content')
-    for table in content_tables:
-        column = "id" if table == "quests" else "quest_id"
-        db.session.execute(db.text(f"UPDATE {table} SET {column} = :new_id WHERE {column} = :old_id"),
-                           {'new_id': new_id, 'old_id': old_id},
-                           bind_arguments={'bind': content_engine})
+    db.session.execute(db.text("UPDATE quests SET code = :code WHERE id = :id"),
+                       [{'id': quest_id, 'code': -code} for quest_id, code in codes.items()],
+                       bind_arguments={'bind': content_engine})
+    db.session.execute(db.text("UPDATE quests SET code = -code WHERE code < 0"),
+                       bind_arguments={'bind': content_engine})
+    mark_content_changed(codes)
 
 @app.route('/admin/quest/bulk_edit_ids', methods=['GET'])
 @login_required
@@ -1573,7 +1460,7 @@ def bulk_edit_ids():
         return redirect(url_for('manage_quests', title=title, level=level))
     
     quest_ids = [int(qid) for qid in quest_ids_str.split(',') if qid]
-    quests = safe_query_all(Quest.query.filter(Quest.id.in_(quest_ids)).order_by(Quest.id))
+    quests = safe_query_all(Quest.query.filter(Quest.id.in_(quest_ids)).order_by(Quest.code, Quest.id))
     
     return render_template('bulk_edit_ids.html', quests=quests, title=title, level=level)
 
@@ -1586,17 +1473,20 @@ def save_bulk_ids():
     title = request.form.get('title', '')
     level = request.form.get('level', '')
     
+    # old_id は内部ID、new_id は新しい表示用のクエストID（code）
     old_ids = request.form.getlist('old_id')
     new_ids_str = request.form.getlist('new_id')
     
     updates = []
     try:
-        for old_id_str, new_id_str in zip(old_ids, new_ids_str):
-            if not new_id_str: continue
-            old_id = int(old_id_str)
-            new_id = int(new_id_str)
-            if old_id != new_id:
-                updates.append((old_id, new_id))
+        requested = [(int(old_id_str), int(new_id_str))
+                     for old_id_str, new_id_str in zip(old_ids, new_ids_str) if new_id_str]
+        current_codes = dict(safe_query_all(db.session.query(Quest.id, Quest.code).filter(
+            Quest.id.in_([quest_id for quest_id, _ in requested])
+        )))
+        for quest_id, new_code in requested:
+            if quest_id in current_codes and current_codes[quest_id] != new_code:
+                updates.append((quest_id, new_code))
     except ValueError:
         flash("IDは数値で入力してください。", "danger")
         return redirect(request.referrer)
@@ -1613,33 +1503,34 @@ def save_bulk_ids():
     
     selected_old_ids = set(u[0] for u in updates)
     
-    for _, new_id in updates:
-        if new_id not in selected_old_ids:
-            if safe_get(Quest, new_id):
-                flash(f"エラー: ID {new_id} は既に他のクエストで使用されています。", "danger")
-                return redirect(request.referrer)
+    if any(new_id <= 0 for new_id in new_id_set):
+        flash("IDは1以上の数値で入力してください。", "danger")
+        return redirect(request.referrer)
 
+    taken = safe_query_first(db.session.query(Quest.code).filter(
+        Quest.code.in_(new_id_set), Quest.id.notin_(selected_old_ids)
+    ).order_by(Quest.code))
+    if taken:
+        flash(f"エラー: ID {taken.code} は既に他のクエストで使用されています。", "danger")
+        return redirect(request.referrer)
+
+    # 入力の検証はここまでで済ませ、書き換えはジョブで行う
+    job = submit_job('bulk_ids', _run_bulk_ids_job, dict(updates))
+    if job is None:
+        return redirect(url_for('manage_quests', title=title, level=level))
+    return redirect(url_for('job_page', job_id=job.id))
+
+def _run_bulk_ids_job(job, codes):
+    """クエストIDの一括変更のジョブ本体。"""
     try:
-        # Temporary offset strategy to avoid unique constraint violations during swap
-        offset = 1000000
-        
-        # 1. Move to temporary range
-        for old_id, new_id in updates:
-            _update_quest_id_internal(old_id, old_id + offset)
-        
-        # 2. Move to final target IDs from temporary range
-        for old_id, new_id in updates:
-            _update_quest_id_internal(old_id + offset, new_id)
-            
+        # 入れ替え（101↔102）を含めて、表示用のIDだけを変更する
+        _update_quest_codes(codes)
         safe_commit()
-        db.session.expire_all()
-        flash(f"{len(updates)}件のクエストIDを更新しました。", "success")
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Bulk ID update error: {e}")
-        flash(f"エラーが発生しました: {str(e)}", "danger")
-        
-    return redirect(url_for('manage_quests', title=title, level=level))
+        raise
+    return {'message': f"{len(codes)}件のクエストIDを更新しました。"}
 
 @app.route('/admin/quest/edit/<quest_id>', methods=['GET'])
 @login_required
@@ -1651,16 +1542,15 @@ def edit_quest(quest_id):
     if quest_id == 'new':
         quest = Quest(title=title, level=level, questname='') # Create a new quest object
     else:
-        quest = safe_get(Quest, int(quest_id))
+        quest = safe_get(Quest, int(quest_id), options=[selectinload(Quest.questions)])
         if not quest:
             abort(404)
     # Fetch all unique titles and levels for dropdowns
-    all_titles_raw = db.session.query(Quest.title).distinct().all()
     all_titles_for_select = sorted([
-        (SUBJECT_KEY_TO_JP.get(t[0], t[0]), t[0]) for t in all_titles_raw
+        (SUBJECT_KEY_TO_JP.get(t, t), t) for t in catalog.titles()
     ], key=lambda x: x[0])
 
-    all_levels = sorted(list(set([l[0] for l in db.session.query(Quest.level).distinct().all()])))
+    all_levels = catalog.levels()
 
     quest_display_title = SUBJECT_KEY_TO_JP.get(quest.title, quest.title) if quest and quest.title else ''
 
@@ -1682,60 +1572,47 @@ def save_quest(quest_id):
         flash("エラー: レベルは 'Lvn' (nは数字) の形式で入力してください (例: Lv1)。", "danger")
         return redirect(url_for('edit_quest', quest_id=quest_id, title=title, level=level))
 
-    # Helper for robust query
-    def get_quest_with_retry(qid):
-        for _ in range(3):
-            try:
-                return db.session.get(Quest, qid)
-            except OperationalError as e:
-                if "disk I/O error" in str(e):
-                    time.sleep(0.5)
-                    continue
-                raise
-        return db.session.get(Quest, qid)
-
     try:
         if quest_id == 'new':
             if new_id_str:
                 try:
-                    new_id = int(new_id_str)
+                    new_code = int(new_id_str)
                     # Check if exists with retry logic
-                    if get_quest_with_retry(new_id):
-                        flash(f"エラー: ID {new_id} は既に使用されています。", "danger")
+                    if safe_query_first(Quest.query.filter_by(code=new_code)):
+                        flash(f"エラー: ID {new_code} は既に使用されています。", "danger")
                         return redirect(url_for('edit_quest', quest_id='new', title=title, level=level))
-                    new_quest = Quest(id=new_id, title=title, level=level, questname=questname)
+                    new_quest = _new_quest(new_code, title=title, level=level, questname=questname)
                 except ValueError:
                     flash("エラー: IDは数値で入力してください。", "danger")
                     return redirect(url_for('edit_quest', quest_id='new', title=title, level=level))
             else:
-                new_quest = Quest(title=title, level=level, questname=questname)
+                new_quest = _new_quest(title=title, level=level, questname=questname)
             
             db.session.add(new_quest)
+            db.session.flush()
+            mark_content_changed([new_quest.id])
             safe_commit()
+            refresh_progress_rollups([(title, level)])
             flash("新しいクエストを保存しました", "success")
             return redirect(url_for('edit_quest', quest_id=new_quest.id, title=title, level=level))
         else:
             old_id = int(quest_id)
-            quest = get_quest_with_retry(old_id)
+            quest = safe_get(Quest, old_id)
             if not quest:
                 flash("エラー: 更新対象のクエストが見つかりません。", "danger")
                 return redirect(url_for('manage_quests'))
             
-            # IDが変更された場合
-            if new_id_str and int(new_id_str) != old_id:
+            # 表示用のIDが変更された場合（内部IDと履歴・進捗はそのまま）
+            if new_id_str and int(new_id_str) != quest.code:
                 try:
-                    new_id = int(new_id_str)
-                    if get_quest_with_retry(new_id):
-                        flash(f"エラー: ID {new_id} は既に使用されています。", "danger")
+                    new_code = int(new_id_str)
+                    if safe_query_first(Quest.query.filter_by(code=new_code)):
+                        flash(f"エラー: ID {new_code} は既に使用されています。", "danger")
                         return redirect(url_for('edit_quest', quest_id=old_id, title=title, level=level))
                     
-                    # 共通のID更新ヘルパーを使用
-                    _update_quest_id_internal(old_id, new_id)
-                    
-                    safe_commit()
-                    db.session.expire_all()
-                    quest = get_quest_with_retry(new_id)
-                    quest_id = str(new_id)
+                    if new_code <= 0:
+                        raise ValueError(new_code)
+                    quest.code = new_code
                 except ValueError:
                     flash("エラー: IDは数値で入力してください。", "danger")
                     return redirect(url_for('edit_quest', quest_id=old_id, title=title, level=level))
@@ -1744,15 +1621,22 @@ def save_quest(quest_id):
                     flash(f"エラー: IDの更新に失敗しました。{str(e)}", "danger")
                     return redirect(url_for('edit_quest', quest_id=old_id, title=title, level=level))
 
+            old_group = (quest.title, quest.level)
             quest.title = title
             quest.level = level
             quest.questname = questname
+            mark_content_changed([quest.id])
+            group_changed = old_group != (title, level)
+            affected_users = rollups.users_with_history([quest.id]) if group_changed else set()
             safe_commit()
+            if group_changed:
+                # 科目・レベルが変わったため、関係する生徒の進捗集計を作り直す
+                refresh_progress_rollups([old_group, (title, level)], affected_users)
             flash("クエスト情報を保存しました", "success")
             return redirect(url_for('edit_quest', quest_id=quest_id, title=title, level=level))
 
     except OperationalError as e:
-        if "disk I/O error" in str(e):
+        if is_retryable(e):
             app.logger.error(f"Critical Database Error during save_quest: {e}")
             flash('データベースの読み込み/書き込みエラーが発生しました。時間を置いてから再度「保存」を押してください。', 'error')
             return redirect(url_for('edit_quest', quest_id=quest_id, title=title, level=level))
@@ -1776,30 +1660,19 @@ def renumber_questions(quest_id):
 
     try:
         content_engine = db.get_engine(app, bind='content')
-        # Step 1: Move all questions for this quest to a temporary ID range to avoid collisions
-        # Temporary offset (e.g., 1,000,000)
-        temp_offset = 1000000
-        for qid in ordered_ids:
-            db.session.execute(db.text("UPDATE questions SET id = id + :offset WHERE id = :old_id"),
-                               {'offset': temp_offset, 'old_id': int(qid)},
-                               bind_arguments={'bind': content_engine})
-
-        # Step 2: Move back to the final ID based on the new order
-        base_id = quest_id * 100
-        for i, old_id in enumerate(ordered_ids):
-            new_id = base_id + (i + 1)
-            temp_id = int(old_id) + temp_offset
-            db.session.execute(db.text("UPDATE questions SET id = :new_id WHERE id = :temp_id"),
-                               {'new_id': new_id, 'temp_id': temp_id},
-                               bind_arguments={'bind': content_engine})
+        # 問題IDは変えず、表示順どおりに position を 1, 2, 3... と更新する
+        db.session.execute(db.text("UPDATE questions SET position = :position WHERE id = :id AND quest_id = :quest_id"),
+                           [{'position': i + 1, 'id': int(qid), 'quest_id': quest_id} for i, qid in enumerate(ordered_ids)],
+                           bind_arguments={'bind': content_engine})
 
+        mark_content_changed([quest_id])
         safe_commit()
         db.session.expire_all()
-        flash(f"並び替えを保存し、問題IDを振り直しました（{base_id + 1}〜）。", "success")
+        flash("問題の順序を保存しました。", "success")
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Renumber questions error: {e}")
-        flash(f"エラー: IDの振り直しに失敗しました。{str(e)}", "danger")
+        flash(f"エラー: 順序の保存に失敗しました。{str(e)}", "danger")
 
     return redirect(url_for('edit_quest', quest_id=quest_id, title=title, level=level))
 @app.route('/admin/question/edit/<int:quest_id>', methods=['POST'])
@@ -1836,6 +1709,7 @@ def delete_question(quest_id, question_id):
     if not question:
         abort(404)
     db.session.delete(question)
+    mark_content_changed([question.quest_id, quest_id])
     safe_commit()
     flash("問題を削除しました", "success")
     return redirect(url_for('edit_quest', quest_id=quest_id, title=title, level=level))
@@ -1938,15 +1812,10 @@ def save_question(quest_id):
         q_type = request.form['type']
         text = request.form['text']
         if question_id == 'new':
-            # クエストIDに基づいた自動採番 (QuestID * 100 + 連番)
-            base_id = quest_id * 100
-            existing_ids = [q.id for q in Question.query.filter(Question.id > base_id, Question.id < base_id + 100).all()]
-            if existing_ids:
-                new_q_id = max(existing_ids) + 1
-            else:
-                new_q_id = base_id + 1
-            
-            question = Question(id=new_q_id, quest_id=quest_id, type=q_type, text=text)
+            new_q_id = id_allocator.allocate_one('questions')
+            # 出題順はクエストの最後
+            last_position = db.session.query(func.max(Question.position)).filter(Question.quest_id == quest_id).scalar()
+            question = Question(id=new_q_id, quest_id=quest_id, type=q_type, text=text, position=(last_position or 0) + 1)
         else:
             question = Question.query.get_or_404(int(question_id))
             question.type = q_type
@@ -2107,11 +1976,12 @@ def save_question(quest_id):
         if question_id == 'new':
             db.session.add(question)
         
+        mark_content_changed([quest_id, question.quest_id])
         safe_commit()
         flash('問題を保存しました', 'success')
 
     except OperationalError as e:
-        if "disk I/O error" in str(e):
+        if is_retryable(e):
             app.logger.error(f"Critical Database Error: {e}")
             flash('データベースの書き込みエラーが発生しました。しばらく時間を置いてから再度お試しください。', 'error')
         else:
@@ -2264,8 +2134,7 @@ def preview_question():
 def select_title_admin():
     if not (current_user.is_admin() or current_user.is_teacher()):
         return redirect(url_for(f"dashboard_{current_user.role}"))
-    titles = db.session.query(Quest.title).distinct().all()
-    jp_titles = [SUBJECT_KEY_TO_JP.get(t[0], t[0]) for t in titles]
+    jp_titles = [SUBJECT_KEY_TO_JP.get(t, t) for t in catalog.titles()]
     return render_template('select_title_admin.html', titles=jp_titles)
 
 
@@ -2274,14 +2143,14 @@ def select_title_admin():
 @login_required
 def select_level_admin(title):
     title_key = SUBJECT_JP_TO_KEY.get(title, title)
-    levels = db.session.query(Quest.level).filter_by(title=title_key).distinct().all()
-    return render_template('select_level_admin.html', title=title, levels=[l[0] for l in levels])
+    levels = catalog.levels(title_key)
+    return render_template('select_level_admin.html', title=title, levels=levels)
 
 @app.route('/select_quest_admin/<title>/<level>')
 @login_required
 def select_quest_by_title_level_admin(title, level):
     title_key = SUBJECT_JP_TO_KEY.get(title, title)
-    quests = safe_query_all(Quest.query.filter_by(title=title_key, level=level))
+    quests = catalog.quests(title_key, level)
     print(quests)
     return render_template(
         'select_quest_admin.html',
@@ -2293,113 +2162,34 @@ def select_quest_by_title_level_admin(title, level):
 @app.route('/group_learning/<int:quest_id>')
 @login_required
 def quest_run_group(quest_id):
-    quest = db.session.get(Quest, quest_id)
-    if not quest:
+    payload = question_cache.get_quest_payload(quest_id)
+    if not payload:
         return "指定されたクエストが存在しません", 404
 
-    # すべての同タイトルの問題を取得（1問＝1レコード）
-    quest = Quest.query.filter_by(id=quest_id).first()  # ✅ 1件のQuestオブジェクトになる
-    if not quest:
-        return "クエストが見つかりません", 404
-
-    all_questions = quest.questions  # Question オブジェクトのリスト
-
-    questions = []
-
-    for q in all_questions:
-        choices = None
-        if q.type == 'choice':
-            # q.choicesが文字列のJSONならパースする
-            try:
-                choices = json.loads(q.choices)
-                random.shuffle(choices)  # 選択肢をシャッフル
-            except Exception:
-                choices = q.choices  # パースできなければそのまま
-        else:
-            try:
-                choices = json.loads(q.choices)
-            except Exception:
-                choices = q.choices
-
-        # q.answerが文字列のJSONならパースする
-        try:
-            answer = json.loads(q.answer)
-        except Exception:
-            answer = q.answer  # パースできなければそのまま
-
-        # すでに構造化されていないので、自前で構築
-        if q.type == 'svg_interactive' or q.type == 'figure_choice':
-            # Try to parse choices as JSON (new format with 'svg' and 'ggb')
-            svg_display = q.choices
-            try:
-                choices_json = json.loads(q.choices)
-                if isinstance(choices_json, dict) and 'svg' in choices_json:
-                    svg_display = choices_json['svg']
-            except (json.JSONDecodeError, TypeError):
-                pass
-
-            try:
-                sub_questions = json.loads(q.answer) if q.answer else []
-                # figure_choice の場合は各小問の選択肢をシャッフル
-                if q.type == 'figure_choice':
-                    for sub_q in sub_questions:
-                        if 'choices' in sub_q and isinstance(sub_q['choices'], list):
-                            random.shuffle(sub_q['choices'])
-            except json.JSONDecodeError:
-                sub_questions = []
-
-            questions.append({
-                "type": q.type,
-                "text": q.text,
-                "choices": q.choices, # Pass raw JSON for size extraction in template
-                "svg_content": svg_display,
-                "sub_questions": sub_questions,
-                "explanation": q.explanation
-            })
-        elif q.type == 'function_graph':
-            questions.append({
-                "type": q.type,
-                "text": q.text,
-                "answer": answer, # This will be the parsed list of dicts
-                "choices": choices,
-                "answers": None,
-                "explanation": q.explanation
-            })
-        elif q.type == 'function_graph_choice':
-            # q.choices is graph_data, q.answer is sub_questions
-            try:
-                graph_data = json.loads(q.choices) if q.choices else []
-            except json.JSONDecodeError:
-                graph_data = []
+    quest, cached_questions = payload
+    questions = question_cache.shuffled(cached_questions)
 
-            try:
-                sub_questions = json.loads(q.answer) if q.answer else []
-                # 各小問の選択肢をシャッフル
-                for sub_q in sub_questions:
-                    if 'choices' in sub_q and isinstance(sub_q['choices'], list):
-                        random.shuffle(sub_q['choices'])
-            except json.JSONDecodeError:
-                sub_questions = []
-
-            questions.append({
-                "type": q.type,
-                "text": q.text,
-                "graph_data": graph_data,
-                "sub_questions": sub_questions,
-                "explanation": q.explanation
-            })
-        else:
-            questions.append({
-                "type": q.type,  
-                "text": q.text,
-                "choices": choices,
-                "answer": answer if q.type != "numeric" else None,
-                "answers": answer if q.type == "numeric" else None,
-                "explanation": q.explanation
-            })
+    jp_title = SUBJECT_KEY_TO_JP.get(quest['title'], quest['title'])
+    return render_template("group_learning.html", quest_id=quest_id, quest=quest, title=jp_title, level=quest['level'], questions=questions)
 
-    jp_title = SUBJECT_KEY_TO_JP.get(quest.title, quest.title)
-    return render_template("group_learning.html", quest_id=quest_id, quest=quest, title=jp_title, level=quest.level, questions=questions)
+@app.route('/group_learning/<int:quest_id>/grade', methods=['POST'])
+@login_required
+def grade_group_submissions(quest_id):
+    """
+    集合学習の解答をまとめて採点する（JSON。履歴には記録しない）。
+    リクエストは {"submissions": [{"q0": "...", "q1_0": "...", ...}, ...]} で、
+    各解答は結果画面への送信と同じ項目名を使う。
+    """
+    if not (current_user.is_admin() or current_user.is_teacher()):
+        abort(403)
+    payload = question_cache.get_grading_payload(quest_id)
+    if not payload:
+        abort(404)
+    submissions_data = (request.get_json(silent=True) or {}).get('submissions')
+    if not isinstance(submissions_data, list) or not all(isinstance(form, dict) for form in submissions_data):
+        return {'error': 'submissions must be a list of objects'}, 400
+    _, answer_keys, _ = payload
+    return {'quest_id': quest_id, 'submissions': grading.grade_many(answer_keys, submissions_data)}
 
 @app.route("/parent/students")
 @login_required
@@ -2407,19 +2197,7 @@ def parent_students():
     if not current_user.is_parent():
         return redirect(url_for("dashboard"))
 
-    parent_id = current_user.id
-    children = User.query.filter_by(parent_id=parent_id, role="student").all()
-
-    student_data = []
-    for child in children:
-        histories = QuestHistory.query.filter_by(user_id=child.id).all()
-        total_medals = sum(h.attempts for h in histories)
-        student_data.append({
-            "student": child,
-            "histories": histories,
-            "medal_count": total_medals
-        })
-
+    student_data = build_parent_summary(current_user.id)
     return render_template("parent_students.html", student_data=student_data)
 
 @app.route('/admin/questions/import', methods=['GET'])
@@ -2429,7 +2207,8 @@ def import_questions_gui():
         return redirect(url_for('login'))
     # 過去のフラッシュメッセージをすべて消費（破棄）して、再読み込み時に表示されないようにする
     get_flashed_messages()
-    return render_template('import_questions.html')
+    # インポートのジョブを実行中であれば、画面から進捗をポーリングする
+    return render_template('import_questions.html', job_id=request.args.get('job'))
 
 @app.route('/admin/questions/import', methods=['POST'])
 @login_required
@@ -2442,253 +2221,155 @@ def import_questions_action():
         flash("JSONファイルを選択してください", "danger")
         return redirect(url_for('import_questions_gui'))
     
+    filename = file.filename.lower()
+    if not filename.endswith(IMPORT_EXTENSIONS):
+        flash("サポートされていないファイル形式です (.json / .ndjson を使用してください)", "danger")
+        return redirect(url_for('import_questions_gui'))
+
+    # アップロードはいったんファイルに保存し、バックグラウンドのジョブで少しずつ読み込む
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    path = os.path.join(IMPORT_DIR, f"{uuid.uuid4().hex}{os.path.splitext(filename)[1]}")
+    file.save(path)
+    # dry_run: 書き込まずに、新規・更新・変更なし・孤立の件数だけを集計する
+    dry_run = request.form.get('dry_run') == '1'
+    job = submit_job('import', _run_import_job, path, not filename.endswith('.json'), dry_run)
+    if job is None:
+        os.remove(path)
+        return redirect(url_for('import_questions_gui'))
+    return redirect(url_for('import_questions_gui', job=job.id))
+
+def _import_summary(counts):
+    summary = (f"クエスト(更新{counts['quests_updated']}/新規{counts['quests_inserted']}"
+               f"/変更なし{counts['quests_unchanged']}/孤立{counts['quests_orphaned']}), "
+               f"問題(更新{counts['questions_updated']}/新規{counts['questions_inserted']}"
+               f"/変更なし{counts['questions_unchanged']}/孤立{counts['questions_orphaned']}")
+    if counts['questions_skipped']:
+        summary += f"/スキップ{counts['questions_skipped']}"
+    return summary + ')'
+
+def _run_import_job(job, path, ndjson, dry_run=False):
+    """インポートのジョブ本体（utils/importer.py）。戻り値はジョブの結果として状態APIで返す。"""
+    engine = importer.ImportEngine(
+        db.engines['content'],
+        subject_keys=SUBJECT_JP_TO_KEY,
+        batch_size=app.config['MQUEST_IMPORT_BATCH_SIZE'],
+        retry=db_retry.call,
+        dry_run=dry_run
+    )
+    job.report(dry_run=dry_run)
+
+    def report(stats):
+        job.report(message=f"インポートを実行しています... {_import_summary(stats.counts)}", **stats.as_dict())
+        # キャンセルされた場合は、コミット済みのバッチの分を残して中断する
+        job.check_cancelled()
+
     try:
-        filename = file.filename.lower()
-        if not filename.endswith('.json'):
-            flash("サポートされていないファイル形式です (.json を使用してください)", "danger")
-            return redirect(url_for('import_questions_gui'))
+        with open(path, encoding='utf-8') as fp:
+            records = importer.normalize_records(importer.iter_json_records(fp, ndjson=ndjson))
+            stats = engine.run(records, progress=report)
+        app.logger.info(f"Import finished: {stats.as_dict()}")
+    finally:
+        os.remove(path)
+        # 途中のバッチで失敗した場合も、コミット済みのバッチの分は反映する。
+        # 内容が変わらなかったクエストのキャッシュはそのまま使う
+        if engine.changed_quest_ids and not dry_run:
+            invalidate_content(engine.changed_quest_ids)
+        if engine.affected_groups and not dry_run:
+            affected_users = rollups.users_with_history(engine.regrouped_quest_ids)
+            refresh_progress_rollups(engine.affected_groups, affected_users)
+    if dry_run:
+        message = f"確認結果（データベースは変更していません）: {_import_summary(engine.stats.counts)}"
+    else:
+        message = f"インポート完了: {_import_summary(engine.stats.counts)}"
+    return dict(engine.stats.as_dict(), dry_run=dry_run, message=message)
 
-        raw_data = json.loads(file.read().decode('utf-8'))
-        
-        # --- Normalization ---
-        normalized_quests = []
-        normalized_questions = []
-        
-        # Context and counters for normalization
-        context = {'last_quest_id': None}
-        temp_id_counter = 0
-
-        def process_entry(row, inherited_quest_id=None):
-            nonlocal temp_id_counter
-            # Detect type
-            rec_type = row.get('record_type')
-            if not rec_type:
-                if 'questname' in row or 'subject' in row:
-                    rec_type = 'quest'
-                elif 'text' in row and 'type' in row:
-                    rec_type = 'question'
-                elif 'questions' in row and isinstance(row['questions'], list):
-                    rec_type = 'quest'
-            
-            if rec_type == 'quest':
-                q_id = row.get('id')
-                # Assign a temporary ID if no ID is present, to link nested questions
-                if not q_id:
-                    temp_id_counter += 1
-                    q_id = f"_temp_quest_{temp_id_counter}"
-                
-                context['last_quest_id'] = q_id
-                
-                quest_data = {
-                    'id': q_id,
-                    'title': row.get('title') or row.get('subject'),
-                    'level': row.get('level'),
-                    'questname': row.get('questname'),
-                    'world_name': row.get('world_name')
-                }
-                normalized_quests.append(quest_data)
-
-                # Process nested questions
-                if 'questions' in row and isinstance(row['questions'], list):
-                    for q_row in row['questions']:
-                        process_entry(q_row, inherited_quest_id=q_id)
-            
-            elif rec_type == 'question':
-                # Link to quest: explicit > inherited > flat list context
-                quest_id = row.get('quest_id') or row.get('questId') or row.get('quest') or inherited_quest_id or context['last_quest_id']
-                
-                q_data = {
-                    'id': row.get('id'),
-                    'quest_id': quest_id,
-                    'type': row.get('type'),
-                    'text': row.get('text'),
-                    'explanation': row.get('explanation'),
-                    'choices': row.get('choices'),
-                    'answer': row.get('answer')
-                }
-                # Flexible mapping for special types and field names
-                if q_data['type'] == 'numeric' and 'answers' in row:
-                    q_data['answer'] = row['answers']
-                elif q_data['type'] == 'svg_interactive' or q_data['type'] == 'figure_choice':
-                    if 'svg_content' in row:
-                        q_data['choices'] = row['svg_content']
-                    if 'sub_questions' in row:
-                        q_data['answer'] = row['sub_questions']
-                
-                normalized_questions.append(q_data)
-
-        if isinstance(raw_data, dict):
-            # Handle quests.json format: { "101": { ... }, "102": { ... } }
-            for key, val in raw_data.items():
-                if isinstance(val, dict):
-                    if 'id' not in val:
-                        try:
-                            val['id'] = int(key)
-                        except ValueError:
-                            # Keep as string (e.g. "q101")
-                            val['id'] = key
-                    process_entry(val)
-        elif isinstance(raw_data, list):
-            for entry in raw_data:
-                process_entry(entry)
-        
-        app.logger.debug(f"Normalized: {len(normalized_quests)} quests, {len(normalized_questions)} questions")
-
-        # --- Phase 1: Process Quests ---
-        updated_quest_count = 0
-        inserted_quest_count = 0
-        quest_id_map = {} # Identifier (from JSON) to real DB ID
-        quest_name_map = {} # questname to real DB ID
-
-        for q_row in normalized_quests:
-            qid_json = q_row.get('id')
-            title_raw = q_row.get('title', 'misc')
-            title = SUBJECT_JP_TO_KEY.get(title_raw, title_raw)
-            level = q_row.get('level', 'Lv1')
-            questname = q_row.get('questname', f'Imported Quest' if not qid_json else f'Quest {qid_json}')
-            world_name = q_row.get('world_name', 'fantasy')
-
-            quest = None
-            # 1. Try by ID
-            if qid_json:
-                try:
-                    quest = safe_get(Quest, int(qid_json))
-                except (ValueError, TypeError):
-                    pass
-            
-            # 2. Try by questname + title + level if still not found
-            if not quest and questname:
-                quest = safe_query_first(Quest.query.filter_by(questname=questname, title=title, level=level))
-            
-            if quest:
-                quest.title = title
-                quest.level = level
-                quest.questname = questname
-                if world_name: quest.world_name = world_name
-                updated_quest_count += 1
-                assigned_id = quest.id
-            else:
-                new_quest = Quest(
-                    title=title,
-                    level=level,
-                    questname=questname,
-                    world_name=world_name
-                )
-                # Only set explicit ID if it's a numeric ID from JSON
-                if qid_json:
-                    try:
-                        new_quest.id = int(qid_json)
-                    except (ValueError, TypeError):
-                        pass
-                
-                db.session.add(new_quest)
-                db.session.flush()
-                inserted_quest_count += 1
-                assigned_id = new_quest.id
-            
-            if qid_json:
-                quest_id_map[str(qid_json)] = assigned_id
-            if questname:
-                quest_name_map[questname] = assigned_id
-        
-        # --- Phase 2: Process Questions ---
-        updated_q_count = 0
-        inserted_q_count = 0
-        
-        for row in normalized_questions:
-            q_id_raw = row.get('id')
-            raw_quest_id = row.get('quest_id')
-            
-            # Resolve quest_id
-            quest_id = None
-            if raw_quest_id:
-                # Try identifier map first
-                quest_id = quest_id_map.get(str(raw_quest_id))
-                if not quest_id:
-                    # Try direct cast
-                    try:
-                        quest_id = int(raw_quest_id)
-                    except (ValueError, TypeError):
-                        pass
-            
-            if not quest_id:
-                # Last resort: if this question record also has a questname (redundant but helpful)
-                q_questname = row.get('questname')
-                if q_questname:
-                    quest_id = quest_name_map.get(q_questname)
-            
-            if quest_id:
-                quest_id = int(quest_id)
-            else:
-                app.logger.debug(f"Skipping question (unresolved quest_id): {row.get('text', '')[:20]}")
-                continue
-
-            q_type = row.get('type')
-            text = row.get('text')
-            choices = row.get('choices')
-            answer = row.get('answer')
-            explanation = row.get('explanation')
-            
-            if not q_type or not text: continue
+# ▼ バックグラウンドジョブ（状態の確認・キャンセル・結果のダウンロード）
+def _job_or_404(job_id):
+    if not (current_user.is_admin() or current_user.is_teacher()):
+        abort(403)
+    status = job_runner.status(job_id)
+    if status is None:
+        abort(404)
+    return status
 
-            if choices is not None and not isinstance(choices, str):
-                choices = json.dumps(choices, ensure_ascii=False)
-            if answer is not None and not isinstance(answer, str):
-                answer = json.dumps(answer, ensure_ascii=False)
+@app.route('/admin/jobs')
+@login_required
+def list_jobs():
+    if not current_user.is_admin():
+        return redirect(url_for('login'))
+    return render_template('jobs.html', jobs=job_runner.recent(), backfills=BACKFILLS)
 
-            question = None
-            if q_id_raw:
-                try:
-                    question = safe_get(Question, int(q_id_raw))
-                except (ValueError, TypeError):
-                    pass
-            
-            if question:
-                question.quest_id = quest_id
-                question.type = q_type
-                question.text = text
-                question.choices = choices if choices and str(choices).strip() != '' else None
-                question.answer = answer
-                question.explanation = explanation
-                updated_q_count += 1
-            else:
-                new_q = Question(
-                    quest_id=quest_id, type=q_type, text=text,
-                    choices=choices if choices and str(choices).strip() != '' else None,
-                    answer=answer, explanation=explanation
-                )
-                if q_id_raw:
-                    try:
-                        new_q.id = int(q_id_raw)
-                    except (ValueError, TypeError):
-                        pass
-                
-                if not new_q.id:
-                    # Auto-assign Question ID (QuestID * 100 + next serial)
-                    base_id = quest_id * 100
-                    max_q_id = db.session.query(func.max(Question.id)).filter(Question.id > base_id, Question.id < base_id + 100).scalar()
-                    new_q.id = (max_q_id + 1) if max_q_id else (base_id + 1)
-                
-                db.session.add(new_q)
-                inserted_q_count += 1
-                db.session.flush()
+@app.route('/admin/jobs/<job_id>')
+@login_required
+def job_page(job_id):
+    return render_template('job_status.html', job=_job_or_404(job_id))
+
+@app.route('/admin/jobs/<job_id>/status')
+@login_required
+def job_status(job_id):
+    return _job_or_404(job_id)
+
+@app.route('/admin/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    _job_or_404(job_id)
+    if not job_runner.cancel(job_id):
+        return {'cancelled': False, 'message': "このジョブは既に終了しています"}, 409
+    return {'cancelled': True}
 
+@app.route('/admin/jobs/<job_id>/download')
+@login_required
+def download_job_result(job_id):
+    job = _job_or_404(job_id)
+    result = job['result'] or {}
+    if job['status'] != jobs.DONE or not result.get('file'):
+        abort(404)
+    path = os.path.join(EXPORT_DIR, result['file'])
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype=result['mimetype'], as_attachment=True, download_name=result['filename'])
+
+def _run_backfill_job(job, name):
+    """集計・ハッシュの再構築と、期限切れの結果の削除のジョブ本体。"""
+    if name == 'quest_results':
+        count = result_store.purge_expired()
         safe_commit()
-        list_url = url_for('manage_quests')
-        flash(f'インポート完了: クエスト(更新{updated_quest_count}/新規{inserted_quest_count}), 問題(更新{updated_q_count}/新規{inserted_q_count})。 <a href="{list_url}">クエスト一覧で確認する</a>', "success")
-    except IntegrityError as ie:
-        db.session.rollback()
-        msg = str(ie)
-        if "FOREIGN KEY" in msg:
-            flash("インポートエラー: 指定された クエストID が存在しません。先に「問題の追加」からクエストを作成してください。", "danger")
-        else:
-            flash(f"データベース整合性エラー: {msg}", "danger")
-    except Exception as e:
-        db.session.rollback()
-        app.logger.error(f"Import error: {e}")
-        flash(f"インポートエラー: {str(e)}", "danger")
-        
-    return redirect(url_for('import_questions_gui'))
+        return {'message': f"期限切れの結果を{count}件削除しました"}
+    if name == 'content_hash':
+        counts = importer.backfill_content_hashes(
+            db.engines['content'], progress=lambda counts: job.report(
+                message=f"クエスト{counts['quests']}件・問題{counts.get('questions', 0)}件のハッシュを設定しました"))
+        return {'message': f"クエスト{counts['quests']}件・問題{counts['questions']}件のハッシュを設定しました"}
+    if name == 'progress_rollups':
+        count = rollups.rebuild()
+        safe_commit()
+        aggregates_rebuilt()
+        return {'message': f"進捗の集計を{count}行再構築しました"}
+    log_count, bucket_count = attempt_buckets.rebuild(attempt_buckets.get_timezone(app.config['MQUEST_TIMEZONE']))
+    safe_commit()
+    aggregates_rebuilt()
+    return {'message': f"{log_count}件の挑戦ログから学習グラフの集計を{bucket_count}行再構築しました"}
+
+# 管理画面から実行できる再構築・メンテナンス（名前 -> 表示名）
+BACKFILLS = {
+    'content_hash': "インポート用のハッシュを設定（content_hash）",
+    'progress_rollups': "進捗の集計を再構築（progress_rollups）",
+    'attempt_buckets': "学習グラフの集計を再構築（attempt_buckets）",
+    'quest_results': "期限切れの結果画面のデータを削除（quest_results）",
+}
+
+@app.route('/admin/jobs/backfill', methods=['POST'])
+@login_required
+def start_backfill():
+    if not current_user.is_admin():
+        return redirect(url_for('login'))
+    name = request.form.get('name')
+    if name not in BACKFILLS:
+        abort(400)
+    job = submit_job('backfill:' + name, _run_backfill_job, name)
+    if job is None:
+        return redirect(url_for('list_jobs'))
+    return redirect(url_for('job_page', job_id=job.id))
 
 if __name__ == '__main__':
     app.logger.setLevel(logging.DEBUG)  # ログレベルをDEBUGに設定
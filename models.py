@@ -3,7 +3,7 @@ from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from datetime import datetime, timezone
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, DDL, event
 from sqlalchemy.orm import foreign, remote
 import json
 
@@ -72,7 +72,10 @@ class User(UserMixin, db.Model):
 class Quest(db.Model):
     __tablename__ = 'quests'
     __bind_key__ = 'content'
+    # id は内部キー（ユーザーDBの履歴・進捗から参照されるため変更しない）。
+    # 画面に表示・入力する「クエストID」は code で、自由に変更できる。
     id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.Integer, unique=True, index=True)
     title = db.Column(db.String(100), nullable=False)
     level = db.Column(db.String(10), nullable=False)
     questname = db.Column(db.String(100), nullable=False)
@@ -80,8 +83,14 @@ class Quest(db.Model):
     # ▼ 世界制覇機能用のカラム
     world_name = db.Column(db.String(100))
 
+    # インポートの差分判定用のハッシュ（utils/importer.py）。画面で編集するとトリガーで NULL に戻る
+    content_hash = db.Column(db.String(64))
+
     # 同一DB内の関係
-    questions = db.relationship('Question', back_populates='quest', cascade="all, delete-orphan", lazy='joined')
+    # 問題本文・選択肢（SVG/GeoGebra を含む）は大きいため、Quest の読み込み時には取得しない。
+    # 問題が必要な画面では selectinload(Quest.questions) を明示して読み込む。
+    questions = db.relationship('Question', back_populates='quest', cascade="all, delete-orphan",
+                                lazy='select', order_by='[Question.position, Question.id]')
     
     # 異なるDB間（BINDS）の関係
     # Questオブジェクトから他DBのデータを参照できるように primaryjoin を設定
@@ -114,9 +123,17 @@ class Question(db.Model):
     choices = db.Column(db.Text)
     answer = db.Column(db.Text)
     explanation = db.Column(db.Text, nullable=True)
+    # クエスト内での出題順（並び替えはこの列だけを更新する）
+    position = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # インポートの差分判定用のハッシュ（utils/importer.py）。画面で編集するとトリガーで NULL に戻る
+    content_hash = db.Column(db.String(64))
 
     quest = db.relationship('Quest', back_populates='questions')
 
+    __table_args__ = (
+        db.Index('ix_questions_quest_position', 'quest_id', 'position'),
+    )
+
 
 class QuestHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -126,7 +143,7 @@ class QuestHistory(db.Model):
     is_cleared = db.Column(db.Boolean, default=False)
     cleared_count = db.Column(db.Integer, default=0)
     attempts = db.Column(db.Integer, default=0)
-    last_attempt = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+    last_attempt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
 
     __table_args__ = (
         UniqueConstraint('user_id', 'quest_id', name='unique_user_quest'),
@@ -165,10 +182,141 @@ class QuestAttemptLog(db.Model):
     quest_id = db.Column(db.Integer, nullable=False)
     correct_answers = db.Column(db.Integer, nullable=False)
     total_questions = db.Column(db.Integer, nullable=False)
-    attempted_at = db.Column(db.DateTime, nullable=False, default=datetime.now(timezone.utc))
+    attempted_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
 
     user = db.relationship('User', back_populates='attempt_logs')
     quest = db.relationship('Quest', 
                             primaryjoin="remote(Quest.id) == foreign(QuestAttemptLog.quest_id)",
                             back_populates='attempt_logs',
                             sync_backref=False)
+
+
+# ▼ /progress 用の集計テーブル（ユーザー × 科目 × レベル）
+class ProgressRollup(db.Model):
+    __tablename__ = 'progress_rollups'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    title = db.Column(db.String(100), nullable=False)
+    level = db.Column(db.String(10), nullable=False)
+    cleared_count = db.Column(db.Integer, nullable=False, default=0)
+    total_attempts = db.Column(db.Integer, nullable=False, default=0)
+    total_count = db.Column(db.Integer, nullable=False, default=0)  # 集計時点の科目・レベル内クエスト数
+    ratio = db.Column(db.Float, nullable=False, default=0.0)  # total_attempts ÷ total_count
+    medal = db.Column(db.String(20), nullable=True)  # 'diamond', 'gold', 'silver', 'bronze' or None
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'title', 'level', name='unique_user_title_level'),
+    )
+
+
+# ▼ 学習グラフ用の期間別集計（日・週・月）
+class AttemptBucket(db.Model):
+    __tablename__ = 'attempt_buckets'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    subject = db.Column(db.String(100), nullable=False, default='')  # '' は全科目合計
+    granularity = db.Column(db.String(10), nullable=False)  # 'day', 'week', 'month'
+    bucket_start = db.Column(db.Date, nullable=False)  # 期間の開始日（設定タイムゾーンでの日付）
+    attempt_count = db.Column(db.Integer, nullable=False, default=0)
+    cleared_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'subject', 'granularity', 'bucket_start', name='unique_user_bucket'),
+    )
+
+
+# ▼ 採点結果の一時保存（結果画面の表示用。セッションにはトークンだけを持つ）
+class QuestResult(db.Model):
+    __tablename__ = 'quest_results'
+    token = db.Column(db.String(64), primary_key=True)  # 推測できないランダムな文字列
+    user_id = db.Column(db.Integer, nullable=True)  # 未ログインで挑戦した場合は None
+    quest_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # 結果画面用のビューモデル（JSON）
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+# ▼ 挑戦ごとの解答（再採点用。utils/answer_log.py）
+# 1回の挑戦の全問の解答を、圧縮した1つのデータとして保存する。
+class AttemptAnswer(db.Model):
+    __tablename__ = 'attempt_answers'
+    attempt_id = db.Column(db.Integer, primary_key=True)  # quest_attempt_logs.id
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    quest_id = db.Column(db.Integer, nullable=False, index=True)
+    answers = db.Column(db.LargeBinary, nullable=False)  # zlib で圧縮した JSON
+
+
+# ▼ バックグラウンドジョブの記録（utils/jobs.py）
+# 状態・進捗・結果を保存し、どのワーカープロセスからも状態の確認とキャンセルの要求ができるようにする。
+class JobRecord(db.Model):
+    __tablename__ = 'jobs'
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # 'import', 'export', 'delete_quests' など
+    status = db.Column(db.String(20), nullable=False, index=True)  # queued, running, done, failed, cancelled
+    progress = db.Column(db.Text, nullable=True)  # 進捗（JSON）
+    result = db.Column(db.Text, nullable=True)  # 結果（JSON）
+    error = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, nullable=True)  # 登録したユーザーのID
+    owner = db.Column(db.String(100), nullable=True)  # 実行するプロセス（'ホスト名:PID'）
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+# ▼ ID の採番（utils/id_allocator.py）
+# name ごとに次に払い出す ID を保持する。一括登録では必要な件数分をまとめて払い出す。
+class IdSequence(db.Model):
+    __bind_key__ = 'content'
+    __tablename__ = 'id_sequences'
+    name = db.Column(db.String(50), primary_key=True)  # 採番対象のテーブル名（例: 'questions'）
+    next_value = db.Column(db.Integer, nullable=False)
+
+
+# ▼ コンテンツの変更番号（複数プロセス間のキャッシュ無効化用）
+# quests / questions への INSERT・UPDATE・DELETE のたびにトリガーで version を1増やす。
+# 各プロセスはこの値を定期的に読み、変わっていればキャッシュを破棄する。
+class ContentVersion(db.Model):
+    __bind_key__ = 'content'
+    __tablename__ = 'content_version'
+    id = db.Column(db.Integer, primary_key=True)  # 常に 1 の1行だけ
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+def _content_version_triggers(table):
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS content_version_{table}_{op.lower()} AFTER {op} ON {table} "
+        f"BEGIN UPDATE content_version SET version = version + 1 WHERE id = 1; END"
+        for op in ('INSERT', 'UPDATE', 'DELETE')
+    ]
+
+
+CONTENT_VERSION_TRIGGERS = _content_version_triggers('quests') + _content_version_triggers('questions')
+
+# ▼ インポートの差分判定用のハッシュ（content_hash）
+# content_hash を変えずに内容の列を更新した場合（画面での編集など）はハッシュを NULL に戻し、
+# 次のインポートで必ず書き込まれるようにする。
+_CONTENT_HASH_COLUMNS = {
+    'quests': ('title', 'level', 'questname', 'world_name'),
+    'questions': ('quest_id', 'type', 'text', 'choices', 'answer', 'explanation'),
+}
+
+
+def _content_hash_trigger(table):
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS content_hash_{table}_reset "
+        f"AFTER UPDATE OF {', '.join(_CONTENT_HASH_COLUMNS[table])} ON {table} "
+        f"WHEN NEW.content_hash IS OLD.content_hash AND NEW.content_hash IS NOT NULL "
+        f"BEGIN UPDATE {table} SET content_hash = NULL WHERE id = NEW.id; END"
+    )
+
+
+CONTENT_HASH_TRIGGERS = [_content_hash_trigger('quests'), _content_hash_trigger('questions')]
+
+# create_all() でテーブルと同時にトリガーと初期行を作成する
+event.listen(ContentVersion.__table__, 'after_create',
+             DDL("INSERT OR IGNORE INTO content_version (id, version) VALUES (1, 0)"))
+for _model in (Quest, Question):
+    for _trigger in _content_version_triggers(_model.__tablename__) + [_content_hash_trigger(_model.__tablename__)]:
+        event.listen(_model.__table__, 'after_create', DDL(_trigger))
@@ -4,6 +4,7 @@ import json
 from datetime import datetime, timezone, timedelta
 import random
 from app import app, db, User, Quest, UserProgress, QuestHistory, QuestAttemptLog
+from sqlalchemy.orm import selectinload
 
 def add_dummy_student_data():
     with app.app_context():
@@ -54,7 +55,7 @@ def add_dummy_student_data():
         QuestAttemptLog.query.filter_by(user_id=student.id).delete()
 
         for title, level, count in subjects:
-            quests = Quest.query.filter_by(title=title, level=level).limit(count).all()
+            quests = Quest.query.options(selectinload(Quest.questions)).filter_by(title=title, level=level).limit(count).all()
             print(f"Adding progress for {title} {level}: {len(quests)} quests")
             
             for i, quest in enumerate(quests):
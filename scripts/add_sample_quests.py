@@ -95,6 +95,7 @@ if __name__ == '__main__':
 
             quest = Quest(
                 id=quest_id,
+                code=quest_id,
                 title=subject_key,
                 level=qset["level"],
                 questname=qset["questname"],
@@ -103,7 +104,7 @@ if __name__ == '__main__':
             db.session.add(quest)
             db.session.flush()
 
-            for q in qset["questions"]:
+            for position, q in enumerate(qset["questions"], start=1):
                 # choicesの処理
                 choices_data = None
                 if q.get("type") == "choice" or q.get("type") == "multiple_choice":
@@ -126,7 +127,8 @@ if __name__ == '__main__':
                     text=q["text"],
                     explanation=q.get("explanation"),
                     choices=choices_data,
-                    answer=answer_data
+                    answer=answer_data,
+                    position=position
                 )
                 db.session.add(question)
 
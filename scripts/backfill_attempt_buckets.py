@@ -0,0 +1,27 @@
+# scripts/backfill_attempt_buckets.py
+"""
+attempt_buckets テーブル（学習グラフ用の日・週・月別集計）を作成し、
+既存の quest_attempt_logs から作り直す。
+
+    python scripts/backfill_attempt_buckets.py            # 全生徒
+    python scripts/backfill_attempt_buckets.py 3 5 8      # 指定したユーザーIDのみ
+
+期間の区切りは app.config['MQUEST_TIMEZONE']（環境変数 MQUEST_TIMEZONE）に従う。
+"""
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from utils import attempt_buckets
+
+if __name__ == '__main__':
+    user_ids = [int(arg) for arg in sys.argv[1:]] or None
+    with app.app_context():
+        # 未作成のテーブルのみ作成される
+        db.create_all()
+        tz = attempt_buckets.get_timezone(app.config['MQUEST_TIMEZONE'])
+        log_count, bucket_count = attempt_buckets.rebuild(tz, user_ids)
+        db.session.commit()
+        print(f"attempt_buckets を再構築しました: 挑戦ログ {log_count} 件 → {bucket_count} 行 ({tz})")
@@ -0,0 +1,143 @@
+# scripts/bench_concurrent_submit.py
+"""
+クエスト結果の同時送信ベンチマーク。
+
+現在の方式（各リクエストスレッドでコミットし、ロック時は sleep リトライ）と
+書き込みキュー方式（MQUEST_WRITE_QUEUE=1）で、同時に送信したときの
+応答時間・スループット・リトライ回数を比較する。
+
+ベンチマーク用の生徒（bench_student_NNN）を作成して送信し、終了時にその
+生徒と関連データを削除する。開発用のデータベースで実行すること。
+
+    python scripts/bench_concurrent_submit.py                      # 両方式を比較
+    python scripts/bench_concurrent_submit.py --students 40 --rounds 10
+    python scripts/bench_concurrent_submit.py --mode queue         # 片方だけ
+"""
+import argparse
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+MODES = ('retry', 'queue')
+
+
+class _RetryCounter(logging.Handler):
+    """Counts the retry warnings logged by the DB retry policy (utils/retry.py)."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        if 'Retrying' in record.getMessage():
+            self.count += 1
+
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run_mode(mode, students, rounds, quests, keep):
+    os.environ['MQUEST_WRITE_QUEUE'] = '1' if mode == 'queue' else '0'
+    from app import app, db, write_queue
+    from models import (User, QuestHistory, UserProgress, QuestAttemptLog, ProgressRollup,
+                        AttemptBucket, QuestResult)
+    from utils.catalog import catalog
+
+    retries = _RetryCounter()
+    logging.getLogger('utils.retry').addHandler(retries)
+
+    with app.app_context():
+        db.create_all()
+        quest_ids = [q.id for q in catalog.quests()][:quests]
+        if not quest_ids:
+            print("クエストが登録されていません。")
+            return
+        user_ids = []
+        for i in range(students):
+            username = f'bench_student_{i:03d}'
+            user = User.query.filter_by(username=username).first()
+            if not user:
+                user = User(username=username, role='student', nickname=f'ベンチ{i}')
+                user.set_password(username)
+                db.session.add(user)
+                db.session.flush()
+            user_ids.append(user.id)
+        db.session.commit()
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(students)
+
+    def student(user_id, index):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['role'] = 'student'
+        barrier.wait()
+        for r in range(rounds):
+            quest_id = quest_ids[(index + r) % len(quest_ids)]
+            start = time.perf_counter()
+            try:
+                response = client.post(f'/quest/{quest_id}/result', data={})
+                ok = response.status_code == 302
+            except Exception as e:
+                ok = False
+                response = e
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors.append(response)
+
+    threads = [threading.Thread(target=student, args=(uid, i)) for i, uid in enumerate(user_ids)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    print(f"[{mode}] students={students} rounds={rounds} requests={len(latencies)} errors={len(errors)}")
+    print(f"  total {wall:.2f}s, {len(latencies) / wall:.1f} req/s")
+    print(f"  latency p50 {statistics.median(latencies) * 1000:.1f}ms, "
+          f"p95 {_percentile(latencies, 0.95) * 1000:.1f}ms, max {max(latencies) * 1000:.1f}ms")
+    print(f"  lock retries {retries.count}")
+    if write_queue is not None:
+        print(f"  write queue {write_queue.stats}")
+
+    if not keep:
+        with app.app_context():
+            for model in (QuestHistory, UserProgress, QuestAttemptLog, ProgressRollup, AttemptBucket, QuestResult):
+                model.query.filter(model.user_id.in_(user_ids)).delete(synchronize_session=False)
+            User.query.filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+            db.session.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=MODES, help='片方の方式だけを実行する（省略時は両方を別プロセスで実行）')
+    parser.add_argument('--students', type=int, default=30, help='同時に送信する生徒数')
+    parser.add_argument('--rounds', type=int, default=5, help='生徒1人あたりの送信回数')
+    parser.add_argument('--quests', type=int, default=10, help='送信先のクエスト数')
+    parser.add_argument('--keep', action='store_true', help='ベンチマーク用の生徒とデータを削除しない')
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.students, args.rounds, args.quests, args.keep)
+    else:
+        # 書き込みキューの有無はアプリ読み込み時に決まるため、方式ごとに別プロセスで実行する
+        for mode in MODES:
+            cmd = [sys.executable, os.path.abspath(__file__), '--mode', mode,
+                   '--students', str(args.students), '--rounds', str(args.rounds), '--quests', str(args.quests)]
+            if args.keep:
+                cmd.append('--keep')
+            subprocess.run(cmd, check=True)
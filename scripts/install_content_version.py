@@ -0,0 +1,21 @@
+# scripts/install_content_version.py
+"""
+既存のコンテンツDBに content_version テーブルと quests / questions の変更トリガーを作成する。
+複数のワーカープロセスで動かす場合に、他のプロセスでのクエスト・問題の変更を検知するために使う。
+
+    python scripts/install_content_version.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from utils import content_version
+
+if __name__ == '__main__':
+    with app.app_context():
+        # 未作成のテーブルのみ作成される
+        db.create_all()
+        content_version.install()
+        print(f"content_version を作成しました（現在の値: {content_version.read_version()}）")
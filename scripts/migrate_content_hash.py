@@ -0,0 +1,39 @@
+# scripts/migrate_content_hash.py
+"""
+既存のコンテンツDBに quests.content_hash / questions.content_hash（インポートの差分判定用）と、
+画面での編集時にハッシュを NULL に戻すトリガーを追加し、未設定のハッシュを計算する。
+
+- ハッシュが未設定の行は、次のインポートで内容が同じでも1度だけ書き込まれる。
+  このスクリプトで事前に計算しておくと、最初のインポートから変更のある行だけが書き込まれる。
+- 何度実行しても、設定済みのハッシュは変更しない。
+
+    python scripts/migrate_content_hash.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from models import CONTENT_HASH_TRIGGERS
+from utils import importer
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def migrate(conn):
+    for table in ('quests', 'questions'):
+        if 'content_hash' not in _columns(conn, table):
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN content_hash VARCHAR(64)")
+    for trigger in CONTENT_HASH_TRIGGERS:
+        conn.exec_driver_sql(trigger)
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        with db.engines['content'].begin() as conn:
+            migrate(conn)
+        counts = importer.backfill_content_hashes(db.engines['content'])
+        print(f"content_hash を設定しました（クエスト {counts['quests']}件、問題 {counts['questions']}件）")
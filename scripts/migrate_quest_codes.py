@@ -0,0 +1,61 @@
+# scripts/migrate_quest_codes.py
+"""
+既存のコンテンツDBに quests.code（表示用のクエストID）と questions.position（出題順）、
+問題IDの採番テーブル id_sequences を追加する。
+
+- quests.code には現在のクエストIDをそのまま設定する（画面上のIDは変わらない）。
+- questions.position にはクエストごとの現在の問題ID順で 1, 2, 3... を設定する。
+- id_sequences は最初の採番時に現在の最大の問題ID+1から始まる。
+- 何度実行しても、設定済みの値は変更しない。
+
+    python scripts/migrate_quest_codes.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from models import IdSequence
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def migrate(conn):
+    quest_columns = _columns(conn, 'quests')
+    question_columns = _columns(conn, 'questions')
+
+    if 'code' not in quest_columns:
+        conn.exec_driver_sql("ALTER TABLE quests ADD COLUMN code INTEGER")
+    conn.exec_driver_sql("UPDATE quests SET code = id WHERE code IS NULL")
+    conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ix_quests_code ON quests (code)")
+
+    added_position = 'position' not in question_columns
+    if added_position:
+        conn.exec_driver_sql("ALTER TABLE questions ADD COLUMN position INTEGER NOT NULL DEFAULT 0")
+        # クエストごとに問題ID順で 1, 2, 3...
+        conn.exec_driver_sql("""
+            UPDATE questions SET position = (
+                SELECT COUNT(*) FROM questions AS q2
+                WHERE q2.quest_id = questions.quest_id AND q2.id <= questions.id
+            )
+        """)
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_questions_quest_position ON questions (quest_id, position)"
+    )
+    IdSequence.__table__.create(conn, checkfirst=True)
+    return added_position
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        with db.engines['content'].begin() as conn:
+            added_position = migrate(conn)
+            quest_count = conn.exec_driver_sql("SELECT COUNT(*) FROM quests").scalar()
+        print(f"quests.code を設定しました（{quest_count}件）")
+        if added_position:
+            print("questions.position を問題ID順で設定しました")
+        else:
+            print("questions.position は設定済みのため変更していません")
@@ -0,0 +1,23 @@
+# scripts/purge_quest_results.py
+"""
+quest_results テーブル（クエスト結果画面用の一時保存）を作成し、期限切れの結果を削除する。
+結果の保存時には削除しないため、cron などで定期的に（例: 1日1回）実行する。
+管理画面のバックグラウンドジョブからも実行できる。
+
+    python scripts/purge_quest_results.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from utils import result_store
+
+if __name__ == '__main__':
+    with app.app_context():
+        # 未作成のテーブルのみ作成される
+        db.create_all()
+        count = result_store.purge_expired()
+        db.session.commit()
+        print(f"期限切れの結果を削除しました: {count} 件")
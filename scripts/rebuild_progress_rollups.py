@@ -0,0 +1,24 @@
+# scripts/rebuild_progress_rollups.py
+"""
+progress_rollups テーブル（/progress 用の科目・レベル別集計）を作成し、
+user_progress / quest_history から作り直す。
+
+    python scripts/rebuild_progress_rollups.py            # 全生徒
+    python scripts/rebuild_progress_rollups.py 3 5 8      # 指定したユーザーIDのみ
+"""
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from utils import rollups
+
+if __name__ == '__main__':
+    user_ids = [int(arg) for arg in sys.argv[1:]] or None
+    with app.app_context():
+        # 未作成のテーブルのみ作成される
+        db.create_all()
+        count = rollups.rebuild(user_ids)
+        db.session.commit()
+        print(f"progress_rollups を再構築しました: {count} 行")
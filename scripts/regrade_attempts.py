@@ -0,0 +1,59 @@
+# scripts/regrade_attempts.py
+"""
+保存した挑戦ごとの解答（attempt_answers）を現在の正解で採点し直し、挑戦ログ・
+quest_history・user_progress と集計（progress_rollups / attempt_buckets）を更新する。
+問題の正解を修正した後に実行する。
+
+    python scripts/regrade_attempts.py                # 全クエスト
+    python scripts/regrade_attempts.py 101 102        # 指定したクエストID（表示用のID）のみ
+    python scripts/regrade_attempts.py --dry-run      # 更新せずに件数だけを表示する
+
+attempt_answers テーブルが無い場合は作成する（解答の保存は作成後の挑戦から）。
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db, refresh_progress_rollups, user_data_changed
+from models import Quest
+from utils import answer_log, attempt_buckets
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="保存した解答を現在の正解で採点し直す")
+    parser.add_argument('codes', nargs='*', type=int, help="クエストID（省略時は全クエスト）")
+    parser.add_argument('--dry-run', action='store_true', help="更新せずに件数だけを表示する")
+    args = parser.parse_args()
+
+    with app.app_context():
+        # 未作成のテーブルのみ作成される
+        db.create_all()
+        quest_ids = None
+        if args.codes:
+            quest_ids = [quest_id for quest_id, in db.session.query(Quest.id).filter(Quest.code.in_(args.codes))]
+            if len(quest_ids) != len(set(args.codes)):
+                sys.exit("存在しないクエストIDが含まれています")
+
+        stats = answer_log.regrade(
+            quest_ids, dry_run=args.dry_run,
+            progress=lambda stats: print(f"  {stats['attempts']} 件を採点しました", flush=True)
+        )
+        user_ids = stats.pop('user_ids')
+        if args.dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+            if user_ids:
+                # 全問正解の挑戦数・クリア状況が変わった生徒の集計を作り直す
+                tz = attempt_buckets.get_timezone(app.config['MQUEST_TIMEZONE'])
+                attempt_buckets.rebuild(tz, user_ids)
+                refresh_progress_rollups((), user_ids)
+                for user_id in user_ids:
+                    user_data_changed(user_id)
+
+    print(("確認結果（更新していません）" if args.dry_run else "再採点しました") +
+          f": 挑戦 {stats['attempts']} 件（結果が変わった挑戦 {stats['attempts_changed']} 件、"
+          f"採点できない挑戦 {stats['skipped']} 件）")
+    print(f"クリア状況が変わった生徒: {stats['students_changed']} 人"
+          f"（新たにクリア {stats['newly_cleared']} 件、クリア取り消し {stats['uncleared']} 件）")
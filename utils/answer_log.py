@@ -0,0 +1,172 @@
+# utils/answer_log.py
+"""
+挑戦ごとの解答の保存と、保存した解答の再採点。
+
+- 結果の送信時に、全問の解答（utils/grading.py の extract_answers の値）を問題IDと組にした
+  JSON を zlib で圧縮し、attempt_answers に挑戦1回につき1行で保存する。圧縮は送信の
+  トランザクションの外で行い、挿入は挑戦ログと同じトランザクションで行う
+  （utils/submissions.py）ため、解答の無い挑戦ログは残らない。
+- 正解を修正した後は regrade() で保存した解答を現在の答えのキーで採点し直し、
+  挑戦ログ・quest_history・user_progress をまとめて更新する（scripts/regrade_attempts.py）。
+"""
+import json
+import zlib
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, AttemptAnswer, QuestAttemptLog, QuestHistory
+from utils import grading, question_cache
+
+FORMAT_VERSION = 1
+
+
+def pack(answer_keys, answers):
+    """Compressed blob of one attempt: the answers paired with the question ids, in question order."""
+    data = {'v': FORMAT_VERSION, 'a': [[key.question_id, answer] for key, answer in zip(answer_keys, answers)]}
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack(blob):
+    """{question_id: answer} of a blob made by pack()."""
+    data = json.loads(zlib.decompress(blob))
+    return {question_id: answer for question_id, answer in data['a']}
+
+
+def record(attempt_id, user_id, quest_id, blob):
+    """Stores the answers of an attempt. The caller commits."""
+    db.session.execute(sqlite_insert(AttemptAnswer).values(
+        attempt_id=attempt_id, user_id=user_id, quest_id=quest_id, answers=blob
+    ).on_conflict_do_nothing())
+
+
+def _grade(answer_keys, answers):
+    """(score, total) of stored answers; questions added after the attempt are not counted."""
+    results = [grading.check(key, answers[key.question_id]) for key in answer_keys if key.question_id in answers]
+    return sum(1 for r in results if r['correct']), len(results)
+
+
+def regrade(quest_ids=None, dry_run=False, batch_size=1000, progress=None):
+    """
+    Re-grades every stored attempt (of quest_ids, or all quests) with the
+    current answer keys and updates the attempt logs, quest_history
+    (cleared_count / is_cleared / correct) and user_progress of the attempts
+    whose result changed. The caller commits (nothing is written when
+    dry_run=True) and rebuilds the aggregates of the returned user_ids.
+    progress(stats) is called every batch_size attempts.
+
+    Returns stats: attempts, attempts_changed, skipped, newly_cleared,
+    uncleared, students_changed and user_ids (students whose records changed).
+    """
+    stats = {'attempts': 0, 'attempts_changed': 0, 'skipped': 0,
+             'newly_cleared': 0, 'uncleared': 0, 'students_changed': 0}
+    keys = {}  # quest_id -> 答えのキー（クエストが無い場合は None）
+    changed_logs = []
+    user_ids = set()
+    pairs = {}  # (user_id, quest_id) -> {'delta', 'last_id', 'last_cleared', 'cleared_at'}
+
+    query = select(
+        AttemptAnswer.attempt_id, AttemptAnswer.answers, QuestAttemptLog.user_id, QuestAttemptLog.quest_id,
+        QuestAttemptLog.correct_answers, QuestAttemptLog.total_questions, QuestAttemptLog.attempted_at
+    ).join(QuestAttemptLog, QuestAttemptLog.id == AttemptAnswer.attempt_id).order_by(AttemptAnswer.attempt_id)
+    if quest_ids is not None:
+        quest_ids = [int(qid) for qid in quest_ids]
+        query = query.where(AttemptAnswer.quest_id.in_(quest_ids))
+
+    # 解答は1回の読み出しで先頭から順に採点し、結果が変わったものだけを保持する
+    for row in db.session.execute(query.execution_options(yield_per=batch_size)):
+        if row.quest_id not in keys:
+            payload = question_cache.get_grading_payload(row.quest_id)
+            keys[row.quest_id] = payload[1] if payload else None
+        answer_keys = keys[row.quest_id]
+        score, total = _grade(answer_keys, unpack(row.answers)) if answer_keys else (0, 0)
+        if total == 0:
+            # クエストや問題が削除されて採点できない
+            stats['skipped'] += 1
+            continue
+
+        stats['attempts'] += 1
+        if (score, total) != (row.correct_answers, row.total_questions):
+            stats['attempts_changed'] += 1
+            changed_logs.append({'id': row.attempt_id, 'score': score, 'total': total})
+            user_ids.add(row.user_id)
+        was_cleared = row.correct_answers == row.total_questions
+        cleared = score == total
+        pair = pairs.setdefault((row.user_id, row.quest_id), {'delta': 0, 'cleared_at': None})
+        pair['delta'] += int(cleared) - int(was_cleared)
+        pair['last_id'] = row.attempt_id
+        pair['last_cleared'] = cleared
+        if cleared and pair['cleared_at'] is None:
+            pair['cleared_at'] = row.attempted_at
+        if progress is not None and stats['attempts'] % batch_size == 0:
+            progress(stats)
+
+    history_updates, newly_cleared, uncleared = _history_changes(pairs, quest_ids)
+    stats['newly_cleared'] = len(newly_cleared)
+    stats['uncleared'] = len(uncleared)
+    stats['students_changed'] = len({user_id for user_id, _, _ in newly_cleared} | {user_id for user_id, _ in uncleared})
+    stats['user_ids'] = user_ids | {h['user_id'] for h in history_updates}
+
+    if not dry_run:
+        _write(changed_logs, history_updates, newly_cleared, uncleared)
+    return stats
+
+
+def _history_changes(pairs, quest_ids):
+    """
+    New quest_history values of the re-graded (user, quest) pairs.
+    Returns (history_updates, newly_cleared [(user_id, quest_id, cleared_at)], uncleared [(user_id, quest_id)]).
+    """
+    if not pairs:
+        return [], [], []
+    # 各ペアの最新の挑戦（quest_history.correct は最新の挑戦の結果）
+    last_q = db.session.query(QuestAttemptLog.user_id, QuestAttemptLog.quest_id, db.func.max(QuestAttemptLog.id)) \
+        .group_by(QuestAttemptLog.user_id, QuestAttemptLog.quest_id)
+    history_q = db.session.query(QuestHistory.user_id, QuestHistory.quest_id, QuestHistory.correct,
+                                 QuestHistory.is_cleared, QuestHistory.cleared_count)
+    if quest_ids is not None:
+        last_q = last_q.filter(QuestAttemptLog.quest_id.in_(quest_ids))
+        history_q = history_q.filter(QuestHistory.quest_id.in_(quest_ids))
+    last_ids = {(u, q): last_id for u, q, last_id in last_q if (u, q) in pairs}
+
+    history_updates, newly_cleared, uncleared = [], [], []
+    for user_id, quest_id, correct, is_cleared, cleared_count in history_q.yield_per(1000):
+        pair = pairs.get((user_id, quest_id))
+        if pair is None:
+            continue
+        new_count = max(0, (cleared_count or 0) + pair['delta'])
+        # 全問正解の回数が変わらなければ、クリア済みかどうかはそのまま（古い記録を含むため）
+        new_cleared = new_count > 0 if pair['delta'] else bool(is_cleared)
+        new_correct = pair['last_cleared'] if last_ids.get((user_id, quest_id)) == pair['last_id'] else bool(correct)
+        if (new_count, new_cleared, new_correct) == ((cleared_count or 0), bool(is_cleared), bool(correct)):
+            continue
+        history_updates.append({'user_id': user_id, 'quest_id': quest_id, 'cleared_count': new_count,
+                                'is_cleared': new_cleared, 'correct': new_correct})
+        if new_cleared and not is_cleared:
+            newly_cleared.append((user_id, quest_id, pair['cleared_at']))
+        elif is_cleared and not new_cleared:
+            uncleared.append((user_id, quest_id))
+    return history_updates, newly_cleared, uncleared
+
+
+def _write(changed_logs, history_updates, newly_cleared, uncleared):
+    if changed_logs:
+        db.session.execute(text(
+            "UPDATE quest_attempt_logs SET correct_answers = :score, total_questions = :total WHERE id = :id"
+        ), changed_logs)
+    if history_updates:
+        db.session.execute(text(
+            "UPDATE quest_history SET cleared_count = :cleared_count, is_cleared = :is_cleared, correct = :correct "
+            "WHERE user_id = :user_id AND quest_id = :quest_id"
+        ), history_updates)
+    if newly_cleared:
+        db.session.execute(text(
+            "INSERT INTO user_progress (user_id, quest_id, status, conquered_at) "
+            "VALUES (:user_id, :quest_id, 'cleared', :conquered_at) "
+            "ON CONFLICT (user_id, quest_id) DO UPDATE SET status = 'cleared', conquered_at = excluded.conquered_at"
+        ), [{'user_id': u, 'quest_id': q, 'conquered_at': at} for u, q, at in newly_cleared])
+    if uncleared:
+        db.session.execute(text(
+            "UPDATE user_progress SET status = 'unlocked', conquered_at = NULL "
+            "WHERE user_id = :user_id AND quest_id = :quest_id"
+        ), [{'user_id': u, 'quest_id': q} for u, q in uncleared])
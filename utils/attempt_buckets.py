@@ -0,0 +1,167 @@
+# utils/attempt_buckets.py
+"""
+学習グラフ（週別・月別の挑戦数/クリア数）用の期間別集計（attempt_buckets テーブル）。
+
+挑戦の記録時に、設定タイムゾーンでの日・週（月曜始まり）・月の各期間について
+全科目合計と科目別の行を UPSERT で加算する。グラフの表示は期間数ぶんの行を
+読むだけなので、利用期間が長くなっても処理量は変わらない。
+"""
+from functools import lru_cache
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, AttemptBucket
+
+GRANULARITIES = ('day', 'week', 'month')
+ALL_SUBJECTS = ''
+
+_LABEL_FORMATS = {
+    'day': '%Y-%m-%d',
+    'week': '%Y-%W',
+    'month': '%Y-%m',
+}
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    """
+    ZoneInfo for name. Raises ValueError if the tz database lacks it; on Windows
+    the database comes from the tzdata package (requirements.txt).
+    """
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise ValueError(f"タイムゾーン '{name}' が見つかりません（MQUEST_TIMEZONE を確認し、"
+                         f"Windows では tzdata をインストールしてください）") from e
+
+
+def local_date(dt, tz):
+    """Calendar date of dt in tz. Naive datetimes (as stored by SQLite) are UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(tz).date()
+
+
+def bucket_start(d, granularity):
+    if granularity == 'day':
+        return d
+    if granularity == 'week':
+        return d - timedelta(days=d.weekday())
+    if granularity == 'month':
+        return d.replace(day=1)
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+
+def _shift(d, granularity, n):
+    """d moved back by n periods (calendar months for 'month')."""
+    if granularity == 'day':
+        return d - timedelta(days=n)
+    if granularity == 'week':
+        return d - timedelta(weeks=n)
+    month_index = d.year * 12 + (d.month - 1) - n
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def bucket_rows(user_id, subject, attempted_at, cleared, tz):
+    """Row dicts for one attempt: every granularity, for all subjects and for the subject."""
+    d = local_date(attempted_at, tz)
+    subjects = [ALL_SUBJECTS] + ([subject] if subject else [])
+    return [{
+        'user_id': user_id,
+        'subject': s,
+        'granularity': g,
+        'bucket_start': bucket_start(d, g),
+        'attempt_count': 1,
+        'cleared_count': 1 if cleared else 0,
+    } for s in subjects for g in GRANULARITIES]
+
+
+def upsert_rows(rows):
+    """Adds the counts in rows to attempt_buckets with a single INSERT ... ON CONFLICT DO UPDATE."""
+    if not rows:
+        return
+    stmt = sqlite_insert(AttemptBucket).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'subject', 'granularity', 'bucket_start'],
+        set_={
+            'attempt_count': AttemptBucket.attempt_count + stmt.excluded.attempt_count,
+            'cleared_count': AttemptBucket.cleared_count + stmt.excluded.cleared_count,
+        }
+    )
+    db.session.execute(stmt)
+
+
+def record_attempt(user_id, subject, attempted_at, cleared, tz):
+    """Counts one attempt. Call inside the submit transaction."""
+    upsert_rows(bucket_rows(user_id, subject, attempted_at, cleared, tz))
+
+
+def rebuild(tz, user_ids=None, batch_size=1000):
+    """
+    Recomputes attempt_buckets from quest_attempt_logs (all users, or user_ids).
+    Logs are streamed in batches and aggregated in memory per bucket, so the
+    memory used is proportional to the number of buckets, not of logs.
+    The caller commits. Returns (log_count, bucket_count).
+    """
+    from models import QuestAttemptLog
+    from utils.catalog import catalog
+
+    logs_q = db.session.query(
+        QuestAttemptLog.user_id, QuestAttemptLog.quest_id, QuestAttemptLog.attempted_at,
+        QuestAttemptLog.correct_answers, QuestAttemptLog.total_questions
+    ).order_by(QuestAttemptLog.id)
+    delete_q = AttemptBucket.query
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        logs_q = logs_q.filter(QuestAttemptLog.user_id.in_(user_ids))
+        delete_q = delete_q.filter(AttemptBucket.user_id.in_(user_ids))
+
+    totals = {}
+    log_count = 0
+    for user_id, quest_id, attempted_at, correct, total in logs_q.yield_per(batch_size):
+        quest = catalog.get(quest_id)
+        subject = quest.title if quest else ''
+        for row in bucket_rows(user_id, subject, attempted_at, correct == total, tz):
+            key = (row['user_id'], row['subject'], row['granularity'], row['bucket_start'])
+            counts = totals.setdefault(key, [0, 0])
+            counts[0] += row['attempt_count']
+            counts[1] += row['cleared_count']
+        log_count += 1
+
+    delete_q.delete(synchronize_session=False)
+    rows = [{
+        'user_id': user_id, 'subject': subject, 'granularity': granularity, 'bucket_start': start,
+        'attempt_count': counts[0], 'cleared_count': counts[1],
+    } for (user_id, subject, granularity, start), counts in totals.items()]
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(AttemptBucket.__table__.insert(), rows[i:i + batch_size])
+    return log_count, len(rows)
+
+
+def chart_series(user_id, granularity, periods, tz, subject=ALL_SUBJECTS, now=None):
+    """
+    Chart data for the last `periods` periods up to and including the current one:
+    {'labels': [...], 'cleared_count': [...], 'attempt_count': [...]}.
+    """
+    today = local_date(now or datetime.now(timezone.utc), tz)
+    starts = [bucket_start(_shift(today, granularity, i), granularity) for i in range(periods - 1, -1, -1)]
+    rows = db.session.query(
+        AttemptBucket.bucket_start, AttemptBucket.attempt_count, AttemptBucket.cleared_count
+    ).filter(
+        AttemptBucket.user_id == user_id,
+        AttemptBucket.subject == subject,
+        AttemptBucket.granularity == granularity,
+        AttemptBucket.bucket_start >= starts[0],
+        AttemptBucket.bucket_start <= starts[-1]
+    ).all()
+    by_start = {r.bucket_start: r for r in rows}
+
+    label_format = _LABEL_FORMATS[granularity]
+    data = {'labels': [], 'cleared_count': [], 'attempt_count': []}
+    for start in starts:
+        row = by_start.get(start)
+        data['labels'].append(start.strftime(label_format))
+        data['cleared_count'].append(int(row.cleared_count) if row else 0)
+        data['attempt_count'].append(int(row.attempt_count) if row else 0)
+    return data
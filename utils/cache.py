@@ -0,0 +1,331 @@
+# utils/cache.py
+"""
+集計結果などのキャッシュ。
+
+- MemoryCache: プロセス内の LRU キャッシュ（有効期限・件数上限付き）
+- SQLiteCache: 全ワーカープロセスで共有する SQLite ファイルのキーバリューストア
+  （外部サービス不要。有効期限・件数上限付き）
+- TieredCache: MemoryCache → SQLiteCache の順に参照する2段のキャッシュ
+
+関数の戻り値は @cached デコレーターでキャッシュする。キャッシュのキーには
+データのバージョン（コンテンツの変更番号や、生徒ごとのタグ）を含め、
+データが変わったときはバージョンが変わることで古い値が使われなくなる。
+タグ（bump_tag / get_tag）は共有の段に保存するため、他のプロセスでの更新も反映される。
+読み出したタグはプロセス内で短時間（tag_interval 秒）保持し、共有の段は一定間隔に1回だけ読む。
+"""
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from utils.single_flight import flights
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class CacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0, 'expirations': 0, 'errors': 0}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        lookups = counts['hits'] + counts['misses']
+        counts['hit_ratio'] = round(counts['hits'] / lookups, 3) if lookups else None
+        return counts
+
+
+class MemoryCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.stats = CacheStats()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.stats.incr('hits')
+                    return entry[1]
+                del self._entries[key]
+                self.stats.incr('expirations')
+        self.stats.incr('misses')
+        return _MISSING
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                evicted += 1
+        self.stats.incr('sets')
+        if evicted:
+            self.stats.incr('evictions', evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+    Key-value cache in a SQLite file shared by every worker process.
+    Values are pickled. Errors are logged and treated as misses so that the
+    cache can never break a request.
+    """
+
+    # 件数上限の確認は書き込み何回かに1回だけ行う
+    EVICT_EVERY = 50
+
+    def __init__(self, path, max_entries=10000, ttl=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self.stats = CacheStats()
+
+    def _conn(self):
+        # ファイルとテーブルは import 時ではなく最初に使うときに作る
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # キャッシュなので、電源断で直近の書き込みが失われても問題ない
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entries ("
+                         "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL, stored_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_entries_stored_at ON cache_entries (stored_at)")
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql, params=()):
+        return self._conn().execute(sql, params)
+
+    def get(self, key):
+        try:
+            row = self._execute("SELECT value, expires_at FROM cache_entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                if row[1] > time.time():
+                    self.stats.incr('hits')
+                    return pickle.loads(row[0])
+                self._execute("DELETE FROM cache_entries WHERE key = ? AND expires_at <= ?", (key, time.time()))
+                self.stats.incr('expirations')
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            self.stats.incr('errors')
+            logger.warning(f"Shared cache read failed for {key}: {e}")
+        self.stats.incr('misses')
+        return _MISSING
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        try:
+            self._execute("INSERT OR REPLACE INTO cache_entries (key, value, expires_at, stored_at) VALUES (?, ?, ?, ?)",
+                          (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now + (ttl or self.ttl), now))
+            self.stats.incr('sets')
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self.evict(now)
+        except (sqlite3.Error, pickle.PicklingError, TypeError, AttributeError) as e:
+            self.stats.incr('errors')
+            logger.warning(f"Shared cache write failed for {key}: {e}")
+
+    def evict(self, now=None):
+        """Drops expired entries, then the oldest ones above max_entries."""
+        now = now or time.time()
+        expired = self._execute("DELETE FROM cache_entries WHERE expires_at <= ?", (now,)).rowcount
+        over = self._execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0] - self.max_entries
+        evicted = 0
+        if over > 0:
+            evicted = self._execute("DELETE FROM cache_entries WHERE key IN ("
+                                    "SELECT key FROM cache_entries ORDER BY stored_at LIMIT ?)", (over,)).rowcount
+        self.stats.incr('expirations', max(expired, 0))
+        self.stats.incr('evictions', max(evicted, 0))
+
+    def delete(self, key):
+        try:
+            self._execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Shared cache delete failed for {key}: {e}")
+
+    def clear(self):
+        self._execute("DELETE FROM cache_entries")
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+
+class TieredCache:
+    """In-process tier in front of an optional shared tier."""
+
+    # タグは値より長く保持する（期限切れになってもキャッシュが外れるだけ）
+    TAG_TTL = 7 * 24 * 3600
+
+    def __init__(self, memory, shared=None, tag_interval=1.0):
+        self.memory = memory
+        self.shared = shared
+        # 共有の段から読んだタグの保持（他のプロセスでの更新は最大 tag_interval 秒遅れて反映される）
+        self._tags = MemoryCache(maxsize=10000, ttl=tag_interval) if shared is not None and tag_interval else None
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is _MISSING and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not _MISSING:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.memory.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def _tag_store(self):
+        return self.shared if self.shared is not None else self.memory
+
+    def get_tag(self, name):
+        """
+        Current token of a version tag (created on first use). Tags are kept in
+        the shared tier only, so a bump in one process is seen by all of them.
+        """
+        if self._tags is not None:
+            token = self._tags.get(name)
+            if token is not _MISSING:
+                return token
+        token = self._tag_store().get(f"tag:{name}")
+        if token is _MISSING:
+            return self.bump_tag(name)
+        if self._tags is not None:
+            self._tags.set(name, token)
+        return token
+
+    def bump_tag(self, name):
+        """Gives the tag a new random token, so keys built from the old one are never hit again."""
+        token = uuid.uuid4().hex
+        self._tag_store().set(f"tag:{name}", token, self.TAG_TTL)
+        if self._tags is not None:
+            self._tags.set(name, token)
+        return token
+
+    def stats(self):
+        result = {'memory': dict(self.memory.stats.snapshot(), entries=len(self.memory))}
+        if self.shared is not None:
+            result['shared'] = self.shared.stats.snapshot()
+        return result
+
+
+class NullCache:
+    """Cache that never stores anything (MQUEST_CACHE=off)."""
+
+    def get(self, key):
+        return _MISSING
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def get_tag(self, name):
+        return ''
+
+    def bump_tag(self, name):
+        return ''
+
+    def stats(self):
+        return {}
+
+
+cache = TieredCache(MemoryCache())
+
+
+def configure(app):
+    """
+    Builds the cache from the app config:
+    MQUEST_CACHE ('tiered', 'memory' or 'off'), MQUEST_CACHE_PATH, MQUEST_CACHE_TTL,
+    MQUEST_CACHE_MEMORY_SIZE, MQUEST_CACHE_SHARED_SIZE and MQUEST_CACHE_TAG_INTERVAL.
+    """
+    global cache
+    mode = app.config.get('MQUEST_CACHE', 'tiered')
+    ttl = app.config.get('MQUEST_CACHE_TTL', 300)
+    if mode == 'off':
+        cache = NullCache()
+        return cache
+    memory = MemoryCache(maxsize=app.config.get('MQUEST_CACHE_MEMORY_SIZE', 1024), ttl=ttl)
+    shared = None
+    if mode == 'tiered':
+        path = app.config.get('MQUEST_CACHE_PATH') or os.path.join(app.instance_path, 'mquest_cache.db')
+        # ファイルは最初に使うときに作る。使えない場合は読み書きごとに警告してミス扱いになる
+        shared = SQLiteCache(path, max_entries=app.config.get('MQUEST_CACHE_SHARED_SIZE', 10000), ttl=ttl)
+    cache = TieredCache(memory, shared, tag_interval=app.config.get('MQUEST_CACHE_TAG_INTERVAL', 1.0))
+    return cache
+
+
+def make_key(namespace, version, args, kwargs):
+    raw = repr((version, args, sorted(kwargs.items())))
+    return f"{namespace}:{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+
+def _fill(key, fn, args, kwargs, ttl):
+    value = fn(*args, **kwargs)
+    cache.set(key, value, ttl)
+    return value
+
+
+def cached(namespace, ttl=None, version=None):
+    """
+    Caches the decorated function's return value by its arguments.
+    version(*args, **kwargs) returns the data version included in the key;
+    when it returns None the call bypasses the cache. Concurrent misses for
+    the same key are computed once (utils/single_flight.py).
+    Cached values are shared between callers and must not be mutated.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            data_version = version(*args, **kwargs) if version is not None else ''
+            if data_version is None:
+                return fn(*args, **kwargs)
+            key = make_key(namespace, data_version, args, kwargs)
+            value = cache.get(key)
+            if value is _MISSING:
+                value = flights.do(key, lambda: _fill(key, fn, args, kwargs, ttl), namespace)
+            return value
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
@@ -0,0 +1,146 @@
+# utils/catalog.py
+"""
+クエストカタログ（科目・レベル・件数・クエスト概要）のインメモリ索引。
+
+科目選択・レベル選択・クエスト一覧などのナビゲーション画面は、毎回
+SELECT DISTINCT を発行する代わりにこの索引を参照する。クエストの保存・削除・
+ID変更・インポート時には変更されたクエストだけを読み直して索引を更新する。
+"""
+import re
+import threading
+from collections import namedtuple
+
+from models import Quest
+from utils import content_snapshot
+from utils.single_flight import flights
+
+QuestSummary = namedtuple('QuestSummary', ['id', 'code', 'title', 'level', 'questname', 'world_name'])
+
+_LEVEL_RE = re.compile(r'^Lv(\d+)$')
+
+
+def level_sort_key(level):
+    """Sorts 'Lv9' before 'Lv10'; levels not in 'Lvn' form come last, alphabetically."""
+    m = _LEVEL_RE.match(level or '')
+    if m:
+        return (0, int(m.group(1)), '')
+    return (1, 0, level or '')
+
+
+def _summary_query(session):
+    # 列だけを取得する（Quest.questions を読み込まない）
+    return session.query(Quest.id, Quest.code, Quest.title, Quest.level, Quest.questname, Quest.world_name)
+
+
+class _Snapshot:
+    """Immutable view of the catalog; replaced as a whole on every change."""
+
+    def __init__(self, summaries):
+        self.summaries = summaries  # quest_id -> QuestSummary
+        # 表示用のクエストID（code）順。code 未設定のクエストは最後
+        ordered = sorted(summaries.values(), key=lambda s: (s.code is None, s.code or 0, s.id))
+        self.ordered = ordered
+
+        titles = []
+        levels = set()
+        title_levels = {}
+        by_title_level = {}
+        for s in ordered:
+            if s.title not in title_levels:
+                titles.append(s.title)
+                title_levels[s.title] = set()
+            title_levels[s.title].add(s.level)
+            levels.add(s.level)
+            by_title_level.setdefault((s.title, s.level), []).append(s)
+
+        self.titles = titles  # 最初に登場した順（code 順）
+        self.levels = sorted(levels, key=level_sort_key)
+        self.title_levels = {t: sorted(lv, key=level_sort_key) for t, lv in title_levels.items()}
+        self.by_title_level = by_title_level
+        self.counts = {key: len(v) for key, v in by_title_level.items()}
+
+
+class CatalogIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._pending = frozenset()
+        self._version = 0
+
+    def _current(self):
+        with self._lock:
+            snapshot = self._snapshot
+            pending = self._pending
+            version = self._version
+        if snapshot is not None and not pending:
+            return snapshot
+        # 同じ版の再構築が実行中なら、その結果を待って使う
+        return flights.do(f"catalog:{version}", lambda: self._rebuild(snapshot, pending, version), 'catalog')
+
+    def _rebuild(self, snapshot, pending, version):
+        with content_snapshot.reader() as session:
+            if snapshot is None:
+                rows = _summary_query(session).all()
+            else:
+                # 変更のあったクエストだけを読み直す
+                rows = _summary_query(session).filter(Quest.id.in_(pending)).all()
+        if snapshot is None:
+            summaries = {}
+        else:
+            summaries = dict(snapshot.summaries)
+            for qid in pending:
+                summaries.pop(qid, None)
+        for r in rows:
+            summaries[r.id] = QuestSummary(*r)
+        snapshot = _Snapshot(summaries)
+
+        with self._lock:
+            if version == self._version:
+                self._snapshot = snapshot
+                self._pending = frozenset()
+        return snapshot
+
+    def invalidate(self, quest_ids=None):
+        """
+        Marks quests as changed (everything when quest_ids is None).
+        The changed rows are re-read lazily on the next access, so this is
+        safe to call from an after_commit hook.
+        """
+        with self._lock:
+            self._version += 1
+            if quest_ids is None:
+                self._snapshot = None
+                self._pending = frozenset()
+            elif self._snapshot is not None:
+                self._pending = self._pending | {int(qid) for qid in quest_ids}
+
+    def titles(self):
+        """Subject keys ('math', 'english', ...) in order of first appearance."""
+        return list(self._current().titles)
+
+    def levels(self, title=None):
+        """Levels sorted numerically; restricted to one subject when title is given."""
+        snapshot = self._current()
+        if title is None:
+            return list(snapshot.levels)
+        return list(snapshot.title_levels.get(title, []))
+
+    def title_to_levels(self):
+        return {t: list(lv) for t, lv in self._current().title_levels.items()}
+
+    def count(self, title, level):
+        return self._current().counts.get((title, level), 0)
+
+    def quests(self, title=None, level=None):
+        """Quest summaries ordered by code, optionally filtered by subject and level."""
+        snapshot = self._current()
+        if title is not None and level is not None:
+            return list(snapshot.by_title_level.get((title, level), []))
+        return [s for s in snapshot.ordered
+                if (title is None or s.title == title) and (level is None or s.level == level)]
+
+    def get(self, quest_id):
+        return self._current().summaries.get(quest_id)
+
+
+catalog = CatalogIndex()
@@ -0,0 +1,142 @@
+# utils/content_snapshot.py
+"""
+コンテンツDB（quests / questions）の読み取り専用インメモリスナップショット。
+
+MQUEST_CONTENT_SNAPSHOT を有効にすると、生徒向けの読み取り（問題キャッシュ・
+カタログ索引の読み込み）はディスク上の mquest_content.db ではなく、SQLite の
+バックアップ API でメモリ上（共有キャッシュのインメモリDB）に複製した
+スナップショットから行う。スナップショットの接続は query_only で開く。
+
+管理者がコンテンツを変更してコミットすると invalidate() が呼ばれ、次の読み取り時に
+新しいスナップショットを作成して丸ごと差し替える。差し替え前に開始した読み取りは
+古いスナップショットのまま完了し、古いスナップショットは読み取りがなくなった時点で閉じる。
+"""
+import itertools
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+from models import db
+
+_names = itertools.count(1)
+
+
+class _Generation:
+    """One immutable in-memory copy; kept alive by its keeper connection."""
+
+    def __init__(self, source_path):
+        self.name = f"file:mquest_content_snapshot_{os.getpid()}_{next(_names)}?mode=memory&cache=shared"
+        self.keeper = sqlite3.connect(self.name, uri=True, check_same_thread=False)
+        source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True)
+        try:
+            source.backup(self.keeper)
+        finally:
+            source.close()
+        self.engine = create_engine('sqlite://', creator=self._connect, poolclass=QueuePool,
+                                    pool_size=5, max_overflow=20)
+        self.readers = 0
+        self.retired = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.name, uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def close(self):
+        self.engine.dispose()
+        self.keeper.close()
+
+
+class ContentSnapshot:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._current = None
+        self._stale = True
+        self.generations = 0
+
+    def invalidate(self):
+        """Marks the snapshot outdated; the next reader builds and swaps in a new one."""
+        with self._lock:
+            self._stale = True
+
+    def acquire(self):
+        """The current generation (building it first if outdated), pinned until release()."""
+        with self._lock:
+            if not self._stale:
+                self._current.readers += 1
+                return self._current
+        with self._build_lock:
+            with self._lock:
+                if not self._stale:
+                    self._current.readers += 1
+                    return self._current
+                # 作成中にコミットされた変更は次回の作成で取り込まれる
+                self._stale = False
+            try:
+                generation = _Generation(db.engines['content'].url.database)
+            except Exception:
+                with self._lock:
+                    self._stale = True
+                raise
+            with self._lock:
+                previous, self._current = self._current, generation
+                generation.readers += 1
+                self.generations += 1
+            if previous is not None:
+                self._retire(previous)
+            return generation
+
+    def release(self, generation):
+        with self._lock:
+            generation.readers -= 1
+            close = generation.retired and generation.readers == 0
+        if close:
+            generation.close()
+
+    def _retire(self, generation):
+        # 読み取り中のセッションがなくなった時点で閉じる
+        with self._lock:
+            generation.retired = True
+            close = generation.readers == 0
+        if close:
+            generation.close()
+
+    def close(self):
+        with self._lock:
+            previous, self._current = self._current, None
+            self._stale = True
+        if previous is not None:
+            self._retire(previous)
+
+
+snapshot = ContentSnapshot()
+
+
+def enabled():
+    return bool(current_app.config.get('MQUEST_CONTENT_SNAPSHOT'))
+
+
+@contextmanager
+def reader():
+    """
+    Session for reading quests/questions: a short-lived session on the in-memory
+    snapshot when MQUEST_CONTENT_SNAPSHOT is on, otherwise db.session.
+    Objects loaded from the snapshot are detached once the block exits.
+    """
+    if not enabled():
+        yield db.session
+        return
+    generation = snapshot.acquire()
+    session = Session(bind=generation.engine)
+    try:
+        yield session
+    finally:
+        session.close()
+        snapshot.release(generation)
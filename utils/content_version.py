@@ -0,0 +1,122 @@
+# utils/content_version.py
+"""
+複数プロセス（ワーカー）間でのコンテンツキャッシュの無効化。
+
+quests / questions が変更されるとトリガーで content_version.version が増える
+（models.ContentVersion）。各プロセスはリクエストの開始時にこの値を確認し、
+前回から変わっていれば自プロセスのキャッシュ（問題キャッシュ・カタログ索引・
+コンテンツのスナップショット）を破棄する。確認は一定間隔に1回だけ行い、
+それ以外のリクエストでは時刻の比較だけで済ませる。
+"""
+import logging
+import threading
+import time
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import OperationalError
+
+from models import db, CONTENT_VERSION_TRIGGERS
+
+logger = logging.getLogger(__name__)
+
+
+def read_version():
+    """Current content version, or None when the content_version table does not exist."""
+    try:
+        with db.engines['content'].connect() as conn:
+            return conn.execute(text("SELECT version FROM content_version WHERE id = 1")).scalar()
+    except OperationalError:
+        return None
+
+
+def install():
+    """Creates the content_version row and triggers on an existing content DB (idempotent)."""
+    with db.engines['content'].begin() as conn:
+        conn.execute(text("INSERT OR IGNORE INTO content_version (id, version) VALUES (1, 0)"))
+        for trigger in CONTENT_VERSION_TRIGGERS:
+            conn.execute(text(trigger))
+
+
+def ensure_installed():
+    """
+    Installs the triggers when content_version exists without them (create_all()
+    on an existing content DB creates only the table). Returns False when they
+    could not be installed.
+    """
+    names = [trigger.split()[5] for trigger in CONTENT_VERSION_TRIGGERS]
+    try:
+        with db.engines['content'].connect() as conn:
+            found = conn.execute(text(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN :names"
+            ).bindparams(bindparam('names', expanding=True)), {'names': names}).scalar()
+        if found < len(names):
+            install()
+            logger.info("Installed the content_version triggers.")
+        return True
+    except OperationalError as e:
+        logger.warning(f"Installing the content_version triggers failed: {e}")
+        return False
+
+
+class VersionWatcher:
+    def __init__(self, on_change, interval=1.0):
+        self.on_change = on_change
+        self.interval = interval
+        self._lock = threading.Lock()
+        # キャッシュの破棄中は新しいバージョンを読ませない（古い内容が新しいキーで共有キャッシュに入るため）
+        self._refresh_lock = threading.RLock()
+        self._seen = None
+        self._checked_at = float('-inf')
+        self._missing_logged = False
+        self._installed = False
+        self.checks = 0
+        self.changes = 0
+
+    @property
+    def version(self):
+        """
+        Last content version read (None before the first check or without the table).
+        Waits while the caches of a newer version are being invalidated.
+        """
+        with self._refresh_lock:
+            return self._seen
+
+    def expire(self):
+        """Makes the next check() read the version regardless of the interval."""
+        with self._lock:
+            self._checked_at = float('-inf')
+
+    def check(self):
+        """
+        Reads the content version (at most once per interval) and calls
+        on_change() when another process, or this one, changed the content.
+        Returns True when the caches were invalidated.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.interval:
+                return False
+            self._checked_at = now
+        version = read_version()
+        if version is not None and not self._installed:
+            # トリガーが無いと値が変わらず、古いキャッシュが使われ続けるため、バージョンとして扱わない
+            self._installed = ensure_installed()
+            if not self._installed:
+                version = None
+        if version is None:
+            if not self._missing_logged:
+                self._missing_logged = True
+                logger.warning("content_version table or its triggers are missing; run scripts/install_content_version.py "
+                               "to enable cross-process cache invalidation.")
+            return False
+        with self._refresh_lock:
+            with self._lock:
+                self.checks += 1
+                changed = self._seen is not None and self._seen != version
+                if changed:
+                    self.changes += 1
+            if changed:
+                self.on_change()
+            # キャッシュを破棄した後で新しいバージョンを公開する
+            self._seen = version
+        return changed
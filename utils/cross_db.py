@@ -0,0 +1,86 @@
+# utils/cross_db.py
+"""
+ユーザーDBとコンテンツDBにまたがるクエスト削除。
+
+ユーザーDBの接続にコンテンツDBを ATTACH し、対象のクエストIDを入れた一時テーブルを
+使った集合演算の DELETE を1つのトランザクションで実行する。対象のクエスト数に
+関係なく、テーブルごとに1文で済む。
+
+注意: WAL モードでは、ATTACH した複数DBへの変更はエラー時のロールバックでは
+まとめて取り消されるが、電源断などのクラッシュに対してはDBファイルごとに原子的になる
+（SQLite の仕様）。
+"""
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+CONTENT_SCHEMA = 'content'
+
+# quest_id 列を持つユーザーDBのテーブル
+USER_QUEST_TABLES = ('quest_attempt_logs', 'attempt_answers', 'quest_history', 'user_progress', 'quest_results')
+# (テーブル, 列) コンテンツDB側。questions を先に削除する
+CONTENT_QUEST_COLUMNS = (('questions', 'quest_id'), ('quests', 'id'))
+
+
+@contextmanager
+def unit_of_work(user_engine, content_engine):
+    """
+    Yields a connection of user_engine with the content DB attached as 'content'
+    and an empty temp table temp.quest_ids(id), inside a write transaction
+    (BEGIN IMMEDIATE on both files). Commits on success, rolls back on error.
+    """
+    content_path = content_engine.url.database
+    with user_engine.connect() as conn:
+        conn.exec_driver_sql(f"ATTACH DATABASE ? AS {CONTENT_SCHEMA}", (content_path,))
+        try:
+            conn.exec_driver_sql(
+                "CREATE TEMP TABLE quest_ids (id INTEGER PRIMARY KEY)"
+            )
+            try:
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+                try:
+                    yield conn
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+            finally:
+                conn.exec_driver_sql("DROP TABLE temp.quest_ids")
+                conn.commit()
+        finally:
+            conn.exec_driver_sql(f"DETACH DATABASE {CONTENT_SCHEMA}")
+            conn.commit()
+
+
+def _load_ids(conn, quest_ids):
+    conn.execute(text("INSERT INTO temp.quest_ids (id) VALUES (:id)"), [{'id': qid} for qid in quest_ids])
+
+
+def _tables():
+    for table in USER_QUEST_TABLES:
+        yield f"main.{table}", 'quest_id'
+    for table, column in CONTENT_QUEST_COLUMNS:
+        yield f"{CONTENT_SCHEMA}.{table}", column
+
+
+def delete_quests(conn, quest_ids):
+    """
+    Deletes quests, their questions and all user records of them (history,
+    progress, attempt logs and answers, stored results). Ids that do not exist are ignored.
+    Returns (deleted_ids, groups) where groups is the set of (title, level)
+    of the deleted quests.
+    """
+    quest_ids = sorted({int(q) for q in quest_ids})
+    if not quest_ids:
+        return [], set()
+    _load_ids(conn, quest_ids)
+    conn.exec_driver_sql(
+        f"DELETE FROM temp.quest_ids WHERE id NOT IN (SELECT id FROM {CONTENT_SCHEMA}.quests)"
+    )
+    deleted_ids = [r[0] for r in conn.exec_driver_sql("SELECT id FROM temp.quest_ids ORDER BY id")]
+    groups = {tuple(r) for r in conn.exec_driver_sql(
+        f"SELECT DISTINCT title, level FROM {CONTENT_SCHEMA}.quests WHERE id IN (SELECT id FROM temp.quest_ids)"
+    )}
+    for table, column in _tables():
+        conn.exec_driver_sql(f"DELETE FROM {table} WHERE {column} IN (SELECT id FROM temp.quest_ids)")
+    return deleted_ids, groups
@@ -0,0 +1,231 @@
+# utils/exporter.py
+"""
+クエスト・問題のエクスポート（管理画面の「JSONエクスポート」と scripts/export_quests.py で共用）。
+
+- クエストと問題を JOIN した1本のクエリを先頭から順に読み、クエストごとにレコードを作る。
+  対象のクエスト数に関係なくクエリは1回で、全件を一度にメモリに載せない。
+- 出力はチャンク（bytes）のジェネレーターで、Flask の Response にそのまま渡せる。
+  JSON（従来と同じ indent=4 の形式）、NDJSON（1行1レコード）、gzip、zip に対応する。
+"""
+import json
+import textwrap
+import zipfile
+import zlib
+from itertools import groupby
+
+from sqlalchemy import text
+
+# 形式 -> (拡張子, MIMEタイプ)
+FORMATS = {
+    'json': ('.json', 'application/json'),
+    'ndjson': ('.ndjson', 'application/x-ndjson'),
+    'json.gz': ('.json.gz', 'application/gzip'),
+    'ndjson.gz': ('.ndjson.gz', 'application/gzip'),
+    'zip': ('.zip', 'application/zip'),
+}
+
+_QUERY = """
+    SELECT q.id, q.code, q.title, q.level, q.questname, q.world_name,
+           qs.id AS question_id, qs.position, qs.type, qs.text, qs.explanation, qs.choices, qs.answer
+    FROM quests AS q
+    LEFT JOIN questions AS qs ON qs.quest_id = q.id
+    {where}
+    ORDER BY q.code, q.id, qs.position, qs.id
+"""
+
+# answer を JSON として読まない（文字列のまま出力する）問題形式（quests.json 形式）
+_PLAIN_ANSWER_TYPES = ('choice', 'multiple_choice', 'sort', 'fill_in_the_blank_en')
+
+
+def iter_quests(engine, quest_ids=None, yield_per=500):
+    """
+    Yields (quest, questions) in code order, where quest is a row of the quests
+    table and questions the list of its question rows in position order.
+    quest_ids restricts the export to those internal ids (None = every quest).
+    Runs a single query on its own connection of the content engine, so it can
+    be consumed after the request (or app) context has ended.
+    """
+    # 引数の検証はここで行い、クエリは読み出しが始まってから実行する
+    params = {}
+    where = ''
+    if quest_ids is not None:
+        where = "WHERE q.id IN (SELECT value FROM json_each(:ids))"
+        params['ids'] = json.dumps([int(qid) for qid in quest_ids])
+    return _iter_groups(engine, text(_QUERY.format(where=where)), params, yield_per)
+
+
+def _iter_groups(engine, query, params, yield_per):
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=yield_per).execute(query, params)
+        for _, rows in groupby(result, key=lambda r: r.id):
+            rows = list(rows)
+            yield rows[0], [r for r in rows if r.question_id is not None]
+
+
+def _loads(raw):
+    try:
+        return json.loads(raw) if raw else None
+    except (json.JSONDecodeError, TypeError):
+        return raw
+
+
+def records(quests):
+    """
+    Records of the admin export (and import) layout: a 'quest' record followed
+    by its 'question' records. id / quest_id are the quest code.
+    """
+    for quest, questions in quests:
+        yield {
+            'record_type': 'quest',
+            'id': quest.code,
+            'title': quest.title,
+            'level': quest.level,
+            'questname': quest.questname
+        }
+        for q in questions:
+            yield {
+                'record_type': 'question',
+                'id': q.question_id,
+                'quest_id': quest.code,
+                'position': q.position,
+                'type': q.type,
+                'text': q.text,
+                'explanation': q.explanation,
+                'choices': _loads(q.choices),
+                'answer': _loads(q.answer),
+            }
+
+
+def quests_json_items(quests, subject_names):
+    """
+    (key, value) items of the quests.json layout ({"101": {..., "questions": [...]}}),
+    keyed by quest code. subject_names maps subject keys to the Japanese names.
+    """
+    for quest, questions in quests:
+        quest_data = {
+            "questname": quest.questname,
+            "level": quest.level,
+            "subject": subject_names.get(quest.title, quest.title),  # titleを日本語のsubjectに変換
+            "world_name": quest.world_name,
+            "questions": []
+        }
+        for q in questions:
+            question_data = {
+                "type": q.type,
+                "text": q.text,
+                "explanation": q.explanation
+            }
+            choices = _loads(q.choices)
+            # これらのタイプの answer は文字列なので、loads しない
+            answer = q.answer if q.type in _PLAIN_ANSWER_TYPES else _loads(q.answer)
+
+            # quests.jsonのフォーマットに合わせてキーを調整
+            if q.type == 'choice' or q.type == 'multiple_choice':
+                question_data['choices'] = choices
+                question_data['answer'] = answer
+            elif q.type == 'numeric':
+                question_data['answers'] = answer
+            elif q.type == 'sort' or q.type == 'fill_in_the_blank_en':
+                question_data['answer'] = answer
+            elif q.type == 'svg_interactive':
+                question_data['svg_content'] = choices  # choicesフィールドにSVGコンテンツが格納されている
+                question_data['sub_questions'] = answer  # answerフィールドにサブ問題が格納されている
+            else:  # フォールバック
+                question_data['choices'] = choices
+                question_data['answer'] = answer
+            quest_data["questions"].append(question_data)
+        yield str(quest.code), quest_data
+
+
+def iter_json(items, keyed=False):
+    """
+    Text chunks of a JSON array (or object when keyed=True and items are
+    (key, value) pairs), byte-identical to json.dumps(..., indent=4, ensure_ascii=False).
+    """
+    open_, close = ('{', '}') if keyed else ('[', ']')
+    first = True
+    for item in items:
+        if keyed:
+            key, value = item
+            body = json.dumps(key, ensure_ascii=False) + ': ' + json.dumps(value, indent=4, ensure_ascii=False)
+        else:
+            body = json.dumps(item, indent=4, ensure_ascii=False)
+        yield (open_ + '\n' if first else ',\n') + textwrap.indent(body, '    ')
+        first = False
+    yield open_ + close if first else '\n' + close
+
+
+def iter_ndjson(items, keyed=False):
+    """Text chunks of NDJSON. With keyed=True the key is stored as the record's 'id'."""
+    for item in items:
+        if keyed:
+            key, value = item
+            item = dict(id=key, **value)
+        yield json.dumps(item, ensure_ascii=False) + '\n'
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip ヘッダー付き
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _Sink:
+    """Write-only buffer for zipfile on a non-seekable stream."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def _zip(chunks, member_name):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        with zf.open(member_name, 'w', force_zip64=True) as member:
+            for chunk in chunks:
+                member.write(chunk)
+                data = sink.drain()
+                if data:
+                    yield data
+    yield sink.drain()
+
+
+def encode(items, fmt, keyed=False, member_name='quests.json'):
+    """
+    Byte chunks of items in the given format (a key of FORMATS).
+    'zip' stores the JSON layout as member_name in the archive.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"未対応のエクスポート形式です: {fmt}")
+    if fmt.startswith('ndjson'):
+        chunks = (chunk.encode('utf-8') for chunk in iter_ndjson(items, keyed))
+    else:
+        chunks = (chunk.encode('utf-8') for chunk in iter_json(items, keyed))
+    if fmt.endswith('.gz'):
+        return _gzip(chunks)
+    if fmt == 'zip':
+        return _zip(chunks, member_name)
+    return chunks
+
+
+def filename(name, fmt):
+    """Replaces a known export extension of name with the one of fmt."""
+    for ext, _ in sorted(FORMATS.values(), key=lambda v: -len(v[0])):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return name + FORMATS[fmt][0]
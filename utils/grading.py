@@ -0,0 +1,244 @@
+# utils/grading.py
+"""
+問題形式ごとの採点（quest_result と一括採点で共用）。
+
+- 問題ごとに、正解を採点しやすい形（正規化した文字列・集合・小問ごとの正解の並び）に
+  あらかじめ変換した「答えのキー」を作る（compile_question）。answer / choices の JSON の
+  パースや正解の正規化は、キーを作るときに一度だけ行う。
+- キーは問題ビューモデルと同じく utils/question_cache.py がクエストごとにキャッシュし、
+  コンテンツの変更（保存・インポート・他プロセスでの変更）で作り直される。
+- 採点は「フォームから解答を取り出す（extract）」と「解答を判定する（check）」の2段階で、
+  保存した解答をフォーム無しで再採点することもできる。
+"""
+import json
+from collections import namedtuple
+
+from werkzeug.datastructures import MultiDict
+
+# question_id, type, data（形式ごとの正解）
+AnswerKey = namedtuple('AnswerKey', 'question_id type data')
+
+_GRADERS = {}
+
+
+def register(*types):
+    """Class decorator registering a grader (an instance of the class) for the given question types."""
+    def decorator(cls):
+        for question_type in types:
+            _GRADERS[question_type] = cls()
+        return cls
+    return decorator
+
+
+def _loads(raw):
+    try:
+        return json.loads(raw)
+    except (json.JSONDecodeError, TypeError):
+        return raw
+
+
+def _load_list(raw):
+    try:
+        value = json.loads(raw) if raw else []
+    except (json.JSONDecodeError, TypeError):
+        return []
+    return value if isinstance(value, list) else []
+
+
+class Grader:
+    """Fallback for unknown types: every answer is wrong, nothing is shown."""
+
+    def compile(self, q):
+        return None
+
+    def extract(self, data, form, index):
+        """The student's answer of the question at index from the submitted form."""
+        return ''
+
+    def check(self, data, answer):
+        """Returns (correct, user_answer, expected) for the result screen."""
+        return False, '', ''
+
+
+@register('choice')
+class ChoiceGrader(Grader):
+    def compile(self, q):
+        return _loads(q.answer)
+
+    def extract(self, data, form, index):
+        return form.get(f'q{index}', '').strip()
+
+    def check(self, data, answer):
+        return answer == data, answer, data
+
+
+@register('multiple_choice')
+class MultipleChoiceGrader(Grader):
+    def compile(self, q):
+        # DBの答えはカンマ区切りの文字列。並べ替えて比較する
+        try:
+            correct_answers = sorted(ans.strip() for ans in q.answer.split(','))
+        except AttributeError:
+            correct_answers = []
+        return tuple(correct_answers), ','.join(correct_answers)
+
+    def extract(self, data, form, index):
+        return form.getlist(f'q{index}')
+
+    def check(self, data, answer):
+        correct_answers, expected = data
+        user_answers = sorted(answer)
+        return tuple(user_answers) == correct_answers, ','.join(user_answers), expected
+
+
+def _normalize_sentence(value):
+    # 句読点の前のスペースを削除して正規化
+    return value.replace(" .", ".").replace(" ,", ",").replace(" ?", "?").replace(" !", "!").lower()
+
+
+@register('sort')
+class SortGrader(Grader):
+    def compile(self, q):
+        correct_answer = _loads(q.answer)
+        if isinstance(correct_answer, str):
+            correct_answer = correct_answer.strip()
+        return _normalize_sentence(str(correct_answer)), correct_answer
+
+    def extract(self, data, form, index):
+        return form.get(f'q{index}', '').strip()
+
+    def check(self, data, answer):
+        normalized, expected = data
+        return _normalize_sentence(answer) == normalized, answer, expected
+
+
+@register('fill_in_the_blank_en')
+class FillInTheBlankGrader(Grader):
+    def compile(self, q):
+        correct_answers_raw = _loads(q.answer)
+        # カンマ区切りの複数の正解のどれかと一致すれば正解（大文字・小文字は区別しない）
+        if correct_answers_raw:
+            correct_answers = frozenset(ans.strip().lower() for ans in str(correct_answers_raw).split(','))
+        else:
+            correct_answers = frozenset()
+        return correct_answers, correct_answers_raw  # 結果画面にはすべての正解を表示する
+
+    def extract(self, data, form, index):
+        return form.get(f'q{index}', '').strip()
+
+    def check(self, data, answer):
+        correct_answers, expected = data
+        answer = answer.lower()
+        return answer in correct_answers, answer, expected
+
+
+class SubQuestionGrader(Grader):
+    """
+    Types made of sub-questions. data is a tuple of (field suffix, label, expected)
+    per sub-question; the answer is the list of submitted values in the same order.
+    """
+
+    def sub_questions(self, q):
+        return _load_list(q.answer)
+
+    def compile(self, q):
+        return tuple(
+            (str(i), sub_q.get('prompt', ''), str(sub_q.get('answer', '')).strip())
+            for i, sub_q in enumerate(self.sub_questions(q)) if isinstance(sub_q, dict)
+        )
+
+    def extract(self, data, form, index):
+        return [form.get(f'q{index}_{suffix}', '').strip() for suffix, _, _ in data]
+
+    def check(self, data, answer):
+        answer = list(answer) + [''] * (len(data) - len(answer))
+        user_answers = [{label: value} for (_, label, _), value in zip(data, answer)]
+        expected = [{label: expected_val} for _, label, expected_val in data]
+        # 正解のデータが壊れていて小問が1つも無い問題は、どの解答でも不正解にする
+        correct = bool(data) and all(value == expected_val for (_, _, expected_val), value in zip(data, answer))
+        return correct, user_answers, expected
+
+
+@register('svg_interactive')
+class SvgInteractiveGrader(SubQuestionGrader):
+    def compile(self, q):
+        # フォームの項目名には小問の id を使う
+        return tuple(
+            (str(sub_q.get('id', '')), sub_q.get('prompt', ''), str(sub_q.get('answer', '')).strip())
+            for sub_q in self.sub_questions(q) if isinstance(sub_q, dict)
+        )
+
+
+@register('figure_choice', 'function_graph_choice')
+class FigureChoiceGrader(SubQuestionGrader):
+    pass
+
+
+@register('function_graph')
+class FunctionGraphGrader(SubQuestionGrader):
+    def sub_questions(self, q):
+        # function_graph は小問（問題文と正解）を choices に保存している
+        return _load_list(q.choices)
+
+
+@register('numeric')
+class NumericGrader(SubQuestionGrader):
+    def compile(self, q):
+        return tuple(
+            (str(i), ans.get('label', ''), str(ans.get('answer', '')).strip())
+            for i, ans in enumerate(self.sub_questions(q)) if isinstance(ans, dict)
+        )
+
+
+_FALLBACK = Grader()
+
+
+def grader_for(question_type):
+    return _GRADERS.get(question_type, _FALLBACK)
+
+
+def compile_question(q):
+    """Compiles a Question (or any object with id, type, answer, choices) into an AnswerKey."""
+    return AnswerKey(q.id, q.type, grader_for(q.type).compile(q))
+
+
+def extract_answers(keys, form):
+    """
+    The student's answers to each question, in question order, from the submitted
+    form (q{index} / q{index}_{sub} fields). form is a MultiDict or a plain dict
+    (list values for multiple_choice).
+    """
+    if not isinstance(form, MultiDict):
+        form = MultiDict(form)
+    return [grader_for(key.type).extract(key.data, form, i) for i, key in enumerate(keys)]
+
+
+def check(key, answer):
+    """Grades one extracted answer: {'question_id', 'user_answer', 'correct', 'type', 'expected'}."""
+    correct, user_answer, expected = grader_for(key.type).check(key.data, answer)
+    return {
+        'question_id': key.question_id,
+        'user_answer': user_answer,
+        'correct': correct,
+        'type': key.type,
+        'expected': expected,
+    }
+
+
+def grade(keys, form):
+    """Grades one submitted form against the answer keys of a quest (in question order)."""
+    return [check(key, answer) for key, answer in zip(keys, extract_answers(keys, form))]
+
+
+def grade_many(keys, forms):
+    """
+    Grades many submissions of the same quest (e.g. a whole class) with one set
+    of answer keys. Returns one {'results', 'score', 'total', 'all_correct'} per form.
+    """
+    graded = []
+    for form in forms:
+        results = grade(keys, form)
+        score = sum(1 for r in results if r['correct'])
+        graded.append({'results': results, 'score': score, 'total': len(results),
+                       'all_correct': score == len(results)})
+    return graded
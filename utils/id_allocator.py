@@ -0,0 +1,49 @@
+# utils/id_allocator.py
+"""
+問題IDなどの採番（id_sequences テーブル、コンテンツDB）。
+
+ID をまとめて払い出す。件数に関係なく UPSERT 1文で、行ごとの MAX() 問い合わせや
+flush は不要になる。払い出す値は、明示的なIDで登録された既存の行
+（インポートなど）とも重ならないよう、テーブルの現在の最大ID以降に揃える。
+"""
+from sqlalchemy import text
+
+from models import db
+
+# 採番の名前 -> 対象のテーブル（主キー列は id）
+SEQUENCES = {
+    'questions': 'questions',
+    'quests': 'quests',
+}
+
+
+def allocate(name, count=1, session=None, conn=None):
+    """
+    Reserves `count` consecutive ids for `name` and returns them as a range.
+    Runs in the current transaction of the session (db.session by default)
+    or of `conn` (a Connection of the content engine), so a rollback also
+    returns the ids.
+    """
+    if count <= 0:
+        return range(0)
+    table = SEQUENCES[name]
+    # 行が無い場合はテーブルの最大ID+1から始める
+    floor = f"(SELECT COALESCE(MAX(id), 0) + 1 FROM {table})"
+    statement = text(
+        f"INSERT INTO id_sequences (name, next_value) VALUES (:name, {floor} + :count) "
+        f"ON CONFLICT (name) DO UPDATE SET next_value = MAX(id_sequences.next_value, {floor}) + :count "
+        f"RETURNING next_value"
+    )
+    params = {'name': name, 'count': count}
+    if conn is not None:
+        next_value = conn.execute(statement, params).scalar_one()
+    else:
+        session = session or db.session
+        next_value = session.execute(
+            statement, params, bind_arguments={'bind': db.engines['content']}
+        ).scalar_one()
+    return range(next_value - count, next_value)
+
+
+def allocate_one(name, session=None):
+    return allocate(name, 1, session)[0]
@@ -0,0 +1,663 @@
+# utils/importer.py
+"""
+クエスト・問題の一括インポート。
+
+- アップロードされたJSONを先頭から少しずつ読み、レコード（クエスト1件、または問題1件）
+  ごとに取り出す。ファイル全体を json.loads しないため、メモリ使用量はファイルの
+  大きさではなく1レコード（とバッチ）の大きさで決まる。
+- 一定件数ごとのバッチで、既存のクエスト・問題をまとめて IN 句で読み込み、
+  executemany の UPSERT でまとめて書き込み、バッチごとにコミットする。
+- フェーズ（読み込み・既存データの取得・書き込み・コミット）ごとの所要時間と件数を記録する。
+
+対応する形式は従来のインポートと同じ（quests.json 形式の {"101": {...}}、
+エクスポートしたレコードの配列、クエストに問題を入れ子にした配列）と、1行1レコードの NDJSON。
+"""
+import hashlib
+import json
+import time
+
+from sqlalchemy import text
+
+from utils import id_allocator
+
+_WHITESPACE = ' \t\r\n'
+
+
+class _Reader:
+    """Incremental reader over a text stream for iter_json_records."""
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character ('' at the end of the stream)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"JSONの形式が正しくありません（'{char}' が必要な位置: {self.pos}）")
+        self.pos += 1
+
+    def value(self, decoder):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+                # 値がバッファの終わりで切れている可能性がある場合は読み足す
+                # （数値は "2." のように途中まででも読めてしまうため、区切り文字まで確認する）
+                complete = end < len(self.buf) and (
+                    not isinstance(value, (int, float)) or self.buf[end] in _WHITESPACE + ',]}'
+                )
+                if complete or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_json_records(fp, ndjson=False, chunk_size=64 * 1024):
+    """
+    Yields (key, value) for every element of the top-level JSON container read
+    from the text stream fp: key is the member name for an object ({"101": {...}})
+    and None for an array or for NDJSON (one value per line).
+    Only the current element is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    reader = _Reader(fp, chunk_size)
+    first = reader.peek()
+    if ndjson or first not in ('[', '{'):
+        while reader.peek():
+            yield None, reader.value(decoder)
+        return
+
+    closing = ']' if first == '[' else '}'
+    reader.pos += 1
+    if reader.peek() == closing:
+        reader.pos += 1
+        return
+    while True:
+        key = None
+        if closing == '}':
+            key = reader.value(decoder)
+            reader.expect(':')
+        yield key, reader.value(decoder)
+        if reader.peek() == ',':
+            reader.pos += 1
+            continue
+        reader.expect(closing)
+        return
+
+
+def normalize_records(records):
+    """
+    Converts raw (key, value) records into ('quest', dict) / ('question', dict) items,
+    with the same detection rules as the original importer: 'record_type' if present,
+    otherwise by the fields; nested 'questions' lists are flattened after their quest,
+    and questions without a quest reference belong to the preceding quest.
+    """
+    context = {'last_quest_id': None, 'temp_ids': 0}
+
+    def process_entry(row, inherited_quest_id=None):
+        if not isinstance(row, dict):
+            return
+        rec_type = row.get('record_type')
+        if not rec_type:
+            if 'questname' in row or 'subject' in row:
+                rec_type = 'quest'
+            elif 'text' in row and 'type' in row:
+                rec_type = 'question'
+            elif 'questions' in row and isinstance(row['questions'], list):
+                rec_type = 'quest'
+
+        if rec_type == 'quest':
+            q_id = row.get('id')
+            # Assign a temporary ID if no ID is present, to link nested questions
+            if not q_id:
+                context['temp_ids'] += 1
+                q_id = f"_temp_quest_{context['temp_ids']}"
+            context['last_quest_id'] = q_id
+            yield 'quest', {
+                'id': q_id,
+                'title': row.get('title') or row.get('subject'),
+                'level': row.get('level'),
+                'questname': row.get('questname'),
+                'world_name': row.get('world_name'),
+            }
+            if isinstance(row.get('questions'), list):
+                for q_row in row['questions']:
+                    yield from process_entry(q_row, inherited_quest_id=q_id)
+
+        elif rec_type == 'question':
+            # Link to quest: explicit > inherited > flat list context
+            quest_id = (row.get('quest_id') or row.get('questId') or row.get('quest')
+                        or inherited_quest_id or context['last_quest_id'])
+            q_data = {
+                'id': row.get('id'),
+                'quest_id': quest_id,
+                'questname': row.get('questname'),
+                'type': row.get('type'),
+                'text': row.get('text'),
+                'explanation': row.get('explanation'),
+                'choices': row.get('choices'),
+                'answer': row.get('answer'),
+                'position': row.get('position'),
+            }
+            # Flexible mapping for special types and field names
+            if q_data['type'] == 'numeric' and 'answers' in row:
+                q_data['answer'] = row['answers']
+            elif q_data['type'] in ('svg_interactive', 'figure_choice'):
+                if 'svg_content' in row:
+                    q_data['choices'] = row['svg_content']
+                if 'sub_questions' in row:
+                    q_data['answer'] = row['sub_questions']
+            yield 'question', q_data
+
+    for key, row in records:
+        # quests.json 形式: { "101": { ... } } のキーをIDとして使う
+        if key is not None and isinstance(row, dict) and 'id' not in row:
+            try:
+                row['id'] = int(key)
+            except ValueError:
+                row['id'] = key
+        yield from process_entry(row)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def _in_chunks(values, size=500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _as_text(value):
+    if value is not None and not isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def content_hash(*values):
+    """
+    Stable hash of a row's payload (the column values as stored).
+    Quests hash (title, level, questname, world_name); questions hash
+    (quest_id, type, text, choices, answer, explanation). A question's position
+    is compared separately, so reordering does not change its hash.
+    """
+    payload = json.dumps(values, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _quest_hash(row):
+    return content_hash(row['title'], row['level'], row['questname'], row['world_name'])
+
+
+def _question_hash(row):
+    return content_hash(row['quest_id'], row['type'], row['text'], row['choices'],
+                        row['answer'], row['explanation'])
+
+
+class ImportStats:
+    """Row counts and per-phase timings (seconds) of an import run."""
+
+    PHASES = ('parse', 'prefetch', 'write', 'commit')
+
+    def __init__(self):
+        self.counts = {
+            'quests_inserted': 0, 'quests_updated': 0, 'quests_unchanged': 0, 'quests_orphaned': 0,
+            'questions_inserted': 0, 'questions_updated': 0, 'questions_unchanged': 0,
+            'questions_orphaned': 0, 'questions_skipped': 0,
+            'batches': 0,
+        }
+        self.timings = {phase: 0.0 for phase in self.PHASES}
+
+    def as_dict(self):
+        return {'counts': dict(self.counts), 'timings': {k: round(v, 3) for k, v in self.timings.items()}}
+
+
+class ImportEngine:
+    """
+    Imports normalized records into the content DB in batches of batch_size
+    records, each batch in its own transaction (a failed batch is rolled back;
+    earlier batches stay committed).
+
+    Rows whose content_hash matches the stored one are not written. With
+    dry_run=True nothing is written at all and the counts report what an
+    import would do. Orphaned rows are those in the DB that the file does
+    not contain (they are counted, never deleted).
+
+    After run(): changed_quest_ids holds the quests whose quest row or
+    questions were written, affected_groups every (title, level) whose quest
+    count may have changed and regrouped_quest_ids the existing quests that
+    moved to another subject/level (their students' rollups must be rebuilt).
+    """
+
+    def __init__(self, content_engine, subject_keys=None, batch_size=500, retry=None, dry_run=False):
+        self.engine = content_engine
+        self.subject_keys = subject_keys or {}
+        self.batch_size = batch_size
+        # retry(fn, site): 一時的なエラーでバッチをやり直す（例: RetryPolicy.call）
+        self.retry = retry or (lambda fn, site: fn())
+        self.dry_run = dry_run
+        self.stats = ImportStats()
+        self.quest_ids = {}     # JSON のクエストID（code）-> 内部ID
+        self.quest_names = {}   # questname -> 内部ID
+        self.next_positions = {}  # quest_id -> 次に追加する問題の position
+        self.changed_quest_ids = set()
+        self.affected_groups = set()
+        self.regrouped_quest_ids = set()
+        self._seen_quests = set()     # ファイルに含まれていた行の内部ID（孤立行の集計用）
+        self._seen_questions = set()
+        self._dry_run_ids = 0
+
+    def run(self, items, progress=None):
+        """
+        Imports items from normalize_records(). progress(stats) is called after
+        every committed batch. Returns the ImportStats.
+        """
+        items = iter(items)
+        while True:
+            started = time.perf_counter()
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+            self.stats.timings['parse'] += time.perf_counter() - started
+            if not batch:
+                break
+            self.retry(lambda: self._import_batch(batch), 'import:batch')
+            self.stats.counts['batches'] += 1
+            if progress is not None:
+                progress(self.stats)
+        self._count_orphans()
+        return self.stats
+
+    def _count_orphans(self):
+        started = time.perf_counter()
+        with self.engine.connect() as conn:
+            self.stats.counts['quests_orphaned'] = conn.execute(text(
+                "SELECT COUNT(*) FROM quests WHERE id NOT IN (SELECT value FROM json_each(:ids))"
+            ), {'ids': json.dumps(sorted(self._seen_quests))}).scalar()
+            self.stats.counts['questions_orphaned'] = conn.execute(text(
+                "SELECT COUNT(*) FROM questions WHERE id NOT IN (SELECT value FROM json_each(:ids))"
+            ), {'ids': json.dumps(sorted(self._seen_questions))}).scalar()
+        self.stats.timings['prefetch'] += time.perf_counter() - started
+
+    def _import_batch(self, batch):
+        quests = [data for kind, data in batch if kind == 'quest']
+        questions = [data for kind, data in batch if kind == 'question']
+        # バッチが失敗した場合に備え、状態はコミット後に反映する
+        state = {
+            'counts': dict.fromkeys(self.stats.counts, 0),
+            'quest_ids': {}, 'quest_names': {}, 'next_positions': {},
+            'changed': set(), 'groups': set(), 'regrouped': set(),
+            'seen_quests': set(), 'seen_questions': set(), 'dry_run_ids': self._dry_run_ids,
+        }
+        timings = self.stats.timings
+        with self.engine.connect() as conn:
+            try:
+                if quests:
+                    self._write_quests(conn, quests, state)
+                if questions:
+                    self._write_questions(conn, questions, state)
+                started = time.perf_counter()
+                if self.dry_run:
+                    conn.rollback()
+                else:
+                    conn.commit()
+                timings['commit'] += time.perf_counter() - started
+            except BaseException:
+                conn.rollback()
+                raise
+
+        for key, value in state['counts'].items():
+            self.stats.counts[key] += value
+        self.quest_ids.update(state['quest_ids'])
+        self.quest_names.update(state['quest_names'])
+        self.next_positions.update(state['next_positions'])
+        self.changed_quest_ids |= state['changed']
+        self.affected_groups |= state['groups']
+        self.regrouped_quest_ids |= state['regrouped']
+        self._seen_quests |= state['seen_quests']
+        self._seen_questions |= state['seen_questions']
+        self._dry_run_ids = state['dry_run_ids']
+
+    def _write(self, conn, statement, rows):
+        if rows and not self.dry_run:
+            conn.execute(text(statement), rows)
+
+    def _allocate(self, conn, name, count, state):
+        if not self.dry_run:
+            return id_allocator.allocate(name, count, conn=conn)
+        # ドライランでは採番せず、既存のIDと重ならない仮のID（負の値）を使う
+        start = state['dry_run_ids']
+        state['dry_run_ids'] += count
+        return range(-start - 1, -start - count - 1, -1)
+
+    # --- quests ---
+
+    def _write_quests(self, conn, rows, state):
+        timings = self.stats.timings
+        started = time.perf_counter()
+        prepared = []
+        for row in rows:
+            key = row.get('id')
+            title_raw = row.get('title') or 'misc'
+            title = self.subject_keys.get(title_raw, title_raw)
+            level = row.get('level') or 'Lv1'
+            prepared.append({
+                'key': key,
+                # JSON の数値IDは表示用のクエストID（code）
+                'code': _to_int(key),
+                'title': title,
+                'level': level,
+                'questname': row.get('questname') or ('Imported Quest' if not key else f'Quest {key}'),
+                # 既存クエストの更新では、指定の無い world_name は変更しない
+                'world_name': row.get('world_name'),
+            })
+
+        columns = "id, code, title, level, questname, world_name, content_hash"
+        by_code = {}
+        for chunk in _in_chunks({p['code'] for p in prepared if p['code'] is not None}):
+            for r in conn.execute(text(
+                f"SELECT {columns} FROM quests WHERE code IN (SELECT value FROM json_each(:codes))"
+            ), {'codes': json.dumps(chunk)}):
+                by_code[r.code] = r
+        by_name = {}
+        names = {p['questname'] for p in prepared if p['code'] not in by_code}
+        for chunk in _in_chunks(names):
+            for r in conn.execute(text(
+                f"SELECT {columns} FROM quests "
+                "WHERE questname IN (SELECT value FROM json_each(:names)) ORDER BY id DESC"
+            ), {'names': json.dumps(chunk)}):
+                by_name[(r.questname, r.title, r.level)] = r
+        taken_ids = set()
+        for chunk in _in_chunks({p['code'] for p in prepared if p['code'] is not None}):
+            taken_ids.update(r[0] for r in conn.execute(text(
+                "SELECT id FROM quests WHERE id IN (SELECT value FROM json_each(:ids))"
+            ), {'ids': json.dumps(chunk)}))
+        max_code = conn.execute(text("SELECT COALESCE(MAX(code), 0) FROM quests")).scalar()
+        timings['prefetch'] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        updates = {}   # 内部ID -> 既存クエストの更新内容
+        unchanged = 0
+        inserts = []
+        pending_codes = {}  # このバッチで追加するクエストを code・名前で引く
+        pending_names = {}
+        for p in prepared:
+            name_key = (p['questname'], p['title'], p['level'])
+            existing = by_code.get(p['code']) or by_name.get(name_key)
+            if existing is not None:
+                row = dict(p, id=existing.id, world_name=p['world_name'] or existing.world_name)
+                row['content_hash'] = _quest_hash(row)
+                if existing.id in updates or row['content_hash'] != existing.content_hash:
+                    if (existing.title, existing.level) != (p['title'], p['level']):
+                        state['regrouped'].add(existing.id)
+                        state['groups'].add((existing.title, existing.level))
+                    state['groups'].add((p['title'], p['level']))
+                    updates[existing.id] = row
+                else:
+                    unchanged += 1
+                state['seen_quests'].add(existing.id)
+                self._remember_quest(state, p['key'], p['questname'], existing.id)
+            else:
+                row = pending_codes.get(p['code']) or pending_names.get(name_key)
+                if row is not None:
+                    # 同じクエストがバッチ内に複数回ある場合は、後の行で更新する
+                    row.update({k: p[k] for k in ('title', 'level', 'questname')})
+                    if p['world_name']:
+                        row['world_name'] = p['world_name']
+                    row['keys'].append(p['key'])
+                else:
+                    code = p['code']
+                    if code is None:
+                        code = max_code + 1
+                    max_code = max(max_code, code)
+                    # code が内部IDとしても未使用であれば、内部IDにも同じ値を使う
+                    quest_id = code if code not in taken_ids else None
+                    taken_ids.add(code)
+                    row = dict(p, id=quest_id, code=code, keys=[p['key']])
+                    inserts.append(row)
+                    pending_codes[code] = row
+                pending_names[(row['questname'], row['title'], row['level'])] = row
+                state['groups'].add((p['title'], p['level']))
+
+        self._write(conn, (
+            "UPDATE quests SET title = :title, level = :level, questname = :questname, "
+            "world_name = :world_name, content_hash = :content_hash WHERE id = :id"
+        ), list(updates.values()))
+        without_id = [row for row in inserts if row['id'] is None]
+        for row, quest_id in zip(without_id, self._allocate(conn, 'quests', len(without_id), state)):
+            row['id'] = quest_id
+        for row in inserts:
+            row['content_hash'] = _quest_hash(row)
+        self._write(conn, (
+            "INSERT INTO quests (id, code, title, level, questname, world_name, content_hash) "
+            "VALUES (:id, :code, :title, :level, :questname, :world_name, :content_hash)"
+        ), inserts)
+        for row in inserts:
+            for key in row['keys']:
+                self._remember_quest(state, key, row['questname'], row['id'])
+            state['seen_quests'].add(row['id'])
+        state['changed'].update(updates)
+        state['changed'].update(row['id'] for row in inserts)
+        state['counts']['quests_updated'] += len(updates)
+        state['counts']['quests_unchanged'] += unchanged
+        state['counts']['quests_inserted'] += len(inserts)
+        timings['write'] += time.perf_counter() - started
+
+    @staticmethod
+    def _remember_quest(state, key, questname, quest_id):
+        if key:
+            state['quest_ids'][str(key)] = quest_id
+        if questname:
+            state['quest_names'][questname] = quest_id
+
+    # --- questions ---
+
+    def _resolve_quest(self, state, row, code_to_id):
+        ref = row.get('quest_id')
+        quest_id = None
+        if ref:
+            key = str(ref)
+            quest_id = state['quest_ids'].get(key) or self.quest_ids.get(key) or code_to_id.get(_to_int(ref))
+        if not quest_id and row.get('questname'):
+            quest_id = state['quest_names'].get(row['questname']) or self.quest_names.get(row['questname'])
+        return quest_id
+
+    def _write_questions(self, conn, rows, state):
+        timings = self.stats.timings
+        started = time.perf_counter()
+        # JSON 内に無いクエストは、既存クエストの code として解決する
+        unresolved = {_to_int(r.get('quest_id')) for r in rows
+                      if r.get('quest_id') and str(r['quest_id']) not in state['quest_ids']
+                      and str(r['quest_id']) not in self.quest_ids}
+        unresolved.discard(None)
+        code_to_id = {}
+        for chunk in _in_chunks(unresolved):
+            code_to_id.update(conn.execute(text(
+                "SELECT code, id FROM quests WHERE code IN (SELECT value FROM json_each(:codes))"
+            ), {'codes': json.dumps(chunk)}).all())
+
+        resolved = []
+        for row in rows:
+            quest_id = self._resolve_quest(state, row, code_to_id)
+            if not quest_id or not row.get('type') or not row.get('text'):
+                state['counts']['questions_skipped'] += 1
+                continue
+            resolved.append((int(quest_id), row))
+
+        # 既存の問題は本文を読まず、position とハッシュだけを取得して比較する
+        columns = "id, quest_id, position, content_hash"
+        existing = {}
+        for chunk in _in_chunks({_to_int(r.get('id')) for _, r in resolved} - {None}):
+            for r in conn.execute(text(
+                f"SELECT {columns} FROM questions WHERE id IN (SELECT value FROM json_each(:ids))"
+            ), {'ids': json.dumps(chunk)}):
+                existing[r.id] = r
+        # IDの無い問題は、同じクエスト内の同じ内容（ハッシュ）の問題と対応付ける
+        by_hash = {}
+        for chunk in _in_chunks({quest_id for quest_id, r in resolved if _to_int(r.get('id')) is None}):
+            for r in conn.execute(text(
+                f"SELECT {columns} FROM questions WHERE quest_id IN (SELECT value FROM json_each(:ids)) "
+                "AND content_hash IS NOT NULL ORDER BY position, id"
+            ), {'ids': json.dumps(chunk)}):
+                by_hash.setdefault((r.quest_id, r.content_hash), []).append(r)
+        next_positions = state['next_positions']
+        missing = {quest_id for quest_id, _ in resolved
+                   if quest_id not in next_positions and quest_id not in self.next_positions}
+        for chunk in _in_chunks(missing):
+            next_positions.update(conn.execute(text(
+                "SELECT quest_id, MAX(position) + 1 FROM questions "
+                "WHERE quest_id IN (SELECT value FROM json_each(:ids)) GROUP BY quest_id"
+            ), {'ids': json.dumps(chunk)}).all())
+        timings['prefetch'] += time.perf_counter() - started
+
+        started = time.perf_counter()
+
+        def next_position(quest_id):
+            position = next_positions.get(quest_id) or self.next_positions.get(quest_id) or 1
+            next_positions[quest_id] = position + 1
+            return position
+
+        def claim(quest_id, hash_):
+            # ファイル内の別の行に対応付け済みの問題は使わない
+            for r in by_hash.get((quest_id, hash_), ()):
+                if r.id not in claimed:
+                    claimed.add(r.id)
+                    return r
+            return None
+
+        claimed = self._seen_questions | state['seen_questions'] | set(existing)
+        upserts = {}  # id -> row（同じIDの行は後のものが優先）
+        unchanged = set()
+        new_rows = []
+        for quest_id, row in resolved:
+            q_id = _to_int(row.get('id'))
+            choices = _as_text(row.get('choices'))
+            values = {
+                'id': q_id,
+                'quest_id': quest_id,
+                'type': row['type'],
+                'text': row['text'],
+                'choices': choices if choices and str(choices).strip() != '' else None,
+                'answer': _as_text(row.get('answer')),
+                'explanation': row.get('explanation'),
+                'position': _to_int(row.get('position')),
+            }
+            values['content_hash'] = _question_hash(values)
+            current = existing.get(q_id) if q_id is not None else claim(quest_id, values['content_hash'])
+            if current is not None:
+                values['id'] = q_id = current.id
+                existing[q_id] = current
+            if values['position'] is None:
+                if current is not None:
+                    values['position'] = current.position
+                elif q_id in upserts:
+                    values['position'] = upserts[q_id]['position']
+                else:
+                    values['position'] = next_position(quest_id)
+
+            if q_id is None:
+                new_rows.append(values)
+            elif (current is not None and q_id not in upserts
+                  and (values['content_hash'], values['position']) == (current.content_hash, current.position)):
+                unchanged.add(q_id)
+            else:
+                unchanged.discard(q_id)
+                upserts[q_id] = values
+        # 同じIDの行が複数あり、最後の行が既存の内容と同じになった場合は書き込まない
+        for q_id, values in list(upserts.items()):
+            current = existing.get(q_id)
+            if current is not None and (values['content_hash'], values['position']) == (current.content_hash, current.position):
+                del upserts[q_id]
+                unchanged.add(q_id)
+
+        self._write(conn, (
+            "INSERT INTO questions (id, quest_id, type, text, choices, answer, explanation, position, content_hash) "
+            "VALUES (:id, :quest_id, :type, :text, :choices, :answer, :explanation, :position, :content_hash) "
+            "ON CONFLICT (id) DO UPDATE SET quest_id = excluded.quest_id, type = excluded.type, "
+            "text = excluded.text, choices = excluded.choices, answer = excluded.answer, "
+            "explanation = excluded.explanation, position = excluded.position, "
+            "content_hash = excluded.content_hash"
+        ), list(upserts.values()))
+        # IDを指定した行を書き込んだ後に、残りの行へ連番を払い出す
+        for values, q_id in zip(new_rows, self._allocate(conn, 'questions', len(new_rows), state)):
+            values['id'] = q_id
+        self._write(conn, (
+            "INSERT INTO questions (id, quest_id, type, text, choices, answer, explanation, position, content_hash) "
+            "VALUES (:id, :quest_id, :type, :text, :choices, :answer, :explanation, :position, :content_hash)"
+        ), new_rows)
+
+        for q_id, values in upserts.items():
+            state['changed'].add(values['quest_id'])
+            if q_id in existing:
+                # 別のクエストへ移った問題は、移動元のクエストも変更になる
+                state['changed'].add(existing[q_id].quest_id)
+        state['changed'].update(values['quest_id'] for values in new_rows)
+        state['seen_questions'].update(upserts)
+        state['seen_questions'].update(unchanged)
+        state['seen_questions'].update(values['id'] for values in new_rows)
+        updated = sum(1 for q_id in upserts if q_id in existing)
+        state['counts']['questions_updated'] += updated
+        state['counts']['questions_unchanged'] += len(unchanged)
+        state['counts']['questions_inserted'] += len(upserts) - updated + len(new_rows)
+        timings['write'] += time.perf_counter() - started
+
+
+def backfill_content_hashes(content_engine, batch_size=500, progress=None):
+    """
+    Sets content_hash on quests and questions where it is NULL (rows created
+    before the column existed or edited in the admin screens), batch_size rows
+    per transaction. Returns {'quests': n, 'questions': n}.
+    """
+    targets = (
+        ('quests', "id, title, level, questname, world_name", _quest_hash),
+        ('questions', "id, quest_id, type, text, choices, answer, explanation", _question_hash),
+    )
+    counts = {}
+    for table, columns, hash_row in targets:
+        counts[table] = 0
+        last_id = None
+        while True:
+            with content_engine.begin() as conn:
+                rows = conn.execute(text(
+                    f"SELECT {columns} FROM {table} WHERE content_hash IS NULL "
+                    f"{'AND id > :last_id ' if last_id is not None else ''}ORDER BY id LIMIT :limit"
+                ), {'last_id': last_id, 'limit': batch_size}).mappings().all()
+                if not rows:
+                    break
+                conn.execute(text(f"UPDATE {table} SET content_hash = :content_hash WHERE id = :id"),
+                             [{'id': row['id'], 'content_hash': hash_row(row)} for row in rows])
+            last_id = rows[-1]['id']
+            counts[table] += len(rows)
+            if progress is not None:
+                progress(dict(counts))
+    return counts
@@ -0,0 +1,380 @@
+# utils/jobs.py
+"""
+管理画面の重い処理（インポート・エクスポート・ID一括変更・一括削除・集計の再構築など）を
+リクエストの外で実行するバックグラウンドジョブ。
+
+- リクエストはジョブを登録してすぐに応答し、画面は状態・進捗をポーリングする。
+- ジョブは固定数のワーカースレッド（MQUEST_JOB_WORKERS）で、アプリケーションコンテキストの
+  中で実行する。待ち行列の長さにも上限があり、超えた場合は登録を断る。
+- ジョブの記録（状態・進捗・結果・エラー）はユーザーDBの jobs テーブルに保存するため、
+  別のワーカープロセスからも状態の確認とキャンセルの要求ができる。
+- キャンセルは協調的で、ジョブの関数が job.check_cancelled() を呼んだ時点で中断する
+  （それまでにコミットした分は残る）。実行前のジョブはそのまま取り消される。
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update, delete
+
+from models import db, JobRecord
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# 終了したジョブの記録を残す期間
+RECORD_TTL = timedelta(days=7)
+
+
+class JobCancelled(Exception):
+    """Raised by Job.check_cancelled() when cancellation was requested."""
+
+
+class JobQueueFull(Exception):
+    """Raised by JobRunner.submit() when too many jobs are waiting."""
+
+
+def _now():
+    # SQLite には naive な UTC 日時として保存される
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        return _pid_alive_windows(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _pid_alive_windows(pid):
+    # Windows の os.kill(pid, 0) は CTRL_C_EVENT を送ってしまうため、プロセスの終了コードで調べる
+    import ctypes
+    from ctypes import wintypes
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    ERROR_ACCESS_DENIED = 5
+    STILL_ACTIVE = 259
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        # 権限が無いだけならプロセスは存在する
+        return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+    try:
+        exit_code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+            return True
+        return exit_code.value == STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+class Job:
+    def __init__(self, runner, kind, fn, args, created_by):
+        self.runner = runner
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.created_by = created_by
+        self.status = QUEUED
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = _now()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._saved_at = 0.0
+
+    def report(self, **progress):
+        """
+        Called by the job function to publish progress. The progress is saved
+        at most once per runner.progress_interval seconds, which also picks up
+        cancellation requested from another process.
+        """
+        self.progress = dict(self.progress, **progress)
+        now = time.monotonic()
+        if now - self._saved_at >= self.runner.progress_interval:
+            self._saved_at = now
+            if self.runner.save_progress(self):
+                self._cancel.set()
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        """Raises JobCancelled if cancellation was requested; call it between units of work."""
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+            'created_by': self.created_by,
+            'cancel_requested': self._cancel.is_set(),
+            'created_at': _iso(self.created_at),
+            'started_at': _iso(self.started_at),
+            'finished_at': _iso(self.finished_at),
+        }
+
+
+def _iso(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def _loads(raw):
+    return json.loads(raw) if raw else None
+
+
+def _record_dict(row):
+    return {
+        'id': row.id,
+        'kind': row.kind,
+        'status': row.status,
+        'progress': _loads(row.progress) or {},
+        'result': _loads(row.result),
+        'error': row.error,
+        'created_by': row.created_by,
+        'cancel_requested': bool(row.cancel_requested),
+        'created_at': _iso(row.created_at),
+        'started_at': _iso(row.started_at),
+        'finished_at': _iso(row.finished_at),
+    }
+
+
+class JobRunner:
+    def __init__(self, app, workers=2, max_pending=20, progress_interval=0.5, keep=100):
+        self.app = app
+        self.workers = workers
+        self.max_pending = max_pending  # 実行待ちのジョブ数の上限
+        self.progress_interval = progress_interval
+        self.keep = keep  # プロセス内に保持する終了済みジョブの件数
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._threads = []
+        self._lock = threading.Lock()
+        self._owner = _owner()
+        self._table = JobRecord.__table__
+
+    # --- jobs テーブル ---
+
+    def _execute(self, statement):
+        with self.app.app_context():
+            with db.engine.begin() as conn:
+                return conn.execute(statement)
+
+    def _save(self, job, **extra):
+        values = {
+            'status': job.status,
+            'progress': json.dumps(job.progress, ensure_ascii=False),
+            'result': json.dumps(job.result, ensure_ascii=False) if job.result is not None else None,
+            'error': job.error,
+            'started_at': job.started_at,
+            'finished_at': job.finished_at,
+        }
+        values.update(extra)
+        self._execute(update(self._table).where(self._table.c.id == job.id).values(**values))
+
+    def save_progress(self, job):
+        """Saves job.progress; returns True when cancellation was requested (from any process)."""
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as conn:
+                    return bool(conn.execute(
+                        update(self._table).where(self._table.c.id == job.id)
+                        .values(progress=json.dumps(job.progress, ensure_ascii=False))
+                        .returning(self._table.c.cancel_requested)
+                    ).scalar())
+        except Exception as e:
+            # 進捗の保存に失敗してもジョブは続ける
+            logger.warning(f"Saving progress of job {job.id} failed: {e}")
+            return False
+
+    def _recover(self):
+        """
+        Marks jobs left queued/running by a dead process on this host as failed
+        and deletes finished records older than RECORD_TTL.
+        """
+        self._table.create(db.engine, checkfirst=True)
+        host = self._owner.rsplit(':', 1)[0]
+        rows = self._execute(select(self._table.c.id, self._table.c.owner)
+                             .where(self._table.c.status.in_((QUEUED, RUNNING)))).all()
+        for row in rows:
+            owner_host, _, pid = (row.owner or '').rpartition(':')
+            if owner_host == host and pid.isdigit() and not _pid_alive(int(pid)):
+                self._execute(update(self._table).where(self._table.c.id == row.id).values(
+                    status=FAILED, error='プロセスの終了により中断されました', finished_at=_now()
+                ))
+        self._execute(delete(self._table).where(
+            self._table.c.status.in_(FINISHED), self._table.c.finished_at < _now() - RECORD_TTL
+        ))
+
+    # --- 公開API ---
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return self
+            with self.app.app_context():
+                self._recover()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'mquest-jobs-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def submit(self, kind, fn, *args, created_by=None):
+        """
+        Queues fn(job, *args) to run on a worker thread inside an app context and
+        returns the Job. The return value of fn (JSON-serializable) becomes
+        job.result; JobCancelled marks the job as cancelled, any other exception
+        as failed. Raises JobQueueFull when max_pending jobs are already waiting.
+        """
+        self.start()
+        if self._queue.qsize() >= self.max_pending:
+            raise JobQueueFull()
+        job = Job(self, kind, fn, args, created_by)
+        self._execute(self._table.insert().values(
+            id=job.id, kind=kind, status=QUEUED, progress='{}', created_by=created_by,
+            owner=self._owner, cancel_requested=False, created_at=job.created_at
+        ))
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._queue.put(job)
+        return job
+
+    def status(self, job_id):
+        """Status dict of a job of any process (None if unknown)."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.as_dict()
+        row = self._execute(select(self._table).where(self._table.c.id == job_id)).first()
+        return _record_dict(row) if row is not None else None
+
+    def recent(self, limit=50):
+        rows = self._execute(select(self._table).order_by(self._table.c.created_at.desc()).limit(limit)).all()
+        return [_record_dict(row) for row in rows]
+
+    def cancel(self, job_id):
+        """
+        Requests cancellation. A job of this process is flagged immediately;
+        a job of another process sees the flag before it starts or, once
+        running, at its next progress save.
+        Returns False when the job is unknown or already finished.
+        """
+        result = self._execute(update(self._table).where(
+            self._table.c.id == job_id, self._table.c.status.in_((QUEUED, RUNNING))
+        ).values(cancel_requested=True))
+        job = self._jobs.get(job_id)
+        if job is None or job.status in FINISHED:
+            return result.rowcount > 0
+        with self._lock:
+            job._cancel.set()
+            # 実行前のジョブはこの時点で取り消す
+            queued = job.status == QUEUED
+            if queued:
+                job.status = CANCELLED
+                job.finished_at = _now()
+        if queued:
+            self._save(job)
+        return True
+
+    def stop(self, timeout=5):
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        for _ in threads:
+            self._queue.put(_STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j.status in FINISHED]
+        for job in sorted(finished, key=lambda j: j.finished_at)[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job.id]
+
+    def _mark_started(self, job):
+        """
+        Marks the job running in the jobs table; returns False when it was
+        cancelled (possibly from another process) before it started.
+        """
+        return self._execute(update(self._table).where(
+            self._table.c.id == job.id, self._table.c.status == QUEUED,
+            self._table.c.cancel_requested.is_(False)
+        ).values(status=RUNNING, started_at=job.started_at)).rowcount > 0
+
+    def _execute_job(self, job):
+        with self.app.app_context():
+            try:
+                job.result = job.fn(job, *job.args)
+                job.status = DONE
+            except JobCancelled:
+                job.status = CANCELLED
+            except Exception as e:
+                logger.exception(f"Job {job.kind} {job.id} failed")
+                job.error = str(e)
+                job.status = FAILED
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                break
+            with self._lock:
+                if job.status != QUEUED:
+                    continue  # 実行前にキャンセルされた
+                job.status = RUNNING
+                job.started_at = _now()
+            try:
+                started = self._mark_started(job)
+            except Exception as e:
+                # DB に書けない場合もワーカースレッドは止めず、ジョブを失敗にする
+                logger.warning(f"Starting job {job.id} failed: {e}")
+                job.error = f"ジョブを開始できませんでした: {e}"
+                job.status = FAILED
+            else:
+                if started:
+                    self._execute_job(job)
+                else:
+                    # 別のプロセスから実行前にキャンセルされたので、実行せずに取り消す
+                    with self._lock:
+                        job._cancel.set()
+                        job.status = CANCELLED
+                        job.started_at = None
+            job.finished_at = _now()
+            try:
+                self._save(job)
+            except Exception as e:
+                logger.warning(f"Saving job {job.id} failed: {e}")
@@ -0,0 +1,217 @@
+# utils/question_cache.py
+"""
+クエスト実行画面（quest_run / group_learning）用の問題ビューモデルキャッシュ。
+
+Question.choices / Question.answer の JSON（SVG や GeoGebra の巨大なデータを含む）を
+クエストごとに一度だけパースしてプロセス内に保持する。リクエストごとに行うのは
+選択肢のシャッフルだけで、キャッシュ本体は決して変更しない。
+採点用の答えのキー（utils/grading.py）と結果画面用の問題の情報も同時に作って保持する。
+"""
+import json
+import random
+import threading
+
+from sqlalchemy.orm import selectinload
+
+from models import Quest
+from utils import content_snapshot, grading
+from utils.single_flight import flights
+
+_lock = threading.Lock()
+_version = 0
+_entries = {}  # quest_id -> (version, quest_info, view_models, grading_payload)
+
+
+def content_version():
+    """Current content version; bumped by every invalidation."""
+    return _version
+
+
+def invalidate(quest_ids=None):
+    """
+    Drops cached payloads. With quest_ids=None every quest is dropped.
+    The version bump also prevents a build that started before the
+    invalidation from storing its (stale) result.
+    """
+    global _version
+    with _lock:
+        _version += 1
+        if quest_ids is None:
+            _entries.clear()
+        else:
+            for qid in quest_ids:
+                _entries.pop(int(qid), None)
+
+
+def _loads(raw):
+    try:
+        return json.loads(raw)
+    except (json.JSONDecodeError, TypeError):
+        return raw
+
+
+def build_question_view_model(q):
+    """Parses one Question into the dict consumed by quest_run.html / group_learning.html."""
+    if q.type == 'svg_interactive' or q.type == 'figure_choice':
+        # Try to parse choices as JSON (new format with 'svg' and 'ggb')
+        svg_display = q.choices
+        choices_json = _loads(q.choices)
+        if isinstance(choices_json, dict) and 'svg' in choices_json:
+            svg_display = choices_json['svg']
+
+        try:
+            sub_questions = json.loads(q.answer) if q.answer else []
+        except json.JSONDecodeError:
+            sub_questions = []
+
+        return {
+            "type": q.type,
+            "text": q.text,
+            "choices": q.choices,  # Pass raw JSON for size extraction in template
+            "svg_content": svg_display,
+            "sub_questions": sub_questions,
+            "explanation": q.explanation
+        }
+
+    choices = _loads(q.choices)
+    answer = _loads(q.answer)
+
+    if q.type == 'function_graph':
+        return {
+            "type": q.type,
+            "text": q.text,
+            "answer": answer,  # This will be the parsed list of dicts
+            "choices": choices,
+            "answers": None,
+            "explanation": q.explanation
+        }
+    if q.type == 'function_graph_choice':
+        # q.choices is an object containing {'definitions': [...], 'width': ..., 'height': ...}
+        try:
+            choices_parsed = json.loads(q.choices) if q.choices else {}
+            if isinstance(choices_parsed, dict):
+                graph_data = choices_parsed
+            else:
+                # Legacy support: if it was just a list, keep it as definitions
+                graph_data = {'definitions': choices_parsed, 'width': '', 'height': ''}
+        except json.JSONDecodeError:
+            graph_data = {'definitions': [], 'width': '', 'height': ''}
+
+        try:
+            sub_questions = json.loads(q.answer) if q.answer else []
+        except json.JSONDecodeError:
+            sub_questions = []
+
+        return {
+            "type": q.type,
+            "text": q.text,
+            "graph_data": graph_data,
+            "sub_questions": sub_questions,
+            "explanation": q.explanation
+        }
+    return {
+        "type": q.type,
+        "text": q.text,
+        "choices": choices,
+        "answer": answer if q.type != "numeric" else None,
+        "answers": answer if q.type == "numeric" else None,
+        "explanation": q.explanation
+    }
+
+
+def build_result_view_model(q):
+    """結果画面で表示する問題の情報（問題文・選択肢・解説・SVG）。"""
+    question_view_model = {
+        'id': q.id,
+        'type': q.type,
+        'text': q.text,
+        'choices': q.choices,
+        'explanation': q.explanation
+    }
+    if q.type == 'svg_interactive' or q.type == 'figure_choice':
+        svg_display = q.choices
+        choices_json = _loads(q.choices)
+        if isinstance(choices_json, dict) and 'svg' in choices_json:
+            svg_display = choices_json['svg']
+        question_view_model['svg_content'] = svg_display
+    # Explanation is now rendered as Markdown on the client side
+    return question_view_model
+
+
+def shuffled(view_models):
+    """
+    Returns per-request copies of the cached view models with choices shuffled.
+    Only the lists that are shuffled are copied; everything else is shared.
+    """
+    result = []
+    for vm in view_models:
+        if vm['type'] == 'choice' and isinstance(vm['choices'], list):
+            vm = dict(vm)
+            vm['choices'] = random.sample(vm['choices'], len(vm['choices']))  # 選択肢をシャッフル
+        elif vm['type'] in ('figure_choice', 'function_graph_choice') and isinstance(vm['sub_questions'], list):
+            # 各小問の選択肢をシャッフル
+            vm = dict(vm)
+            subs = []
+            for sub_q in vm['sub_questions']:
+                if isinstance(sub_q, dict) and isinstance(sub_q.get('choices'), list):
+                    sub_q = dict(sub_q)
+                    sub_q['choices'] = random.sample(sub_q['choices'], len(sub_q['choices']))
+                subs.append(sub_q)
+            vm['sub_questions'] = subs
+        result.append(vm)
+    return result
+
+
+def get_quest_payload(quest_id):
+    """
+    Returns (quest_info, view_models) for quest_id, or None if the quest does not exist.
+    quest_info is a plain dict (id, title, level, questname, world_name).
+    The returned objects are shared and must not be mutated; use shuffled().
+    """
+    entry = _load(quest_id)
+    return (entry[1], entry[2]) if entry is not None else None
+
+
+def get_grading_payload(quest_id):
+    """
+    Returns (quest_info, answer_keys, result_view_models) for quest_id, or None
+    if the quest does not exist. answer_keys are grading.AnswerKey in question
+    order; result_view_models are the question dicts shown on the result screen.
+    Shared objects; do not mutate.
+    """
+    entry = _load(quest_id)
+    return (entry[1],) + entry[3] if entry is not None else None
+
+
+def _load(quest_id):
+    entry = _entries.get(quest_id)
+    if entry is not None:
+        return entry
+
+    version = _version
+    return flights.do(f"quest_payload:{quest_id}:{version}", lambda: _build(quest_id, version), 'quest_payload')
+
+
+def _build(quest_id, version):
+    with content_snapshot.reader() as session:
+        quest = session.get(Quest, quest_id, options=[selectinload(Quest.questions)])
+        if not quest:
+            return None
+        quest_info = {
+            'id': quest.id,
+            'title': quest.title,
+            'level': quest.level,
+            'questname': quest.questname,
+            'world_name': quest.world_name
+        }
+        view_models = [build_question_view_model(q) for q in quest.questions]
+        grading_payload = (
+            [grading.compile_question(q) for q in quest.questions],
+            [build_result_view_model(q) for q in quest.questions],
+        )
+
+    entry = (version, quest_info, view_models, grading_payload)
+    with _lock:
+        if version == _version:
+            _entries[quest_id] = entry
+    return entry
@@ -0,0 +1,60 @@
+# utils/result_store.py
+"""
+クエスト結果画面用の採点結果ストア（quest_results テーブル）。
+
+問題ごとの採点結果（問題ID・解答・正答・正誤）をサーバー側に保存し、セッションクッキーには
+推測できないトークンだけを入れる。問題文・SVG などは保存せず、結果画面の表示時に問題キャッシュ
+（utils/question_cache.py）から補う。保存はログイン中の送信では record_submission と同じ
+トランザクションで行い、期限切れの結果の削除は定期的なメンテナンス
+（scripts/purge_quest_results.py・管理画面のジョブ）で行う。
+"""
+import json
+import secrets
+from datetime import datetime, timedelta, timezone
+
+from models import db, QuestResult
+
+# 結果画面を再表示できる期間
+RESULT_TTL = timedelta(hours=24)
+
+
+def _now():
+    # SQLite には naive な UTC 日時として保存される
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def save(user_id, quest_id, payload, ttl=RESULT_TTL):
+    """
+    Stores payload (a JSON-serializable dict) and returns its token. The caller commits.
+    """
+    now = _now()
+    token = secrets.token_urlsafe(32)
+    db.session.add(QuestResult(
+        token=token,
+        user_id=user_id,
+        quest_id=quest_id,
+        payload=json.dumps(payload, ensure_ascii=False),
+        created_at=now,
+        expires_at=now + ttl
+    ))
+    return token
+
+
+def load(token, quest_id, user_id=None):
+    """
+    The payload stored under token, or None when it is missing, expired,
+    for another quest, or owned by another user.
+    """
+    if not token:
+        return None
+    row = db.session.get(QuestResult, token)
+    if row is None or row.quest_id != quest_id or row.expires_at < _now():
+        return None
+    if row.user_id is not None and row.user_id != user_id:
+        return None
+    return json.loads(row.payload)
+
+
+def purge_expired(now=None):
+    """Deletes expired results; returns the number of rows deleted. The caller commits."""
+    return QuestResult.query.filter(QuestResult.expires_at < (now or _now())).delete(synchronize_session=False)
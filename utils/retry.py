@@ -0,0 +1,156 @@
+# utils/retry.py
+"""
+SQLite の一時的なエラー（ロック・ビジー・ディスク I/O）に対するリトライ方針。
+
+リトライするかどうかは SQLite のエラーコードで判定し、待ち時間は指数バックオフ
+（ジッター付き）とする。1回の呼び出しの期限と、1リクエスト内でリトライに使える
+時間の上限を設け、それを超える場合はリトライせずに諦める。呼び出し箇所ごとに
+リトライ回数・待ち時間・諦めた回数を記録する。
+"""
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+from flask import g, has_request_context
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+# リトライ対象の SQLite 基本エラーコード（拡張コードは下位8ビットで判定する）
+RETRYABLE_SQLITE_CODES = {
+    5: 'SQLITE_BUSY',
+    6: 'SQLITE_LOCKED',
+    10: 'SQLITE_IOERR',
+}
+
+# 待ち時間のヒストグラムの区切り（秒）
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def sqlite_error_code(exc):
+    """Primary SQLite result code of an OperationalError, or None when unknown."""
+    orig = getattr(exc, 'orig', exc)
+    code = getattr(orig, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff
+    # Python 3.10 以前の sqlite3 はエラーコードを持たないのでメッセージで判定する
+    message = str(orig)
+    if 'database is locked' in message:
+        return 5
+    if 'database table is locked' in message:
+        return 6
+    if 'disk I/O error' in message:
+        return 10
+    return None
+
+
+def is_retryable(exc):
+    return isinstance(exc, (OperationalError, sqlite3.OperationalError)) and sqlite_error_code(exc) in RETRYABLE_SQLITE_CODES
+
+
+class RetryMetrics:
+    """Thread-safe per-call-site counters and a histogram of retry waits."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sites = {}
+
+    def _site(self, site):
+        stats = self._sites.get(site)
+        if stats is None:
+            stats = self._sites[site] = {
+                'calls': 0, 'retries': 0, 'give_ups': 0, 'wait_seconds': 0.0,
+                'wait_histogram': [0] * (len(WAIT_BUCKETS) + 1),
+            }
+        return stats
+
+    def record_call(self, site):
+        with self._lock:
+            self._site(site)['calls'] += 1
+
+    def record_retry(self, site, wait):
+        with self._lock:
+            stats = self._site(site)
+            stats['retries'] += 1
+            stats['wait_seconds'] += wait
+            index = next((i for i, bound in enumerate(WAIT_BUCKETS) if wait <= bound), len(WAIT_BUCKETS))
+            stats['wait_histogram'][index] += 1
+
+    def record_give_up(self, site):
+        with self._lock:
+            self._site(site)['give_ups'] += 1
+
+    def snapshot(self):
+        """{site: {...}} with the histogram keyed by its upper bound ('+Inf' for the last bucket)."""
+        labels = [str(bound) for bound in WAIT_BUCKETS] + ['+Inf']
+        with self._lock:
+            return {
+                site: dict(stats, wait_seconds=round(stats['wait_seconds'], 4),
+                           wait_histogram=dict(zip(labels, stats['wait_histogram'])))
+                for site, stats in sorted(self._sites.items())
+            }
+
+    def reset(self):
+        with self._lock:
+            self._sites.clear()
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=4, base_delay=0.05, max_delay=1.0, multiplier=2.0,
+                 deadline=2.0, request_budget=3.0, metrics=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline = deadline  # 1回の呼び出しで使える時間（秒）
+        self.request_budget = request_budget  # 1リクエスト内でリトライの待ちに使える時間の合計（秒）
+        self.metrics = metrics or RetryMetrics()
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff for the given (1-based) failed attempt."""
+        cap = min(self.max_delay, self.base_delay * (self.multiplier ** (attempt - 1)))
+        return random.uniform(0, cap)
+
+    def _request_budget_left(self):
+        if not has_request_context():
+            return None
+        return g.setdefault('db_retry_budget', self.request_budget)
+
+    def _spend_request_budget(self, wait):
+        if has_request_context():
+            g.db_retry_budget = g.get('db_retry_budget', self.request_budget) - wait
+
+    def call(self, fn, site, on_retry=None):
+        """
+        Calls fn(), retrying retryable SQLite errors. on_retry(exc) runs before
+        each retry (e.g. to roll the session back). Non-retryable errors, and
+        retryable ones once attempts, the deadline or the request budget are
+        exhausted, are re-raised.
+        """
+        self.metrics.record_call(site)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fn()
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                wait = self.backoff(attempt)
+                budget = self._request_budget_left()
+                if (attempt >= self.max_attempts
+                        or time.monotonic() - started + wait > self.deadline
+                        or (budget is not None and wait > budget)):
+                    self.metrics.record_give_up(site)
+                    logger.warning(f"Database operation at {site} gave up after {attempt} attempt(s): {e}")
+                    raise
+                logger.warning(f"Database operation at {site} failed (attempt {attempt}/{self.max_attempts}): {e}. "
+                               f"Retrying in {wait:.3f}s...")
+                if on_retry is not None:
+                    on_retry(e)
+                self.metrics.record_retry(site, wait)
+                self._spend_request_budget(wait)
+                time.sleep(wait)
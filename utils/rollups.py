@@ -0,0 +1,146 @@
+# utils/rollups.py
+"""
+/progress 用の進捗・メダル集計（progress_rollups テーブル）の更新処理。
+
+quest_result が挑戦記録を書き込むのと同じトランザクションで該当する
+（ユーザー, 科目, レベル）の行を更新し、メダル判定もその時点で一度だけ行う。
+既存データの取り込みや科目・レベルの変更後は rebuild() で作り直す。
+"""
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from sqlalchemy import case, func, literal
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, ProgressRollup, QuestHistory, UserProgress
+from utils.catalog import catalog
+
+# メダル判定の閾値 (挑戦回数 ÷ 総クエスト数)
+MEDAL_TIERS = [
+    (2.0, 'diamond'),
+    (1.5, 'gold'),
+    (1.0, 'silver'),
+    (0.5, 'bronze'),
+]
+
+
+def medal_tier(ratio):
+    for threshold, tier in MEDAL_TIERS:
+        if ratio >= threshold:
+            return tier
+    return None
+
+
+def _medal_case(ratio):
+    """SQL expression evaluating medal_tier() for a ratio expression."""
+    return case(*[(ratio >= threshold, tier) for threshold, tier in MEDAL_TIERS], else_=None)
+
+
+def _apply_totals(rollup, total_count):
+    rollup.total_count = total_count
+    rollup.ratio = rollup.total_attempts / total_count if total_count > 0 else 0
+    rollup.medal = medal_tier(rollup.ratio)
+    rollup.updated_at = datetime.now(timezone.utc)
+
+
+def record_attempt(user_id, quest_id, newly_cleared, now=None):
+    """
+    Adds one attempt (and one cleared quest when newly_cleared) to the rollup row
+    of the quest's (title, level) with a single INSERT ... ON CONFLICT DO UPDATE.
+    Must be called before the submit transaction commits.
+    """
+    quest = catalog.get(quest_id)
+    if not quest:
+        return
+    total_count = catalog.count(quest.title, quest.level)
+    first_ratio = 1 / total_count if total_count > 0 else 0
+    stmt = sqlite_insert(ProgressRollup).values(
+        user_id=user_id,
+        title=quest.title,
+        level=quest.level,
+        cleared_count=1 if newly_cleared else 0,
+        total_attempts=1,
+        total_count=total_count,
+        ratio=first_ratio,
+        medal=medal_tier(first_ratio),
+        updated_at=now or datetime.now(timezone.utc)
+    )
+    if total_count > 0:
+        ratio = (ProgressRollup.total_attempts + 1) * 1.0 / total_count
+    else:
+        ratio = literal(0.0)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'title', 'level'],
+        set_={
+            'total_attempts': ProgressRollup.total_attempts + 1,
+            'cleared_count': ProgressRollup.cleared_count + stmt.excluded.cleared_count,
+            'total_count': stmt.excluded.total_count,
+            'ratio': ratio,
+            'medal': _medal_case(ratio),
+            'updated_at': stmt.excluded.updated_at,
+        }
+    )
+    db.session.execute(stmt)
+
+
+def rebuild(user_ids=None):
+    """
+    Recomputes progress_rollups from user_progress / quest_history.
+    user_ids=None rebuilds every user. The caller commits.
+    Returns the number of rollup rows written.
+    """
+    cleared_q = db.session.query(UserProgress.user_id, UserProgress.quest_id).filter(UserProgress.status == 'cleared')
+    attempts_q = db.session.query(QuestHistory.user_id, QuestHistory.quest_id, func.coalesce(QuestHistory.attempts, 0))
+    delete_q = ProgressRollup.query
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        cleared_q = cleared_q.filter(UserProgress.user_id.in_(user_ids))
+        attempts_q = attempts_q.filter(QuestHistory.user_id.in_(user_ids))
+        delete_q = delete_q.filter(ProgressRollup.user_id.in_(user_ids))
+
+    aggregated = defaultdict(lambda: {'cleared': 0, 'attempts': 0})
+    for user_id, quest_id in cleared_q.yield_per(1000):
+        quest = catalog.get(quest_id)
+        if quest:
+            aggregated[(user_id, quest.title, quest.level)]['cleared'] += 1
+    for user_id, quest_id, attempts in attempts_q.yield_per(1000):
+        quest = catalog.get(quest_id)
+        if quest:
+            aggregated[(user_id, quest.title, quest.level)]['attempts'] += attempts
+
+    delete_q.delete(synchronize_session=False)
+    for (user_id, title, level), stats in aggregated.items():
+        rollup = ProgressRollup(user_id=user_id, title=title, level=level,
+                                cleared_count=stats['cleared'], total_attempts=stats['attempts'])
+        _apply_totals(rollup, catalog.count(title, level))
+        db.session.add(rollup)
+    return len(aggregated)
+
+
+def refresh_totals(groups):
+    """
+    Re-evaluates total_count / ratio / medal for every rollup row of the given
+    (title, level) groups after quests were added, removed or moved.
+    One set-based UPDATE per group; the caller commits.
+    """
+    for title, level in groups:
+        total_count = catalog.count(title, level)
+        if total_count > 0:
+            ratio = ProgressRollup.total_attempts * 1.0 / total_count
+        else:
+            ratio = literal(0.0)
+        medal = _medal_case(ratio)
+        ProgressRollup.query.filter_by(title=title, level=level).update({
+            'total_count': total_count,
+            'ratio': ratio,
+            'medal': medal,
+        }, synchronize_session=False)
+
+
+def users_with_history(quest_ids):
+    """User ids whose rollups depend on any of quest_ids."""
+    quest_ids = list(quest_ids)
+    if not quest_ids:
+        return set()
+    rows = db.session.query(QuestHistory.user_id).filter(QuestHistory.quest_id.in_(quest_ids)).distinct()
+    return {r[0] for r in rows}
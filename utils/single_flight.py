@@ -0,0 +1,100 @@
+# utils/single_flight.py
+"""
+同じ計算の同時実行をまとめる（single-flight）。
+
+同じキー（処理名・引数・データのバージョン）の計算が実行中のときに来た呼び出しは
+自分では計算せず、実行中の計算の完了を待ってその結果（または例外）を受け取る。
+プロセス内のスレッド間でのみ働く。結果は呼び出し元の間で共有されるため変更しないこと。
+"""
+import functools
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {}  # namespace -> counters
+
+    def _count(self, namespace, name):
+        stats = self._stats.get(namespace)
+        if stats is None:
+            stats = self._stats[namespace] = {'calls': 0, 'executions': 0, 'coalesced': 0, 'errors': 0}
+        stats[name] += 1
+
+    def do(self, key, fn, namespace=None):
+        """Runs fn() unless a call with the same key is in flight, in which case its outcome is shared."""
+        namespace = namespace or key.split(':', 1)[0]
+        with self._lock:
+            self._count(namespace, 'calls')
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._count(namespace, 'coalesced')
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self._count(namespace, 'executions')
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self._count(namespace, 'errors')
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {namespace: dict(counts) for namespace, counts in sorted(self._stats.items())}
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+flights = SingleFlight()
+
+
+def coalesced(namespace, version=None):
+    """
+    Decorator: concurrent calls with the same arguments (and the same data
+    version, when version(*args, **kwargs) is given) share one execution.
+    When version returns None the call runs on its own, as with @cached.
+    The shared result must not be mutated by the callers.
+    """
+    from utils.cache import make_key
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            data_version = version(*args, **kwargs) if version is not None else ''
+            if data_version is None:
+                return fn(*args, **kwargs)
+            key = make_key(namespace, data_version, args, kwargs)
+            return flights.do(key, lambda: fn(*args, **kwargs), namespace)
+        wrapper.uncoalesced = fn
+        return wrapper
+    return decorator
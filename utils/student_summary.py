@@ -0,0 +1,179 @@
+# utils/student_summary.py
+"""
+生徒一覧・保護者画面向けの学習状況の一括取得。
+
+生徒ごとにクエリを発行する代わりに、対象の生徒IDをまとめて IN 句で渡し、
+生徒数に関係なく決まった回数のクエリで集計する。
+"""
+from collections import defaultdict
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import aliased
+
+from models import db, User, ProgressRollup, QuestHistory, QuestAttemptLog
+
+# 生徒一覧の並び替えに使える列（キーセットページネーション用）
+STUDENT_SORT_COLUMNS = {
+    'id': User.id,
+    'username': User.username,
+}
+
+
+def query_student_page(search='', sort='id', order='asc', after=None, limit=50):
+    """
+    One page of students (with their parent) using keyset pagination.
+    `after` is the sort-column value of the last row of the previous page.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    sort_column = STUDENT_SORT_COLUMNS.get(sort, User.id)
+    descending = order == 'desc'
+    Parent = aliased(User)
+
+    query = db.session.query(
+        User.id, User.username, User.nickname, User.avatar,
+        Parent.id.label('parent_id'), Parent.username.label('parent_username'),
+        Parent.nickname.label('parent_nickname')
+    ).outerjoin(Parent, User.parent_id == Parent.id).filter(User.role == 'student')
+
+    if search:
+        query = query.filter(or_(
+            User.username.contains(search, autoescape=True),
+            User.nickname.contains(search, autoescape=True)
+        ))
+    if after is not None:
+        query = query.filter(sort_column < after if descending else sort_column > after)
+
+    query = query.order_by(sort_column.desc() if descending else sort_column.asc()).limit(limit + 1)
+    rows = query.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = getattr(rows[-1], sort_column.key)
+    return rows, next_cursor
+
+
+def progress_by_user(user_ids):
+    """user_id -> [{'title', 'level', 'count'}] of cleared quests per subject/level, from progress_rollups."""
+    result = defaultdict(list)
+    if not user_ids:
+        return result
+    rows = db.session.query(
+        ProgressRollup.user_id, ProgressRollup.title, ProgressRollup.level, ProgressRollup.cleared_count
+    ).filter(
+        ProgressRollup.user_id.in_(list(user_ids)),
+        ProgressRollup.cleared_count > 0
+    ).order_by(ProgressRollup.user_id, ProgressRollup.title, ProgressRollup.level)
+    for user_id, title, level, count in rows:
+        result[user_id].append({'title': title, 'level': level, 'count': count})
+    return result
+
+
+def medals_by_user(user_ids):
+    """
+    user_id -> [{'quest_id', 'code', 'count'}] (attempts per quest = medals),
+    ordered by the quest's display code.
+    """
+    from utils.catalog import catalog
+
+    result = defaultdict(list)
+    if not user_ids:
+        return result
+    rows = db.session.query(
+        QuestHistory.user_id, QuestHistory.quest_id, QuestHistory.attempts
+    ).filter(QuestHistory.user_id.in_(list(user_ids))).order_by(QuestHistory.user_id, QuestHistory.quest_id)
+    for user_id, quest_id, attempts in rows:
+        quest = catalog.get(quest_id)
+        result[user_id].append({'quest_id': quest_id, 'code': quest.code if quest else quest_id, 'count': attempts})
+    for medals in result.values():
+        medals.sort(key=lambda m: (m['code'] is None, m['code'] or 0))
+    return result
+
+
+def medal_totals(user_ids):
+    """user_id -> total medals (sum of attempts over all quests)."""
+    if not user_ids:
+        return {}
+    rows = db.session.query(
+        QuestHistory.user_id, func.coalesce(func.sum(QuestHistory.attempts), 0)
+    ).filter(QuestHistory.user_id.in_(list(user_ids))).group_by(QuestHistory.user_id)
+    return {user_id: int(total) for user_id, total in rows}
+
+
+def last_activity(user_ids):
+    """user_id -> datetime of the latest attempt (users without attempts are absent)."""
+    if not user_ids:
+        return {}
+    rows = db.session.query(
+        QuestAttemptLog.user_id, func.max(QuestAttemptLog.attempted_at)
+    ).filter(QuestAttemptLog.user_id.in_(list(user_ids))).group_by(QuestAttemptLog.user_id)
+    return dict(rows.all())
+
+
+def recent_attempts(user_ids, limit=5):
+    """
+    user_id -> latest `limit` attempts (newest first), as dicts with quest_id,
+    title, level, questname, correct, total, attempted_at and cleared.
+    A single ROW_NUMBER() window query, whatever the number of users.
+    """
+    from utils.catalog import catalog
+
+    result = defaultdict(list)
+    if not user_ids:
+        return result
+    rn = func.row_number().over(
+        partition_by=QuestAttemptLog.user_id,
+        order_by=(QuestAttemptLog.attempted_at.desc(), QuestAttemptLog.id.desc())
+    ).label('rn')
+    ranked = db.session.query(
+        QuestAttemptLog.user_id, QuestAttemptLog.quest_id, QuestAttemptLog.correct_answers,
+        QuestAttemptLog.total_questions, QuestAttemptLog.attempted_at, rn
+    ).filter(QuestAttemptLog.user_id.in_(list(user_ids))).subquery()
+    rows = db.session.query(ranked).filter(ranked.c.rn <= limit).order_by(ranked.c.user_id, ranked.c.rn)
+
+    for r in rows:
+        # クエスト名はカタログ索引から引く（コンテンツDBへの問い合わせなし）
+        quest = catalog.get(r.quest_id)
+        result[r.user_id].append({
+            'quest_id': r.quest_id,
+            'title': quest.title if quest else None,
+            'level': quest.level if quest else None,
+            'questname': quest.questname if quest else None,
+            'correct': r.correct_answers,
+            'total': r.total_questions,
+            'attempted_at': r.attempted_at,
+            'cleared': r.correct_answers == r.total_questions,
+        })
+    return result
+
+
+def parent_summary(parent_id, recent_limit=5):
+    """
+    Summary of every child of a parent, in child id order:
+    [{'student', 'medal_count', 'progress', 'cleared_total', 'last_activity', 'recent_attempts'}].
+    'student' is a row with id, username, nickname and avatar; 'progress' holds
+    subject keys (the caller translates them for display).
+    Five queries in total, however many children the parent has.
+    """
+    children = db.session.query(
+        User.id, User.username, User.nickname, User.avatar
+    ).filter(User.parent_id == parent_id, User.role == 'student').order_by(User.id).all()
+    child_ids = [c.id for c in children]
+
+    medals = medal_totals(child_ids)
+    progress = progress_by_user(child_ids)
+    activity = last_activity(child_ids)
+    recent = recent_attempts(child_ids, recent_limit)
+
+    summary = []
+    for child in children:
+        child_progress = progress.get(child.id, [])
+        summary.append({
+            'student': child,
+            'medal_count': medals.get(child.id, 0),
+            'progress': child_progress,
+            'cleared_total': sum(p['count'] for p in child_progress),
+            'last_activity': activity.get(child.id),
+            'recent_attempts': recent.get(child.id, []),
+        })
+    return summary
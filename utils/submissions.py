@@ -0,0 +1,96 @@
+# utils/submissions.py
+"""
+クエスト結果送信時の書き込み処理。
+
+quest_history / user_progress を INSERT ... ON CONFLICT DO UPDATE（RETURNING 付き）で
+更新し、挑戦ログ・再採点用の解答・期間別集計・進捗集計・結果画面用の採点結果と
+あわせて1つの短い書き込みトランザクションにまとめる。事前の SELECT（読み取り → 変更 → 書き込み）を行わないため、同じクエストの
+二重送信でも一意制約違反にならず、書き込みロックの保持時間も短くなる。
+"""
+from datetime import datetime, timezone
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, QuestHistory, UserProgress, QuestAttemptLog
+from utils import answer_log, attempt_buckets, result_store, rollups
+
+
+def upsert_history(user_id, quest_id, all_correct, now):
+    """
+    Counts one attempt in quest_history and returns the resulting is_cleared.
+    A quest stays cleared once it has been cleared.
+    """
+    stmt = sqlite_insert(QuestHistory).values(
+        user_id=user_id,
+        quest_id=quest_id,
+        correct=all_correct,
+        is_cleared=all_correct,
+        cleared_count=1 if all_correct else 0,
+        attempts=1,
+        last_attempt=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'quest_id'],
+        set_={
+            'attempts': func.coalesce(QuestHistory.attempts, 0) + 1,
+            'correct': stmt.excluded.correct,
+            'cleared_count': func.coalesce(QuestHistory.cleared_count, 0) + stmt.excluded.cleared_count,
+            'is_cleared': func.coalesce(QuestHistory.is_cleared, False) | stmt.excluded.is_cleared,
+            'last_attempt': stmt.excluded.last_attempt,
+        }
+    ).returning(QuestHistory.is_cleared)
+    return bool(db.session.execute(stmt).scalar())
+
+
+def mark_cleared(user_id, quest_id, now):
+    """
+    Sets user_progress to 'cleared'. Returns True only when the quest was not
+    cleared before (a row is returned only when it was inserted or updated).
+    """
+    stmt = sqlite_insert(UserProgress).values(
+        user_id=user_id,
+        quest_id=quest_id,
+        status='cleared',
+        conquered_at=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'quest_id'],
+        set_={'status': 'cleared', 'conquered_at': stmt.excluded.conquered_at},
+        where=UserProgress.status != 'cleared'
+    ).returning(UserProgress.id)
+    return db.session.execute(stmt).first() is not None
+
+
+def record_submission(user_id, quest_id, subject, score, total_questions, all_correct, tz, now=None,
+                      result=None, answers=None):
+    """
+    Writes everything a submitted quest changes: quest_history, user_progress,
+    the attempt log, attempt_buckets, progress_rollups and, when given, the
+    answers packed by answer_log.pack() and the result shown on the result
+    screen (utils/result_store.py). The caller commits right after, so the
+    write lock is held only for these statements.
+    Returns {'is_cleared': bool, 'newly_cleared': bool, 'attempt_id': int, 'result_token': str or None}.
+    """
+    now = now or datetime.now(timezone.utc)
+    is_cleared = upsert_history(user_id, quest_id, all_correct, now)
+    newly_cleared = mark_cleared(user_id, quest_id, now) if is_cleared else False
+
+    attempt_id = db.session.execute(QuestAttemptLog.__table__.insert().values(
+        user_id=user_id,
+        quest_id=quest_id,
+        correct_answers=score,
+        total_questions=total_questions,
+        attempted_at=now
+    ).returning(QuestAttemptLog.id)).scalar()
+    # 再採点用の解答（圧縮は呼び出し元がトランザクションの外で行う）
+    if answers is not None:
+        answer_log.record(attempt_id, user_id, quest_id, answers)
+    # 学習グラフ用の期間別集計
+    attempt_buckets.record_attempt(user_id, subject, now, score == total_questions, tz)
+    # /progress 用の集計
+    rollups.record_attempt(user_id, quest_id, newly_cleared, now)
+    # 結果画面用の採点結果
+    result_token = result_store.save(user_id, quest_id, result) if result is not None else None
+    return {'is_cleared': is_cleared, 'newly_cleared': newly_cleared, 'attempt_id': attempt_id,
+            'result_token': result_token}
@@ -0,0 +1,125 @@
+# utils/write_queue.py
+"""
+ユーザーDBへの書き込みを1本の専用スレッドに集約する書き込みキュー。
+
+リクエストスレッドは書き込み処理（関数）をキューに入れ、Future で結果を待つ。
+書き込みスレッドはキューに溜まった処理をまとめて1つの短いトランザクションで
+実行するため、同時送信が多くても SQLite の書き込みロックを奪い合わない
+（"database is locked" による sleep リトライが発生しない）。WAL モードなので
+読み取りはこのスレッドを待たない。
+
+書き込みスレッドはプロセスごとに1本なので、複数プロセスで動かす場合は
+プロセス間の競合が残る。その場合のロックのエラーは、retry（RetryPolicy.call など）で
+バッチ全体をロールバックしてやり直す。
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Unit:
+    __slots__ = ('fn', 'args', 'kwargs', 'future')
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class WriteQueue:
+    def __init__(self, app, max_batch=32, retry=None):
+        self.app = app
+        self.max_batch = max_batch
+        # retry(fn, site, on_retry): 一時的なエラーでバッチをやり直す
+        self.retry = retry or (lambda fn, site, on_retry=None: fn())
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {'units': 0, 'batches': 0, 'failed_units': 0, 'batch_fallbacks': 0, 'max_batch': 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='mquest-writer', daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs) to run on the writer thread (with db.session
+        bound to the writer's app context) and returns a Future for its result.
+        fn must not commit; the writer commits after the batch.
+        """
+        unit = _Unit(fn, args, kwargs)
+        self.start()
+        self._queue.put(unit)
+        return unit.future
+
+    def stop(self, timeout=5):
+        """Finishes the queued units and stops the writer thread."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def _run(self):
+        with self.app.app_context():
+            stopping = False
+            while not stopping:
+                unit = self._queue.get()
+                if unit is _STOP:
+                    break
+                batch = [unit]
+                # 待っている処理をまとめて1トランザクションにする
+                while len(batch) < self.max_batch:
+                    try:
+                        unit = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if unit is _STOP:
+                        stopping = True
+                        break
+                    batch.append(unit)
+                batch = [u for u in batch if u.future.set_running_or_notify_cancel()]
+                if batch:
+                    self._run_batch(batch)
+
+    def _execute(self, batch):
+        results = [u.fn(*u.args, **u.kwargs) for u in batch]
+        db.session.commit()
+        return results
+
+    def _run_batch(self, batch):
+        try:
+            results = self.retry(lambda: self._execute(batch), 'write_queue:batch',
+                                 on_retry=lambda e: db.session.rollback())
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                self.stats['failed_units'] += 1
+                logger.warning(f"Write unit {batch[0].fn.__name__} failed: {e}")
+                batch[0].future.set_exception(e)
+            else:
+                # どの処理が失敗したか分からないので、1件ずつのトランザクションでやり直す
+                self.stats['batch_fallbacks'] += 1
+                for u in batch:
+                    self._run_batch([u])
+            return
+        finally:
+            db.session.remove()
+
+        self.stats['units'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+        for u, result in zip(batch, results):
+            u.future.set_result(result)